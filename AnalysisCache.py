@@ -0,0 +1,389 @@
+##      AnalysisCache.py
+##
+##      Description: a persistent on-disk cache for analysis results. Entries
+##          are NumPy .npz files keyed by a hash of the audio file's contents
+##          plus the analysis parameters, so re-plotting or re-reporting a file
+##          that was already analysed only reads the arrays back. The cache is
+##          bounded in size with least-recently-used eviction, and is safe to
+##          share between processes: entries are written to a temporary file
+##          and renamed into place, and eviction runs under a file lock.
+##
+##      ©2023
+##
+
+import hashlib
+import json
+import numbers
+import os
+import tempfile
+import zipfile
+import numpy as np
+from Profiling import profiled, annotate
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# bump when the layout of any cached entry changes, so old entries are never read back
+CACHE_FORMAT_VERSION = 1
+
+# set ANALYSIS_CACHE_DIR to move the cache, or to an empty string to turn it off
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "audio_analysis")
+DEFAULT_MAX_BYTES = 1 << 30
+# remembered file digests kept on disk, most recently used first
+MAX_DIGEST_MEMOS = 10000
+# writes between recounts of the cache on disk, which also catch what other processes have written
+RECOUNT_WRITES = 100
+
+
+class FileLock:
+    """
+    Exclusive inter-process lock on a file, held for the duration of a with block
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = None
+
+    def __enter__(self):
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        else:
+            msvcrt.locking(self._fd, msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        else:
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        os.close(self._fd)
+        self._fd = None
+
+
+class AnalysisCache:
+    """
+    Content-addressed store of named NumPy arrays. A cache with directory None is disabled: fetch always
+    computes and nothing is written.
+    """
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._digests = {}
+        self._bytes = None  # size of the entries as last counted, plus what this process has written since
+        self._writes = 0
+        if directory:
+            os.makedirs(os.path.join(directory, "entries"), exist_ok=True)
+            os.makedirs(os.path.join(directory, "digests"), exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def file_digest(self, filename: str) -> str:
+        """
+        SHA-256 of a file's contents. The digest is remembered against the file's path, size and modification
+        time, in memory and (unless the cache is disabled) on disk, so unchanged files are only hashed once.
+        :param filename: path to the file
+        :return: hex digest
+        """
+        stat = os.stat(filename)
+        stat_key = f"{os.path.abspath(filename)}|{stat.st_size}|{stat.st_mtime_ns}"
+        if stat_key in self._digests:
+            return self._digests[stat_key]
+
+        memo = os.path.join(self.directory, "digests", hashlib.sha1(stat_key.encode()).hexdigest()) \
+            if self.enabled else None
+        digest = ""
+        if memo is not None:
+            try:
+                with open(memo, encoding="ascii") as f:
+                    digest = f.read().strip()
+                os.utime(memo)  # mark as recently used
+            except OSError:
+                pass
+        if len(digest) != 64:
+            h = hashlib.sha256()
+            with open(filename, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    h.update(block)
+            digest = h.hexdigest()
+            if memo is not None:
+                self._write_atomic(memo, lambda f: f.write(digest.encode("ascii")))
+                self._wrote(0)
+        self._digests[stat_key] = digest
+        return digest
+
+    @staticmethod
+    def _normalise(value):
+        """
+        :return: value in a form whose JSON is the same for equal settings: every number but a bool as a float
+                    (so 1, 1.0 and np.float64(1.0) agree), sequences and arrays as lists, dicts with their values
+                    normalised
+        """
+        if isinstance(value, (bool, np.bool_)):
+            return bool(value)
+        if isinstance(value, numbers.Real):
+            return float(value)
+        if isinstance(value, (list, tuple, np.ndarray)):
+            return [AnalysisCache._normalise(item) for item in (value.tolist() if isinstance(value, np.ndarray)
+                                                                else value)]
+        if isinstance(value, dict):
+            return {str(name): AnalysisCache._normalise(item) for name, item in value.items()}
+        return value
+
+    def key(self, filename: str, kind: str, **params) -> str:
+        """
+        :param filename: the analysed audio file
+        :param kind: name of the analysis, e.g. 'spectrogram' or 'getVals'
+        :param params: every parameter that changes the result; numbers count as equal by value, whatever their
+                        type
+        :return: the cache key for that analysis of that file's contents
+        """
+        settings = json.dumps(self._normalise(params), sort_keys=True, default=str)
+        text = f"v{CACHE_FORMAT_VERSION}|{self.file_digest(filename)}|{kind}|{settings}"
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, "entries", key[:2], key + ".npz")
+
+    def _write_atomic(self, path: str, write):
+        """
+        Writes a file through a temporary file in the same directory and renames it into place, so other
+        processes only ever see complete files
+        """
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=folder, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    def load(self, key: str):
+        """
+        :param key: a key from AnalysisCache.key
+        :return: dict of name -> array, or None if the entry is not cached
+        """
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files}
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, zipfile.BadZipFile):
+            # unreadable entry, drop it and recompute
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        try:
+            os.utime(path)  # mark as recently used
+        except OSError:
+            pass
+        return arrays
+
+    def store(self, key: str, arrays: dict):
+        """
+        :param key: a key from AnalysisCache.key
+        :param arrays: dict of name -> array to save
+        """
+        if not self.enabled:
+            return
+        path = self._path(key)
+        self._write_atomic(path, lambda f: np.savez(f, **arrays))
+        try:
+            self._wrote(os.path.getsize(path))
+        except OSError:  # already evicted by another process
+            pass
+
+    def _wrote(self, size: int):
+        """
+        Adds a write to the running total, and evicts once it is over the limit. The entries and digest memos are
+        only counted on disk again every RECOUNT_WRITES writes, rather than on every write.
+        :param size: bytes of the entry written, 0 for a digest memo
+        """
+        self._writes += 1
+        if self._bytes is None or self._writes % RECOUNT_WRITES == 0:
+            self._bytes = self.size()
+            self._prune_digests()
+        else:
+            self._bytes += size
+        if self._bytes > self.max_bytes:
+            self.evict()
+
+    @profiled(name="cache_fetch", params=("kind",))
+    def fetch(self, filename: str, kind: str, compute, **params) -> dict:
+        """
+        Returns the cached arrays for an analysis, computing and storing them on a miss
+        :param filename: the analysed audio file
+        :param kind: name of the analysis
+        :param compute: function taking no arguments that returns the dict of arrays
+        :param params: every parameter that changes the result
+        :return: dict of name -> array
+        """
+        key = self.key(filename, kind, **params) if self.enabled else None
+        arrays = self.load(key) if self.enabled else None
+        annotate(hit=arrays is not None)
+        if arrays is None:
+            arrays = {name: np.asarray(value) for name, value in compute().items()}
+            self.store(key, arrays)
+        return arrays
+
+    def _entries(self) -> list[tuple[float, int, str]]:
+        """
+        :return: (last used time, size in bytes, path) of every entry
+        """
+        entries = []
+        root = os.path.join(self.directory, "entries")
+        for folder in os.scandir(root):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                if entry.name.endswith(".npz"):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def size(self) -> int:
+        """
+        :return: total size of the cached entries in bytes
+        """
+        return sum(size for _, size, _ in self._entries()) if self.enabled else 0
+
+    def evict(self, max_bytes: int = None):
+        """
+        Removes least recently used entries until the cache fits in max_bytes
+        :param max_bytes: size to shrink to, defaults to the cache's limit
+        """
+        if not self.enabled:
+            return
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        with FileLock(os.path.join(self.directory, "lock")):
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:  # already removed by another process, or open on Windows
+                    continue
+                total -= size
+            self._bytes = total
+        self._prune_digests()
+
+    def _prune_digests(self, keep: int = MAX_DIGEST_MEMOS):
+        """
+        Removes the least recently used digest memos beyond the newest keep; a file whose memo is gone is only
+        hashed again
+        """
+        memos = []
+        for memo in os.scandir(os.path.join(self.directory, "digests")):
+            if memo.name.endswith(".tmp"):  # another process's memo being written
+                continue
+            try:
+                memos.append((memo.stat().st_mtime, memo.path))
+            except OSError:
+                continue
+        if len(memos) <= keep:
+            return
+        memos.sort()
+        for _, path in memos[:len(memos) - keep]:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+
+    def clear(self):
+        """
+        Removes every entry
+        """
+        self.evict(0)
+
+
+_default_cache = None
+
+
+def get_cache() -> AnalysisCache:
+    """
+    :return: the process-wide cache, in ANALYSIS_CACHE_DIR if set (an empty value disables it)
+    """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = AnalysisCache(os.environ.get("ANALYSIS_CACHE_DIR", DEFAULT_CACHE_DIR))
+    return _default_cache
+
+
+def set_cache(cache: AnalysisCache):
+    """
+    Replaces the process-wide cache, e.g. with AnalysisCache(None) to turn caching off
+    """
+    global _default_cache
+    _default_cache = cache
+
+
+class CachedSpectrogram:
+    """
+    The parts of a parselmouth.Spectrogram used for plotting, rebuilt from cached arrays
+    """
+
+    def __init__(self, arrays: dict):
+        self.values = arrays["values"]
+        self._x_grid = arrays["x_grid"]
+        self._y_grid = arrays["y_grid"]
+        self.xmin, self.xmax = self._x_grid[0], self._x_grid[-1]
+        self.ymin, self.ymax = self._y_grid[0], self._y_grid[-1]
+
+    @staticmethod
+    def to_arrays(spectrogram) -> dict:
+        """
+        :param spectrogram: a parselmouth.Spectrogram
+        :return: the arrays to cache for it
+        """
+        return {"values": spectrogram.values, "x_grid": spectrogram.x_grid(), "y_grid": spectrogram.y_grid()}
+
+    def x_grid(self) -> np.ndarray:
+        return self._x_grid
+
+    def y_grid(self) -> np.ndarray:
+        return self._y_grid
+
+
+def main():
+    import time
+    import parselmouth as pm
+
+    cache = get_cache()
+    inFile = "Thats One Small.wav"
+
+    def compute():
+        sg = pm.Sound(inFile).to_spectrogram(window_length=0.032169, time_step=0.001)
+        return CachedSpectrogram.to_arrays(sg)
+
+    for attempt in ("first", "second"):
+        start = time.perf_counter()
+        arrays = cache.fetch(inFile, "spectrogram", compute, window_length=0.032169, time_step=0.001)
+        print(f"{attempt} fetch: {(time.perf_counter() - start) * 1000:.1f} ms, values {arrays['values'].shape}")
+    print(f"cache size: {cache.size() / 1e6:.1f} MB in {cache.directory}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+##      AnalysisCore.py
+##
+##      Description: the analysis side of the project with nothing of the
+##          plotting side: extracting pitch, formant and intensity tracks,
+##          cleaning and smoothing them, and their frame-to-frame differences.
+##          It imports only numpy, parselmouth and the project's other
+##          numpy-only modules, so worker processes and services start
+##          without matplotlib or tkinter; Assignment_2, FormantCleaning and
+##          ExtractValues import these functions from here and load
+##          matplotlib and tkinter only when something is drawn.
+##
+##          python -X importtime -c "import AnalysisCore" shows the cost, and
+##          python Benchmarks.py --imports checks it against IMPORT_BUDGET_MS.
+##
+##      ©2023
+##
+
+import os.path as path
+from contextlib import nullcontext
+import parselmouth as pm
+import numpy as np
+from MovingAverages import movingAvg, movingMedian
+from TrackExtraction import (pitch_track, formant_track, intensity_track, intensity_gate, apply_gate,
+                             extract_frames, FrameGrid, grid_intensity_track)
+from AnalysisCache import get_cache
+from WavReader import MappedWav
+from StreamingAnalysis import StreamingAnalyser
+from Profiling import profiled, stage, annotate
+from AnalysisSession import AnalysisSession
+from AnalysisFrames import CLEAN_FEATURES, FormantTrack, AnalysisFrameSet, clean_layout_arrays
+
+
+def get_pitch_values(pitch: pm.Pitch, intensity: pm.Intensity,
+                     intensity_filter: float = 0, nan_as_zero=True) -> tuple[list[float, ...], list[float, ...]]:
+    """
+        Extracts the values pitch from the pitch object. Optionally filters out formant that occur when
+        intensity is below a certain value.
+        :param pitch: a parselmouth.Pitch object
+        :param intensity: a parselmouth.Intensity object
+        :param intensity_filter: sets the value at or below which pitch will be filtered out. Does nothing if set to zero
+        :param nan_as_zero: converts nan values to 0.0 if True, leaves them if False
+        :return: a tuple containing the list of time steps and the list of pitch values
+        """
+    times = pitch.ts()
+    gate = intensity_gate(intensity, times, intensity_filter)
+    values = apply_gate(pitch_track(pitch, times), gate, nan_as_zero)
+    return times, values.tolist()
+
+
+def get_formant_values(formant_number: int, formants: pm.Formant, intensity: pm.Intensity,
+                       intensity_filter: float = 0, nan_as_zero=True) -> tuple[list[float, ...], list[float, ...]]:
+    """
+    Extracts the formant values for a particular formant from the formants object. Optionally filters out formants
+    that occur when intensity is below a certain value.
+    :param formant_number: The formant to extract
+    :param formants: a parselmouth.Formants object
+    :param intensity: a parselmouth.Intensity object
+    :param intensity_filter: sets the value at or below which formants will be filtered out. Does nothing if set to zero
+    :param nan_as_zero: converts nan values to 0.0 if True, leaves them if False
+    :return: a tuple containing the list of time steps and the list of formant values
+    """
+    times = formants.ts()
+    gate = intensity_gate(intensity, times, intensity_filter)
+    values = apply_gate(formant_track(formant_number, formants, times), gate, nan_as_zero)
+    return times, values.tolist()
+
+
+@profiled(frames=lambda formants: sum(len(f_times) for f_times, _ in formants))
+def get_formants(pitch: pm.Pitch, formants: pm.Formant, intensity: pm.Intensity,
+                 which_formants: tuple[int, ...] = (0, 1, 2, 3, 4), intensity_filter: float = 0, nan_as_zero=True) -> \
+        list[
+            tuple[list[float, ...], list[float, ...]]]:
+    """
+    :param pitch: parselmouth Pitch
+    :param formants: parselmouth Formants
+    :param intensity: parselmouth Intensity
+    :param which_formants: tuple that contains the formants to get
+    :param intensity_filter: float that when 0 does nothing and when > 0 sets returned formant values to 0 if the
+                                intensity at that time is not above the filter value
+    :param nan_as_zero: converts nan values to 0.0 if True, leaves them if False
+    :return: a list that contains lists of the formant values. The order of the formant lists matches the
+                                order of the which_formants tuple
+    """
+
+    formant_values = []
+    for f in which_formants:
+        if f == 0:
+            formant_values.append(get_pitch_values(pitch, intensity, intensity_filter, nan_as_zero=nan_as_zero))
+        else:
+            formant_values.append(get_formant_values(f, formants, intensity, intensity_filter, nan_as_zero=nan_as_zero))
+
+    return formant_values
+
+
+def get_formant_differences(formants: list[tuple[list[float, ...], list[float, ...]]]) -> list[
+    tuple[list[float, ...], list[float, ...]]]:
+    """
+    :param formants: 2-d list in the form returned by get_formants
+    :return: 2-d list in the form returned by get_formants containing the differences
+            note: differences list will have one fewer element than the original list,
+                  if list has values at indices i=0..len-1, then return list will contain elements L[i+1] - L[i]
+    """
+    diffs = []
+    for f_list in formants:
+        assert (len(f_list[0]) == len(f_list[1]))  # if assert fails, there is an issue with the way the lists are built
+        f_times = np.asarray(f_list[0], dtype=float)
+        f_vals = np.asarray(f_list[1], dtype=float)
+        f_diffs = np.where((f_vals[:-1] == 0) | (f_vals[1:] == 0), 0.0, np.diff(f_vals))
+        diffs.append((((f_times[:-1] + f_times[1:]) / 2).tolist(), f_diffs.tolist()))
+    return diffs
+
+
+def _analyse_loud_formants(filename: str, time_step: float, intensity_filter: float) -> dict:
+    """
+    The arrays analyse_formants caches, with pitch and formants analysed only around the frames that pass
+    intensity_filter
+    """
+    analyser = StreamingAnalyser(filename, time_step=time_step, pitch_ceiling=300)
+    with stage('analyses'):
+        tracks = analyser.analyse_loud(intensity_floor=intensity_filter)
+    annotate(analysed_fraction=round(analyser.analysed_fraction(), 3), regions=len(analyser.regions))
+    i_times, i_values = tracks['intensity']
+    grid = FrameGrid(i_times[0], time_step)
+    (p_times, p_values), (f_times, f_values) = tracks['pitch'], tracks['formant']
+    with np.errstate(invalid='ignore'):
+        p_gate = grid_intensity_track(grid, i_values, p_times) >= intensity_filter
+        f_gate = grid_intensity_track(grid, i_values, f_times) >= intensity_filter
+    # skipped frames are NaN, and all fail the gate, so they come out 0 like the quiet frames get_formants zeroes
+    arrays = {'times0': p_times, 'values0': apply_gate(p_values, p_gate)}
+    for i, row in enumerate(f_values, start=1):
+        arrays[f'times{i}'] = f_times
+        arrays[f'values{i}'] = apply_gate(row, f_gate)
+    return arrays
+
+
+@profiled(params=('filename', 'time_step', 'from_time', 'to_time', 'skip_quiet'))
+def analyse_formants(filename: str, time_step: float = None, from_time: float = None,
+                     to_time: float = None, intensity_filter: float = 0,
+                     skip_quiet: bool = False) -> list[tuple[np.ndarray, list[float, ...]]]:
+    """
+    Runs the pitch (autocorrelation, 300 Hz ceiling), formant and intensity analysis on a file, or on one interval
+    of it, and extracts the values with get_formants. Results are kept in the analysis cache, so analysing the same
+    file contents with the same settings again only reads them back.
+    :param filename: path to a .wav file
+    :param time_step: analysis time step in seconds, None for the parselmouth defaults
+    :param from_time: start of the interval to analyse, None for the whole file
+    :param to_time: end of the interval to analyse
+    :param intensity_filter: the intensity_filter of get_formants: values are 0 where intensity is below it
+    :param skip_quiet: analyse intensity first and pitch and formants only around the frames that pass
+                        intensity_filter (StreamingAnalyser.analyse_loud), which saves most of the work on recordings
+                        that are mostly silence. Needs a time_step, an intensity_filter and the whole file.
+    :return: a list of (times, values) pairs for F0-F4, in the form returned by get_formants
+    """
+    if skip_quiet and (time_step is None or not intensity_filter or from_time is not None):
+        raise ValueError("skip_quiet needs a time_step and an intensity_filter, and analyses whole files only")
+
+    def compute():
+        if skip_quiet:
+            return _analyse_loud_formants(filename, time_step, intensity_filter)
+        if from_time is None:
+            source = filename
+        else:
+            # only the interval's samples are read from the file
+            with stage('load'), MappedWav(filename) as wav:
+                source = wav.extract_part(from_time, to_time)
+        step = {} if time_step is None else {'time_step': time_step}
+        # the three analyses run at the same time
+        with AnalysisSession(source) as session:
+            pitch = session.pitch_ac(pitch_ceiling=300, **step)
+            formants = session.formants(**step)
+            intensity = session.intensity(**step)
+            with stage('analyses'):
+                pitch, formants, intensity = pitch.result(), formants.result(), intensity.result()
+        arrays = {}
+        for i, (f_times, f_vals) in enumerate(get_formants(pitch, formants, intensity,
+                                                           intensity_filter=intensity_filter, nan_as_zero=True)):
+            arrays[f'times{i}'] = f_times
+            arrays[f'values{i}'] = f_vals
+        return arrays
+
+    # only settings that differ from the defaults go into the key, so earlier entries stay valid
+    gating = {'intensity_filter': intensity_filter} if intensity_filter else {}
+    if skip_quiet:
+        gating['skip_quiet'] = True
+    arrays = get_cache().fetch(filename, 'formants', compute, time_step=time_step, pitch_ceiling=300,
+                               from_time=from_time, to_time=to_time, **gating)
+    return [(arrays[f'times{i}'], arrays[f'values{i}'].tolist()) for i in range(5)]
+
+
+##  clean_formants
+##  pre:
+##          pitch, formants and intensity are parselmouth Pitch, Formant and Intensity objects of one sound
+##  Post:
+##          returns - lists of pitch, F1-F4, frame times and intensity on the intensity frames, with pitch and
+##                    formants 0 where unvoiced or below 55 dB
+##
+@profiled(frames=lambda values: len(values[5]))
+def clean_formants(pitch, formants, intensity):
+    times, values, intensity_values = extract_frames(pitch, formants, intensity, intensity_floor=55)
+    pitch_values, f1_values, f2_values, f3_values, f4_values = values.tolist()
+    values = [pitch_values, f1_values, f2_values, f3_values, f4_values, times.tolist(), intensity_values.tolist()]
+    #values = smooth_formants(values)
+    return values
+
+##  smooth_formants
+##  pre:
+##          values is in the layout returned by clean_formants, or an AnalysisFrameSet
+##          kernSize is the window size in frames, made odd if even
+##          method is "mean" for a moving average or "median" for a running median
+##  Post:
+##          returns - values with pitch and F1-F4 smoothed together as one 2-D array; zero (unvoiced
+##                    or below the intensity floor) and NaN frames are left out of every window and kept as is.
+##                    An AnalysisFrameSet gives a new AnalysisFrameSet
+##
+def smooth_formants(values, kernSize = 3, method = "mean"):
+    if kernSize%2 == 0:
+        kernSize += 1
+
+    tracks, times, intensity = clean_layout_arrays(values)
+    tracks = tracks.astype(float)
+    if method == "median":
+        filtered = movingMedian(tracks, kernSize)
+    elif method == "mean":
+        filtered = movingAvg(tracks, kernSize)
+    else:
+        raise ValueError(f"unknown smoothing method '{method}', use 'mean' or 'median'")
+    if isinstance(values, AnalysisFrameSet):
+        return AnalysisFrameSet.from_clean_layout([*filtered, times, intensity], values.data.dtype)
+    filtered_pitch, filtered_f1, filtered_f2, filtered_f3, filtered_f4 = filtered.tolist()
+    return [filtered_pitch, filtered_f1, filtered_f2, filtered_f3, filtered_f4, values[5], values[6]]
+
+##  loadCleanFormants
+##  pre:
+##          inFile is a valid .wav file
+##          session is an AnalysisSession of inFile to run the analyses in, or None for a new one
+##  Post:
+##          returns - clean_formants values for the pitch/formant/intensity settings used by plotValues,
+##                    from the analysis cache if they were computed before
+##
+@profiled(params=("inFile",))
+def loadCleanFormants(inFile, session=None):
+    return _cleanFormantArrays(inFile, session).tolist()
+
+##  loadCleanFrames
+##  pre:
+##          inFile is a valid .wav file
+##          dtype is np.float32 or np.float64
+##          session is an AnalysisSession of inFile to run the analyses in, or None for a new one
+##  Post:
+##          returns - the loadCleanFormants values as an AnalysisFrameSet, about a sixth of the memory as float32
+##
+@profiled(params=("inFile",))
+def loadCleanFrames(inFile, dtype=np.float32, session=None):
+    return AnalysisFrameSet.from_clean_layout(_cleanFormantArrays(inFile, session), dtype)
+
+def _cleanFormantArrays(inFile, session):
+    def compute():
+        with nullcontext(session) if session else AnalysisSession(inFile) as analyses:
+            # the three analyses run at the same time
+            intensity = analyses.intensity(time_step=0.001)
+            formants = analyses.formants(time_step=0.001, window_length=0.032169)
+            pitch = analyses.pitch(time_step=0.001019)
+            with stage("analyses"):
+                analysed = pitch.result(), formants.result(), intensity.result()
+        return {"values": np.array(clean_formants(*analysed))}
+    arrays = get_cache().fetch(inFile, "clean_formants", compute, intensity_time_step=0.001,
+                               formant_time_step=0.001, window_length=0.032169, pitch_time_step=0.001019)
+    return arrays["values"]
+
+##  _extractVals
+##  pre:
+##          inFile is a valid .wav file
+##  Post:
+##          returns - dict of the frame times and raw pitch, F1-F4 and intensity tracks used by getVals,
+##                    undefined values as 0
+##
+def _extractVals(inFile):
+    #import sound object
+    with stage("load"):
+        snd = pm.Sound(inFile)
+
+    #extract data objects
+    with stage("to_pitch"):
+        pitch = snd.to_pitch(time_step=0.001)
+    with stage("to_formant_burg"):
+        formants = snd.to_formant_burg(time_step=0.001, window_length=pitch.get_time_from_frame_number(1))
+    with stage("to_intensity"):
+        intensity = snd.to_intensity(time_step=0.001)
+
+    arrays = {"pitch_ts": pitch.ts(), "formants_ts": formants.ts(), "intensity_ts": intensity.ts()}
+    arrays["track0"] = pitch_track(pitch, arrays["pitch_ts"])
+    for i in range(1, 5):
+        arrays[f"track{i}"] = formant_track(i, formants, arrays["formants_ts"])
+    arrays["track5"] = intensity_track(intensity, arrays["intensity_ts"])
+    for i in range(6):
+        arrays[f"track{i}"][np.isnan(arrays[f"track{i}"])] = 0
+    return arrays
+
+@profiled(params=("inFile",), frames=lambda values: len(values[0][0]) if values else 0)
+def getVals(inFile: str):
+    #check if valid wave file
+    if path.isfile(inFile) and inFile.endswith(".wav"):
+        arrays = _cachedVals(inFile)
+
+        #time sequences superlist
+        times = [arrays["pitch_ts"], arrays["formants_ts"], arrays["intensity_ts"]]
+        tracks = [arrays[f"track{i}"] for i in range(6)]
+
+        #calculate differences, earlier minus later, with a leading 0
+        vals = []
+        diffs = []
+        for track in tracks:
+            temp = track[:-1] - track[1:]
+            temp[np.isnan(temp)] = 0
+            vals.append(track.tolist())
+            diffs.append([0] + temp.tolist())
+
+        # 3-D array of format values[time_sequence[pitch=0/formants=1[index]]][raw data[data 0-5[index]]][differences[data  0-5[index]]]
+        values = [times, vals, diffs]
+        return values
+
+def _cachedVals(inFile):
+    return get_cache().fetch(inFile, "getVals", lambda: _extractVals(inFile), time_step=0.001)
+
+##  getTracks
+##  pre:
+##          inFile is a valid .wav file
+##          dtype is np.float32 or np.float64
+##  Post:
+##          returns - the getVals tracks as six FormantTracks (pitch, F1-F4, intensity), the formants sharing
+##                    one times array, about an eighth of the memory as float32; FormantTrack.diffs gives the getVals
+##                    differences. None if inFile is not a .wav file
+##
+@profiled(params=("inFile",))
+def getTracks(inFile: str, dtype=np.float32):
+    if path.isfile(inFile) and inFile.endswith(".wav"):
+        arrays = _cachedVals(inFile)
+        times = [arrays["pitch_ts"]] + [arrays["formants_ts"]] * 4 + [arrays["intensity_ts"]]
+        # undefined values are 0 in every getVals track
+        return [FormantTrack(name, t, arrays[f"track{i}"], arrays[f"track{i}"] != 0, dtype)
+                for i, (name, t) in enumerate(zip(CLEAN_FEATURES, times))]
@@ -0,0 +1,224 @@
+##      AnalysisFrames.py
+##
+##      Description: compact containers for analysis tracks. getVals and
+##          clean_formants return parallel Python lists of boxed floats, about
+##          32 bytes per value; these keep the values in NumPy arrays of
+##          float32 or float64 (4 or 8 bytes) with a one-byte validity mask,
+##          and derive differences on demand instead of storing them. Slicing
+##          returns views, so taking part of a track or frame set copies
+##          nothing.
+##
+##          FormantTrack is one track with its own frame times, as getVals
+##          has (pitch, formants and intensity each have their own frames).
+##          AnalysisFrameSet is several tracks on one set of frame times, as
+##          clean_formants has, stored as one frames x features array.
+##
+##      ©2023
+##
+
+import numpy as np
+
+# features of a frame set in the clean_formants layout
+CLEAN_FEATURES = ("F0", "F1", "F2", "F3", "F4", "intensity")
+# features where 0 means unvoiced or below the intensity floor, not a measured value
+ZERO_IS_MISSING = frozenset(("F0", "F1", "F2", "F3", "F4"))
+
+
+def _validity(values: np.ndarray, zero_is_missing) -> np.ndarray:
+    valid = ~np.isnan(values)
+    if zero_is_missing is not None:
+        valid &= (values != 0) | ~np.asarray(zero_is_missing, dtype=bool)
+    return valid
+
+
+class FormantTrack:
+    """
+    One track: frame times, values and which values are defined
+    """
+
+    __slots__ = ("name", "times", "values", "valid")
+
+    def __init__(self, name: str, times, values, valid=None, dtype=np.float64):
+        """
+        :param name: e.g. "F1"
+        :param times: frame times in seconds; kept as float64, and shared rather than copied when it already is
+        :param values: one value per frame, NaN (or 0 for pitch and formants) where undefined
+        :param valid: mask of the defined frames, derived from values if None
+        :param dtype: np.float32 or np.float64 for the values
+        """
+        self.name = name
+        self.times = np.asarray(times, dtype=np.float64)
+        self.values = np.asarray(values, dtype=dtype)
+        self.valid = _validity(self.values, name in ZERO_IS_MISSING) if valid is None else valid
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        """
+        :return: the value of one frame, or a FormantTrack viewing a slice of the frames
+        """
+        if isinstance(index, slice):
+            return FormantTrack(self.name, self.times[index], self.values[index], self.valid[index],
+                                self.values.dtype)
+        return self.values[index]
+
+    def __repr__(self):
+        return f"FormantTrack({self.name!r}, {len(self)} frames, {self.values.dtype})"
+
+    @property
+    def nbytes(self) -> int:
+        return self.times.nbytes + self.values.nbytes + self.valid.nbytes
+
+    def between(self, from_time: float, to_time: float) -> "FormantTrack":
+        """
+        :return: a view of the frames from from_time up to and including to_time
+        """
+        start = np.searchsorted(self.times, from_time, side="left")
+        stop = np.searchsorted(self.times, to_time, side="right")
+        return self[start:stop]
+
+    def diffs(self) -> np.ndarray:
+        """
+        :return: frame-to-frame differences in the getVals convention: earlier minus later, with a leading 0,
+                    and 0 where either value is NaN
+        """
+        diffs = np.zeros(len(self.values), dtype=self.values.dtype)
+        np.subtract(self.values[:-1], self.values[1:], out=diffs[1:])
+        diffs[np.isnan(diffs)] = 0
+        return diffs
+
+    def defined(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        :return: (times, values) of the defined frames only
+        """
+        return self.times[self.valid], self.values[self.valid]
+
+
+class AnalysisFrameSet:
+    """
+    Tracks sampled on one set of frame times, as a frames x features array with a mask of the defined values
+    """
+
+    __slots__ = ("features", "times", "data", "valid")
+
+    def __init__(self, features, times, data, valid=None, dtype=np.float64):
+        """
+        :param features: feature names, one per column
+        :param times: frame times in seconds, kept as float64
+        :param data: frames x features values, NaN (or 0 for pitch and formants) where undefined
+        :param valid: frames x features mask of the defined values, derived from data if None
+        :param dtype: np.float32 or np.float64 for the values
+        """
+        self.features = tuple(features)
+        self.times = np.asarray(times, dtype=np.float64)
+        self.data = np.asarray(data, dtype=dtype)
+        if self.data.shape != (len(self.times), len(self.features)):
+            raise ValueError(f"data has shape {self.data.shape}, expected ({len(self.times)}, {len(self.features)})")
+        self.valid = valid if valid is not None else \
+            _validity(self.data, [name in ZERO_IS_MISSING for name in self.features])
+
+    @classmethod
+    def from_clean_layout(cls, values, dtype=np.float64) -> "AnalysisFrameSet":
+        """
+        :param values: in the layout returned by FormantCleaning.clean_formants, as lists or a 7 x n array
+        :param dtype: np.float32 or np.float64 for the values
+        """
+        tracks, times, intensity = values[:5], values[5], values[6]
+        data = np.empty((len(times), len(CLEAN_FEATURES)), dtype=dtype)
+        data[:, :5] = np.asarray(tracks, dtype=float).T
+        data[:, 5] = intensity
+        return cls(CLEAN_FEATURES, times, data, dtype=dtype)
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, index):
+        """
+        :param index: a feature name, for a FormantTrack viewing that column; or a frame index, slice or mask,
+                        for the frames as an AnalysisFrameSet (a view for slices)
+        """
+        if isinstance(index, str):
+            column = self.features.index(index)
+            return FormantTrack(index, self.times, self.data[:, column], self.valid[:, column], self.data.dtype)
+        if isinstance(index, (int, np.integer)):
+            index = slice(index, index + 1 or None)
+        return AnalysisFrameSet(self.features, self.times[index], self.data[index], self.valid[index],
+                                self.data.dtype)
+
+    def __repr__(self):
+        return f"AnalysisFrameSet({len(self)} frames x {self.features}, {self.data.dtype})"
+
+    @property
+    def nbytes(self) -> int:
+        return self.times.nbytes + self.data.nbytes + self.valid.nbytes
+
+    def column(self, name: str) -> np.ndarray:
+        """
+        :return: a view of one feature's values
+        """
+        return self.data[:, self.features.index(name)]
+
+    def between(self, from_time: float, to_time: float) -> "AnalysisFrameSet":
+        """
+        :return: a view of the frames from from_time up to and including to_time
+        """
+        start = np.searchsorted(self.times, from_time, side="left")
+        stop = np.searchsorted(self.times, to_time, side="right")
+        return self[start:stop]
+
+    def astype(self, dtype) -> "AnalysisFrameSet":
+        return AnalysisFrameSet(self.features, self.times, self.data.astype(dtype, copy=False), self.valid, dtype)
+
+    def to_clean_layout(self) -> list:
+        """
+        :return: the lists returned by FormantCleaning.clean_formants
+        """
+        tracks = [self.column(name).tolist() for name in CLEAN_FEATURES[:5]]
+        return tracks + [self.times.tolist(), self.column("intensity").tolist()]
+
+
+def clean_layout_arrays(values) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Lets functions written for the clean_formants layout take an AnalysisFrameSet too
+    :param values: in the layout returned by FormantCleaning.clean_formants, or an AnalysisFrameSet with its
+                    features
+    :return: (5 x n pitch and F1-F4, times, intensity) arrays; views for an AnalysisFrameSet
+    """
+    if isinstance(values, AnalysisFrameSet):
+        columns = [values.features.index(name) for name in CLEAN_FEATURES[:5]]
+        return values.data[:, columns].T, values.times, values.column("intensity")
+    return np.asarray(values[:5], dtype=float), np.asarray(values[5], dtype=float), \
+        np.asarray(values[6], dtype=float)
+
+
+def main():
+    import time
+    from AnalysisCore import getVals, getTracks, loadCleanFormants, loadCleanFrames
+
+    def list_bytes(lists) -> int:
+        # a list holds an 8-byte pointer per item, and each float is a 24-byte object
+        return sum(8 * len(values) + 56 + 24 * len(values) for values in lists)
+
+    inFile = "One Small Step.wav"
+    times, vals, diffs = getVals(inFile)
+    boxed = list_bytes(vals) + list_bytes(diffs) + sum(t.nbytes for t in times)
+    for dtype in (np.float64, np.float32):
+        start = time.perf_counter()
+        tracks = getTracks(inFile, dtype=dtype)
+        elapsed = time.perf_counter() - start
+        shared = {id(track.times): track.times.nbytes for track in tracks}
+        compact = sum(track.values.nbytes + track.valid.nbytes for track in tracks) + sum(shared.values())
+        print(f"getVals: {boxed / 1e6:.1f} MB as lists, {compact / 1e6:.1f} MB as {np.dtype(dtype).name} tracks "
+              f"({boxed / compact:.0f}x smaller, {elapsed * 1000:.1f} ms)")
+
+    values = loadCleanFormants(inFile)
+    boxed = list_bytes(values)
+    frames = loadCleanFrames(inFile, dtype=np.float32)
+    print(f"clean_formants: {boxed / 1e6:.1f} MB as lists, {frames.nbytes / 1e6:.1f} MB as {frames!r} "
+          f"({boxed / frames.nbytes:.0f}x smaller)")
+    print(f"F2 from 1 to 2 s: {frames.between(1.0, 2.0)['F2']!r}")
+
+
+if __name__ == "__main__":
+    main()
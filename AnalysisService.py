@@ -0,0 +1,544 @@
+##      AnalysisService.py
+##
+##      Description: a small local HTTP service for the analyses of
+##          Assignment_2 and ExtractValues, so tools can share one set of warm
+##          worker processes instead of each paying the import and analysis
+##          cost. Requests name a file on this machine (path=...) or upload
+##          the WAV itself as the request body. The CPU work runs in a process
+##          pool. Identical requests that arrive while one is being computed
+##          wait for that result instead of starting their own, and finished
+##          responses are kept in memory for repeats. The workers also share
+##          the on-disk analysis cache.
+##
+##          usage: python AnalysisService.py serve [--host HOST] [--port PORT | --unix SOCKET] [-j JOBS]
+##                 python AnalysisService.py load <file.wav> ... [--url URL] [-n REQUESTS] [-c CONCURRENCY]
+##
+##          Endpoints (parameters in the query string):
+##              GET/POST /tracks   F0-F4 from analyse_formants             time_step, from_time, to_time
+##              GET/POST /values   pitch, F1-F4 and intensity from getVals
+##              GET/POST /report   interval_report text as JSON            from_time, to_time
+##              GET/POST /plot     one PNG                                 kind (formants, waveform,
+##                                                                          spectrogram, values), formant
+##              GET /stats         request counts and latencies
+##          e.g. curl 'localhost:8765/report?path=Thats.wav&from_time=0.1&to_time=0.3'
+##               curl --data-binary @Thats.wav 'localhost:8765/plot?kind=spectrogram' -o sg.png
+##
+##      ©2023
+##
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import urllib.parse
+
+import numpy as np
+
+DEFAULT_PORT = 8765
+# largest upload accepted, in bytes
+MAX_BODY = 512 * 1024 * 1024
+# uploads kept in the spool directory, in bytes; the least recently used ones that no request is reading go first
+SPOOL_BYTES = 4 * MAX_BODY
+PLOT_KINDS = ("formants", "waveform", "spectrogram", "values")
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class RequestError(Exception):
+    """
+    A request the service can't answer, with the HTTP status to send back
+    """
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def _json_values(values) -> list:
+    """
+    :return: values as a list for JSON, with NaN as null
+    """
+    values = np.asarray(values, dtype=float)
+    return [None if v != v else v for v in values.tolist()]
+
+
+def _init_worker():
+    # import everything once per worker, before the first request arrives
+    os.environ["ANALYSIS_WORKERS"] = "1"  # the service's own pool is the parallelism
+    # headless plots without importing matplotlib now; only /plot requests load it
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    import AnalysisCore  # noqa: F401
+    import Assignment_2  # noqa: F401
+
+
+def _tracks_job(filename: str, time_step: float, from_time: float, to_time: float) -> tuple[str, bytes]:
+    from AnalysisCore import analyse_formants
+    values = analyse_formants(filename, time_step=time_step, from_time=from_time, to_time=to_time)
+    tracks = {f"F{i}": {"times": _json_values(times), "values": _json_values(vals)}
+              for i, (times, vals) in enumerate(values)}
+    return "application/json", json.dumps(tracks).encode("utf8")
+
+
+def _values_job(filename: str) -> tuple[str, bytes]:
+    from AnalysisCore import getVals
+    times, vals, diffs = getVals(filename)
+    names = ("F0", "F1", "F2", "F3", "F4", "intensity")
+    # pitch, formant and intensity frame times, in the order getVals lists them
+    time_index = (0, 1, 1, 1, 1, 2)
+    tracks = {name: {"times": _json_values(times[t]), "values": _json_values(v), "diffs": _json_values(d)}
+              for name, t, v, d in zip(names, time_index, vals, diffs)}
+    return "application/json", json.dumps(tracks).encode("utf8")
+
+
+def _report_job(filename: str, from_time: float, to_time: float) -> tuple[str, bytes]:
+    from Assignment_2 import interval_report
+    report = interval_report(filename, from_time, to_time)
+    return "application/json", json.dumps({"from_time": from_time, "to_time": to_time,
+                                           "report": report}).encode("utf8")
+
+
+def _plot_job(filename: str, kind: str, formant: int) -> tuple[str, bytes]:
+    from BatchRunner import render_plots
+    with tempfile.TemporaryDirectory() as folder:
+        written = render_plots(filename, os.path.join(folder, ""), (kind,))
+        image = written[formant] if kind == "formants" else written[0]
+        with open(image, "rb") as f:
+            return "image/png", f.read()
+
+
+def _float(query: dict, name: str, default=None, positive: bool = False):
+    """
+    :param positive: whether the number must be greater than 0 rather than at least 0
+    :return: the finite, non-negative number query[name], or default when it isn't given
+    """
+    if name not in query:
+        return default
+    try:
+        value = float(query[name])
+    except ValueError:
+        raise RequestError(400, f"{name} must be a number, not '{query[name]}'")
+    if not math.isfinite(value) or value < 0 or (positive and value == 0):
+        raise RequestError(400, f"{name} must be a finite number {'above' if positive else 'of at least'} 0, "
+                                f"not '{query[name]}'")
+    return value
+
+
+def _job(endpoint: str, filename: str, query: dict):
+    """
+    :return: (worker function, arguments) answering a request
+    """
+    if endpoint == "/tracks":
+        from_time, to_time = _float(query, "from_time"), _float(query, "to_time")
+        if (from_time is None) != (to_time is None):
+            raise RequestError(400, "from_time and to_time go together")
+        if from_time is not None and from_time >= to_time:
+            raise RequestError(400, "/tracks needs from_time < to_time")
+        return _tracks_job, (filename, _float(query, "time_step", positive=True), from_time, to_time)
+    if endpoint == "/values":
+        return _values_job, (filename,)
+    if endpoint == "/report":
+        from_time, to_time = _float(query, "from_time"), _float(query, "to_time")
+        if from_time is None or to_time is None or from_time >= to_time:
+            raise RequestError(400, "/report needs from_time < to_time")
+        return _report_job, (filename, from_time, to_time)
+    if endpoint == "/plot":
+        kind = query.get("kind", "formants")
+        if kind not in PLOT_KINDS:
+            raise RequestError(400, f"kind must be one of {', '.join(PLOT_KINDS)}")
+        formant = _float(query, "formant", 0)
+        if formant not in range(5):
+            raise RequestError(400, "formant must be 0-4")
+        return _plot_job, (filename, kind, int(formant))
+    raise RequestError(404, f"no endpoint {endpoint}")
+
+
+class AnalysisService:
+    """
+    Request handling independent of the transport: a process pool, in-flight coalescing and a response cache
+    """
+
+    def __init__(self, processes: int = None, cache_entries: int = 512, cache_bytes: int = 256 * 1024 * 1024,
+                 spool_dir: str = None, spool_bytes: int = SPOOL_BYTES):
+        """
+        :param processes: worker processes, defaults to the number of cores
+        :param cache_entries: most responses kept in memory
+        :param cache_bytes: most bytes of responses kept in memory
+        :param spool_dir: where uploaded WAV files are kept, named by their SHA-256, so repeated uploads hit the
+                            caches; defaults to a temporary directory
+        :param spool_bytes: most bytes of uploads kept in spool_dir
+        """
+        self.processes = processes or os.cpu_count() or 1
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.processes, initializer=_init_worker)
+        self.cache_entries = cache_entries
+        self.cache_bytes = cache_bytes
+        self._responses = collections.OrderedDict()  # key -> (content type, body), least recently used first
+        self._cached_bytes = 0
+        self._in_flight = {}  # key -> asyncio.Future of (content type, body)
+        self._spool = None if spool_dir else tempfile.TemporaryDirectory(prefix="analysis_uploads_")
+        self.spool_dir = spool_dir or self._spool.name
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self.spool_bytes = spool_bytes
+        # spooled file -> size, least recently used first, starting with what an earlier run left behind
+        self._spooled = collections.OrderedDict()
+        for entry in sorted((e for e in os.scandir(self.spool_dir) if e.name.endswith(".wav")),
+                            key=lambda e: e.stat().st_mtime):
+            self._spooled[entry.path] = entry.stat().st_size
+        self._spooled_total = sum(self._spooled.values())
+        self._spool_writes = {}  # spooled file -> asyncio.Future of the write in progress
+        self._spool_readers = collections.Counter()  # spooled file -> requests using it, which keep it on disk
+        self.counts = collections.Counter()
+        self.latencies = collections.deque(maxlen=100000)
+
+    def warm_up(self):
+        """
+        Starts every worker process now rather than on the first requests
+        """
+        for future in [self.pool.submit(os.getpid) for _ in range(self.processes)]:
+            future.result()
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+        if self._spool is not None:
+            self._spool.cleanup()
+
+    def _write_upload(self, filename: str, body: bytes):
+        """
+        Writes an upload through a temporary file of its own and renames it into place; runs off the event loop
+        """
+        fd, temporary = tempfile.mkstemp(dir=self.spool_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(body)
+            os.replace(temporary, filename)
+        except BaseException:
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+            raise
+
+    async def _spool_upload(self, body: bytes) -> str:
+        """
+        Puts an upload in the spool directory, hashing and writing it (up to MAX_BODY bytes) off the event loop.
+        Identical uploads arriving together share one write. The file stays until _release_upload has been called
+        as often as this returned it.
+        :return: its file name there
+        """
+        if body[:4] != b"RIFF" or body[8:12] != b"WAVE":
+            raise RequestError(400, "the request body is not a WAV file")
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(None, lambda: hashlib.sha256(body).hexdigest())
+        filename = os.path.join(self.spool_dir, digest + ".wav")
+        self._spool_readers[filename] += 1
+        try:
+            if filename not in self._spooled:
+                write = self._spool_writes.get(filename)
+                if write is None:
+                    write = self._spool_writes[filename] = loop.run_in_executor(None, self._write_upload, filename,
+                                                                                body)
+                    write.add_done_callback(lambda _: self._spool_writes.pop(filename, None))
+                await asyncio.shield(write)
+                if filename not in self._spooled:
+                    self._spooled[filename] = len(body)
+                    self._spooled_total += len(body)
+            self._spooled.move_to_end(filename)
+        except BaseException:
+            self._release_upload(filename)
+            raise
+        self._evict_uploads()
+        return filename
+
+    def _release_upload(self, filename: str):
+        """
+        Marks a file from _spool_upload as no longer read by a request, so it may be evicted
+        """
+        self._spool_readers[filename] -= 1
+        if self._spool_readers[filename] <= 0:
+            del self._spool_readers[filename]
+        self._evict_uploads()
+
+    def _evict_uploads(self):
+        """
+        Deletes the least recently used uploads no request is reading until the spool fits in spool_bytes
+        """
+        for filename in list(self._spooled):
+            if self._spooled_total <= self.spool_bytes:
+                break
+            if filename in self._spool_readers:
+                continue
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            self._spooled_total -= self._spooled.pop(filename)
+
+    def _remember(self, key, response: tuple[str, bytes]):
+        self._responses[key] = response
+        self._cached_bytes += len(response[1])
+        while self._responses and (len(self._responses) > self.cache_entries or
+                                   self._cached_bytes > self.cache_bytes):
+            _, (_, body) = self._responses.popitem(last=False)
+            self._cached_bytes -= len(body)
+
+    async def _compute(self, key, function, args) -> tuple[str, bytes]:
+        response = self._responses.get(key)
+        if response is not None:
+            self._responses.move_to_end(key)
+            self.counts["cache_hits"] += 1
+            return response
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.counts["coalesced"] += 1
+            return await asyncio.shield(future)
+
+        loop = asyncio.get_running_loop()
+        future = self._in_flight[key] = loop.create_future()
+        try:
+            self.counts["computed"] += 1
+            response = await loop.run_in_executor(self.pool, function, *args)
+            self._remember(key, response)
+            future.set_result(response)
+            return response
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # the waiters, if any, see it; don't warn when there are none
+            raise
+        finally:
+            del self._in_flight[key]
+
+    def stats(self) -> dict:
+        latencies = np.array(self.latencies)
+        summary = {"workers": self.processes, **self.counts, "cached_responses": len(self._responses),
+                   "cached_bytes": self._cached_bytes, "in_flight": len(self._in_flight),
+                   "spooled_uploads": len(self._spooled), "spooled_bytes": self._spooled_total}
+        if len(latencies):
+            summary.update(latency_p50=float(np.percentile(latencies, 50)),
+                           latency_p99=float(np.percentile(latencies, 99)), latency_max=float(latencies.max()))
+        return summary
+
+    async def handle(self, method: str, target: str, body: bytes) -> tuple[int, str, bytes]:
+        """
+        Answers one request
+        :param method: "GET" or "POST"
+        :param target: the path with its query string
+        :param body: the request body, a WAV file or empty
+        :return: (HTTP status, content type, body)
+        """
+        start = time.perf_counter()
+        url = urllib.parse.urlsplit(target)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        self.counts["requests"] += 1
+        upload = None
+        try:
+            if url.path == "/stats":
+                return 200, "application/json", json.dumps(self.stats()).encode("utf8")
+            if method not in ("GET", "POST"):
+                raise RequestError(405, f"{method} is not supported")
+            # the endpoint and parameters are checked before an upload is hashed and written
+            function, args = _job(url.path, None, query)
+            if body:
+                filename = upload = await self._spool_upload(body)
+                identity = os.path.basename(filename)
+            elif "path" in query:
+                filename = os.path.abspath(query["path"])
+                try:
+                    info = os.stat(filename)
+                except OSError:
+                    raise RequestError(404, f"no file {query['path']}")
+                identity = (filename, info.st_size, info.st_mtime_ns)
+            else:
+                raise RequestError(400, "give a path=... parameter or upload a WAV file as the body")
+            args = (filename,) + args[1:]
+            key = (url.path, identity, args[1:])
+            content_type, response = await self._compute(key, function, args)
+            self.latencies.append(time.perf_counter() - start)
+            return 200, content_type, response
+        except RequestError as e:
+            self.counts["errors"] += 1
+            return e.status, "application/json", json.dumps({"error": str(e)}).encode("utf8")
+        except Exception as e:
+            self.counts["errors"] += 1
+            return 500, "application/json", json.dumps({"error": f"{type(e).__name__}: {e}"}).encode("utf8")
+        finally:
+            if upload is not None:
+                self._release_upload(upload)
+
+    async def _connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Serves HTTP/1.1 requests on one connection until the client closes it
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY:
+                    status, content_type, body = 413, "application/json", b'{"error": "upload too large"}'
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    status, content_type, body = await self.handle(method, target, body)
+                    keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                writer.write(f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\nContent-Type: {content_type}\r\n"
+                             f"Content-Length: {len(body)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}"
+                             f"\r\n\r\n".encode("latin-1") + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = DEFAULT_PORT, unix: str = None):
+        """
+        Serves until cancelled, on a TCP port or a Unix socket
+        """
+        if unix:
+            server = await asyncio.start_unix_server(self._connection, path=unix)
+        else:
+            server = await asyncio.start_server(self._connection, host, port)
+        where = unix or ", ".join(f"http://{s.getsockname()[0]}:{s.getsockname()[1]}" for s in server.sockets)
+        print(f"serving on {where} with {self.processes} workers", file=sys.stderr)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if unix and os.path.exists(unix):
+                os.unlink(unix)
+
+
+async def _request(reader, writer, method: str, target: str, body: bytes = b"") -> tuple[int, bytes]:
+    writer.write(f"{method} {target} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n\r\n"
+                 .encode("latin-1") + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while (line := await reader.readline()) not in (b"\r\n", b""):
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    return status, await reader.readexactly(length)
+
+
+async def load_test(url: str, requests: list[tuple[str, str, bytes]], concurrency: int) -> dict:
+    """
+    Sends requests from several keep-alive connections at once and times them
+    :param url: "http://host:port" or "unix:/path/to/socket"
+    :param requests: list of (method, target, body)
+    :param concurrency: number of connections sending at the same time
+    :return: "requests", "errors", "seconds", "throughput" (requests/s) and latency "p50", "p99" and "max"
+    """
+    queue = collections.deque(requests)
+    latencies = []
+    errors = collections.Counter()
+
+    async def client():
+        if url.startswith("unix:"):
+            reader, writer = await asyncio.open_unix_connection(url[5:])
+        else:
+            address = urllib.parse.urlsplit(url)
+            reader, writer = await asyncio.open_connection(address.hostname, address.port or DEFAULT_PORT)
+        try:
+            while queue:
+                method, target, body = queue.popleft()
+                start = time.perf_counter()
+                status, _ = await _request(reader, writer, method, target, body)
+                latencies.append(time.perf_counter() - start)
+                if status != 200:
+                    errors[status] += 1
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+    latencies = np.array(latencies)
+    return {"requests": len(latencies), "errors": dict(errors), "seconds": seconds,
+            "throughput": len(latencies) / seconds, "p50": float(np.percentile(latencies, 50)),
+            "p99": float(np.percentile(latencies, 99)), "max": float(latencies.max())}
+
+
+def mixed_requests(filenames: list[str], n: int, upload: bool = False, seed: int = 0) -> list[tuple[str, str, bytes]]:
+    """
+    :return: n requests for tracks, values, interval reports and plots of the files, in random order, with many
+                repeats as there would be from several tools looking at the same recordings
+    """
+    rng = random.Random(seed)
+    bodies = {}
+    if upload:
+        for filename in filenames:
+            with open(filename, "rb") as f:
+                bodies[filename] = f.read()
+    requests = []
+    for _ in range(n):
+        filename = rng.choice(filenames)
+        source = "" if upload else "path=" + urllib.parse.quote(os.path.abspath(filename)) + "&"
+        endpoint = rng.choice(("/tracks", "/tracks", "/values", "/report", "/report", "/plot"))
+        if endpoint == "/tracks":
+            target = f"/tracks?{source}time_step=0.01"
+        elif endpoint == "/values":
+            target = f"/values?{source}"
+        elif endpoint == "/report":
+            start = rng.choice((0.1, 0.2, 0.3))
+            target = f"/report?{source}from_time={start}&to_time={start + 0.1:.1f}"
+        else:
+            target = f"/plot?{source}kind={rng.choice(('formants', 'spectrogram', 'waveform'))}"
+        requests.append(("POST" if upload else "GET", target.rstrip("&?"), bodies.get(filename, b"")))
+    return requests
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local analysis service, and a load test for it.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="run the service")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=DEFAULT_PORT)
+    serve.add_argument("--unix", default=None, help="listen on this Unix socket instead of a TCP port")
+    serve.add_argument("-j", "--jobs", type=int, default=None, help="worker processes (default: number of cores)")
+    load = commands.add_parser("load", help="measure throughput and latency of a running service")
+    load.add_argument("files", nargs="+", help=".wav files to request analyses of")
+    load.add_argument("--url", default=f"http://127.0.0.1:{DEFAULT_PORT}", help="service URL, or unix:/socket")
+    load.add_argument("-n", "--requests", type=int, default=200)
+    load.add_argument("-c", "--concurrency", type=int, default=8, help="connections sending at once")
+    load.add_argument("--upload", action="store_true", help="upload the files instead of sending their paths")
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        service = AnalysisService(args.jobs)
+        service.warm_up()
+        try:
+            asyncio.run(service.serve(args.host, args.port, args.unix))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            service.close()
+        return 0
+
+    results = asyncio.run(load_test(args.url, mixed_requests(args.files, args.requests, args.upload),
+                                    args.concurrency))
+    print(f"{results['requests']} requests from {args.concurrency} connections in {results['seconds']:.2f} s: "
+          f"{results['throughput']:.1f} requests/s, latency p50 {results['p50'] * 1000:.1f} ms, "
+          f"p99 {results['p99'] * 1000:.1f} ms, max {results['max'] * 1000:.1f} ms")
+    if results["errors"]:
+        print(f"errors by status: {results['errors']}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
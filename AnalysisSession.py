@@ -0,0 +1,343 @@
+##      AnalysisSession.py
+##
+##      Description: runs the independent analyses of one sound (pitch,
+##          formants, intensity, spectrogram) at the same time instead of one
+##          after another. parselmouth holds the GIL while Praat works, so the
+##          analyses go to a pool of worker processes. The samples are written
+##          once to a file on a RAM disk that every worker memory-maps, and
+##          results come back as Praat binary files next to it. The session
+##          removes the file when it is closed; no multiprocessing resource
+##          tracker is involved, so it works the same whichever process started
+##          the pool, and when. Each analysis
+##          returns a concurrent.futures.Future of the parselmouth object
+##          (await it with asyncio.wrap_future), so callers start everything
+##          they need first and wait afterwards: a file then takes about as
+##          long as its slowest analysis.
+##
+##          With one core, inside a daemonic worker process, or with
+##          ANALYSIS_WORKERS=1, the analyses run in the calling process and
+##          the futures are already done when they are returned.
+##
+##      ©2023
+##
+
+import concurrent.futures
+import multiprocessing as mp
+import os
+import tempfile
+import threading
+import uuid
+import parselmouth as pm
+import numpy as np
+from parselmouth.praat import call
+from WavReader import MappedWav
+
+# Sound methods a session can run
+ANALYSES = ("to_pitch", "to_pitch_ac", "to_pitch_cc", "to_formant_burg", "to_intensity", "to_spectrogram")
+# where samples and results are exchanged with the workers; a RAM disk where there is one
+EXCHANGE_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+# the sound a worker loaded last, so analyses of the same sound landing on one worker load it once
+_worker_sound = (None, None)
+
+
+def _init_worker():
+    os.environ["ANALYSIS_WORKERS"] = "1"  # analyses in a worker don't start their own pool
+
+
+def _load_sound(source: tuple) -> pm.Sound:
+    """
+    :param source: ("file", path, size, modification time) of a sound file, ("channel", path, size,
+                    modification time, channel) of one channel of a .wav file, ("praat", path) of a Praat binary
+                    file, or ("samples", path, channels, samples, sampling frequency, start time) of raw float64
+                    samples
+    """
+    global _worker_sound
+    if _worker_sound[0] == source:
+        return _worker_sound[1]
+    if source[0] == "file":
+        sound = pm.Sound(source[1])
+    elif source[0] == "channel":
+        with MappedWav(source[1]) as wav:
+            sound = wav.sound(channel=source[4])
+    elif source[0] == "praat":
+        sound = pm.read(source[1])
+    else:
+        _, path, n_channels, n_samples, sampling_frequency, start_time = source
+        samples = np.memmap(path, dtype=np.float64, mode="r", shape=(n_channels, n_samples))
+        sound = pm.Sound(samples, sampling_frequency=sampling_frequency, start_time=start_time)
+        del samples
+    _worker_sound = (source, sound)
+    return sound
+
+
+def _analyse(source: tuple, method: str, params: dict, out_file: str) -> str:
+    """
+    Runs one analysis in a worker and saves the result as a Praat binary file
+    :return: out_file
+    """
+    result = getattr(_load_sound(source), method)(**params)
+    call(result, "Save as binary file", out_file)
+    return out_file
+
+
+def _apply(source: tuple, function, args: tuple):
+    """
+    Runs function on the sound in a worker
+    """
+    return function(_load_sound(source), *args)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    :return: the process-wide pool that sessions run their analyses in, with ANALYSIS_WORKERS processes (default:
+                the number of cores), or None where the analyses should run in the calling process
+    """
+    global _executor
+    workers = int(os.environ.get("ANALYSIS_WORKERS") or os.cpu_count() or 1)
+    if workers <= 1 or mp.current_process().daemon:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker)
+    return _executor
+
+
+def set_executor(executor):
+    """
+    Replaces the process-wide pool; None runs every session's analyses in the calling process
+    """
+    global _executor
+    _executor = executor
+
+
+def _done(value=None, error: BaseException = None) -> concurrent.futures.Future:
+    future = concurrent.futures.Future()
+    if error is None:
+        future.set_result(value)
+    else:
+        future.set_exception(error)
+    return future
+
+
+class AnalysisSession:
+    """
+    Concurrent analyses of one sound. Use as a context manager, or call close, to free the shared samples.
+    """
+
+    _USE_DEFAULT = object()
+
+    def __init__(self, source, executor=_USE_DEFAULT, channel: int = None):
+        """
+        :param source: path to a sound file, or a parselmouth.Sound
+        :param executor: process pool to run the analyses in, None for the calling process; defaults to
+                            get_executor()
+        :param channel: analyse only this channel (0-based) of a .wav file source, rather than all of them
+        """
+        self.executor = get_executor() if executor is AnalysisSession._USE_DEFAULT else executor
+        self._filename = source if isinstance(source, str) else None
+        self._sound = None if isinstance(source, str) else source
+        self.channel = channel
+        self._source = None
+        self._shared_file = None
+        self._futures = {}
+        self._applied = []
+        self._threads = None
+        # background threads submit too; held while the sound, its shared copy or an analysis is being set up
+        self._lock = threading.RLock()
+
+    def sound(self) -> pm.Sound:
+        """
+        :return: the sound, loaded in this process
+        """
+        with self._lock:
+            if self._sound is None and self.channel is not None:
+                with MappedWav(self._filename) as wav:
+                    self._sound = wav.sound(channel=self.channel)
+            elif self._sound is None:
+                self._sound = pm.Sound(self._filename)
+            return self._sound
+
+    def _share(self) -> tuple:
+        """
+        :return: the description of the sound the workers load it from, see _load_sound
+        """
+        with self._lock:
+            if self._source is not None:
+                return self._source
+            if self._filename is not None:
+                # workers read the file themselves; the operating system shares its pages between them
+                info = os.stat(self._filename)
+                self._source = ("file", os.path.abspath(self._filename), info.st_size, info.st_mtime_ns)
+                if self.channel is not None:
+                    # each worker maps the file and converts only this channel's samples
+                    self._source = ("channel",) + self._source[1:] + (self.channel,)
+                return self._source
+            sound = self._sound
+            if sound.x1 == sound.xmin + 0.5 * sound.dx and sound.xmax == sound.xmin + sound.nx * sound.dx:
+                samples = sound.values
+                self._shared_file = os.path.join(EXCHANGE_DIR, f"analysis_session_{uuid.uuid4().hex}.f64")
+                np.ascontiguousarray(samples, dtype=np.float64).tofile(self._shared_file)
+                self._source = ("samples", self._shared_file, samples.shape[0], samples.shape[1],
+                                sound.sampling_frequency, sound.xmin)
+            else:
+                # the sample grid isn't the one pm.Sound(values, ...) makes (e.g. after extract_part), which the
+                # analyses depend on; Praat's own format keeps it exactly
+                self._shared_file = os.path.join(EXCHANGE_DIR, f"analysis_session_{uuid.uuid4().hex}.Sound")
+                call(sound, "Save as binary file", self._shared_file)
+                self._source = ("praat", self._shared_file)
+            return self._source
+
+    def submit(self, method: str, **params) -> concurrent.futures.Future:
+        """
+        Starts an analysis; asking for the same analysis again returns the same future
+        :param method: one of ANALYSES, e.g. "to_formant_burg"
+        :param params: its keyword arguments
+        :return: a Future of the parselmouth object the method returns
+        """
+        if method not in ANALYSES:
+            raise ValueError(f"unknown analysis '{method}', expected one of {', '.join(ANALYSES)}")
+        key = (method, tuple(sorted(params.items())))
+        with self._lock:
+            if key in self._futures:
+                return self._futures[key]
+            if self.executor is None:
+                try:
+                    future = _done(getattr(self.sound(), method)(**params))
+                except Exception as e:
+                    future = _done(error=e)
+            else:
+                out_file = os.path.join(EXCHANGE_DIR, f"analysis_result_{uuid.uuid4().hex}")
+                worker = self.executor.submit(_analyse, self._share(), method, params, out_file)
+                future = concurrent.futures.Future()
+                worker.add_done_callback(lambda done: self._collect(done, future, out_file))
+            self._futures[key] = future
+            return future
+
+    @staticmethod
+    def _collect(worker: concurrent.futures.Future, future: concurrent.futures.Future, out_file: str):
+        # the result file is gone before the future is done, so nothing is left once close has waited for it
+        try:
+            worker.result()
+            result = pm.read(out_file)
+        except BaseException as e:
+            result, error = None, e
+        else:
+            error = None
+        finally:
+            if os.path.exists(out_file):
+                os.remove(out_file)
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+    def pitch(self, **params) -> concurrent.futures.Future:
+        return self.submit("to_pitch", **params)
+
+    def pitch_ac(self, **params) -> concurrent.futures.Future:
+        return self.submit("to_pitch_ac", **params)
+
+    def formants(self, **params) -> concurrent.futures.Future:
+        return self.submit("to_formant_burg", **params)
+
+    def intensity(self, **params) -> concurrent.futures.Future:
+        return self.submit("to_intensity", **params)
+
+    def spectrogram(self, **params) -> concurrent.futures.Future:
+        return self.submit("to_spectrogram", **params)
+
+    def apply(self, function, *args) -> concurrent.futures.Future:
+        """
+        Runs function(sound, *args) where the analyses run, for work that only needs to send back something
+        smaller than the parselmouth objects it makes, e.g. statistics of a track
+        :param function: a module-level function, so workers can find it by name
+        :return: a Future of its result
+        """
+        if self.executor is None:
+            try:
+                future = _done(function(self.sound(), *args))
+            except Exception as e:
+                future = _done(error=e)
+        else:
+            future = self.executor.submit(_apply, self._share(), function, args)
+        with self._lock:
+            self._applied.append(future)
+        return future
+
+    def background(self, function, *args, **kwargs) -> concurrent.futures.Future:
+        """
+        Runs function in a thread of this session, e.g. a cached loader that waits on this session's analyses
+        while the calling thread starts others
+        :return: a Future of its result
+        """
+        if self.executor is None:
+            try:
+                return _done(function(*args, **kwargs))
+            except Exception as e:
+                return _done(error=e)
+        with self._lock:
+            if self._threads is None:
+                self._threads = concurrent.futures.ThreadPoolExecutor(2, thread_name_prefix="analysis_session")
+            return self._threads.submit(function, *args, **kwargs)
+
+    def close(self):
+        """
+        Waits for the background threads, then for every analysis (including those the threads started), and
+        frees the shared samples
+        """
+        with self._lock:
+            threads, self._threads = self._threads, None
+        if threads is not None:
+            threads.shutdown()
+        with self._lock:
+            running = list(self._futures.values()) + self._applied
+            self._applied = []
+        concurrent.futures.wait(running)
+        with self._lock:
+            if self._shared_file is not None and os.path.exists(self._shared_file):
+                os.remove(self._shared_file)
+            self._shared_file = None
+            self._source = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def main():
+    import time
+
+    inFile = "One Small Step.wav"
+    settings = [("to_spectrogram", dict(window_length=0.032169, time_step=0.001)),
+                ("to_intensity", dict(time_step=0.001)),
+                ("to_formant_burg", dict(time_step=0.001, window_length=0.032169)),
+                ("to_pitch", dict(time_step=0.001019))]
+
+    start = time.perf_counter()
+    snd = pm.Sound(inFile)
+    for method, params in settings:
+        single = time.perf_counter()
+        getattr(snd, method)(**params)
+        print(f"{method}: {time.perf_counter() - single:.2f} s")
+    print(f"one after another: {time.perf_counter() - start:.2f} s")
+
+    get_executor()  # start the pool before timing
+    start = time.perf_counter()
+    with AnalysisSession(inFile) as session:
+        futures = [session.submit(method, **params) for method, params in settings]
+        for future in futures:
+            future.result()
+    print(f"in a session with {os.environ.get('ANALYSIS_WORKERS') or os.cpu_count()} workers: "
+          f"{time.perf_counter() - start:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+##      BatchRunner.py
+##
+##      Description: headless batch mode for the Assignment_2 pipeline. Runs
+##          the first_part_separate formant plots and the second_part interval
+##          reports for every WAV file in a directory or manifest, one file per
+##          worker process, without Tk and with the non-interactive Agg
+##          matplotlib backend. The waveform, spectrogram and formant/intensity
+##          plots from ExtractValues can be rendered too. Each worker reuses
+##          its figures from file to file. Outputs are named after each
+##          recording so files never overwrite each other.
+##
+##          usage: python BatchRunner.py <directory or manifest> [-o OUT_DIR] [-j JOBS]
+##                                       [--interval FROM TO ...] [--plots KIND ...] [--no-plots]
+##                                       [--store STORE_DIR]
+##
+##          A manifest is a CSV file with one row per interval:
+##              file, from_time, to_time[, label]
+##          or just "file" to plot a recording without reporting on any interval.
+##          Relative file paths are relative to the manifest. Lines starting
+##          with # are ignored.
+##
+##      ©2023
+##
+
+import argparse
+import csv
+import multiprocessing as mp
+import os
+import sys
+import time
+
+import matplotlib
+
+matplotlib.use("Agg")  # must happen before Assignment_2 imports pyplot
+
+from Assignment_2 import first_part_separate, interval_report
+from ExtractValues import loadSpectrogramBand, loadCleanFrames
+from Rendering import get_renderer
+from TrackStore import TrackStore
+from Profiling import stage
+from WavReader import MappedWav
+
+# formants: the first_part_separate plots, one per formant
+# waveform, spectrogram, values: the ExtractValues plotWaveform, plotSpectrogram and plotValues plots
+PLOT_KINDS = ("formants", "waveform", "spectrogram", "values")
+
+
+##  find_jobs
+##  pre:
+##          source is a directory of .wav files or a manifest file
+##          intervals is a list of (from_time, to_time) pairs applied to every file found in a directory
+##  Post:
+##          returns - list of (filename, [(from_time, to_time, label), ...]) in the order found,
+##                    one entry per file
+##
+def find_jobs(source, intervals=()):
+    jobs = {}
+    if os.path.isdir(source):
+        for folder, _, files in os.walk(source):
+            for name in sorted(files):
+                if name.lower().endswith(".wav"):
+                    jobs[os.path.join(folder, name)] = [(start, end, "") for start, end in intervals]
+        return list(jobs.items())
+
+    root = os.path.dirname(os.path.abspath(source))
+    with open(source, newline="", encoding="utf8") as f:
+        rows = csv.reader(line for line in f if line.strip() and not line.lstrip().startswith("#"))
+        for row in rows:
+            row = [cell.strip() for cell in row]
+            filename = row[0] if os.path.isabs(row[0]) else os.path.join(root, row[0])
+            file_intervals = jobs.setdefault(filename, [])
+            if len(row) >= 3:
+                file_intervals.append((float(row[1]), float(row[2]), row[3] if len(row) > 3 else ""))
+    return list(jobs.items())
+
+
+##  output_prefix
+##  pre:
+##          filename is one of the files found by find_jobs under source
+##  Post:
+##          returns - "<out_dir>/<name>_" where name is the file's path relative to source without the
+##                    extension, with directory separators replaced, so every recording gets unique names
+##
+def output_prefix(filename, source, out_dir):
+    root = source if os.path.isdir(source) else os.path.dirname(os.path.abspath(source))
+    name = os.path.splitext(os.path.relpath(os.path.abspath(filename), os.path.abspath(root)))[0]
+    name = name.replace(os.sep, "__").replace("/", "__").replace("..", "up")
+    return os.path.join(out_dir, name + "_")
+
+
+##  render_plots
+##  pre:
+##          kinds is a collection of names from PLOT_KINDS
+##  Post:
+##          the chosen plots of filename are saved as "<prefix>..." images
+##          returns - list of the written files
+##
+def render_plots(filename, prefix, kinds):
+    written = []
+    renderer = get_renderer()
+    if "formants" in kinds:
+        written += first_part_separate(filename, out_prefix=prefix)
+    if "waveform" in kinds:
+        with MappedWav(filename) as wav:
+            written.append(renderer.waveform(wav.times(), wav.read(), prefix + "waveform.png", xlim=(0, wav.duration)))
+    if "spectrogram" in kinds or "values" in kinds:
+        sg = loadSpectrogramBand(filename)
+        if "spectrogram" in kinds:
+            written.append(renderer.spectrogram(sg, prefix + "spectrogram.png"))
+        if "values" in kinds:
+            written.append(renderer.values(loadCleanFrames(filename), sg, prefix + "formants.png"))
+    return written
+
+
+##  run_file
+##  pre:
+##          job is (filename, intervals, prefix, plots, store), plots a collection of names from PLOT_KINDS,
+##          store a TrackStore directory or None
+##  Post:
+##          the plots and "<prefix>report.txt" (if there are intervals) are written, and the frame table
+##          is added to the store unless it is already there
+##          returns - (filename, list of written files, seconds taken, error message or None)
+##
+def run_file(job):
+    filename, intervals, prefix, plots, store = job
+    start = time.perf_counter()
+    written = []
+    try:
+        with stage("run_file", filename=filename):
+            if plots:
+                written += render_plots(filename, prefix, plots)
+            if intervals:
+                reports = []
+                for from_time, to_time, label in intervals:
+                    report = interval_report(filename, from_time, to_time)
+                    reports.append(f"{label}\n{report}" if label else report)
+                with open(prefix + "report.txt", "w", encoding="utf8") as f:
+                    f.write("\n".join(reports))
+                written.append(prefix + "report.txt")
+            if store:
+                TrackStore(store).add_recording(filename)
+    except Exception as e:
+        return filename, written, time.perf_counter() - start, f"{type(e).__name__}: {e}"
+    return filename, written, time.perf_counter() - start, None
+
+
+##  run_batch
+##  pre:
+##          jobs is a list from find_jobs
+##          processes is the number of worker processes, defaults to the number of cores; 1 runs in this process
+##          plots is a collection of names from PLOT_KINDS, empty for reports only
+##          store is a TrackStore directory to save every file's frame table in, or None
+##  Post:
+##          outputs for every file are written under out_dir
+##          yields - run_file results as files finish
+##
+def run_batch(jobs, source, out_dir, processes=None, plots=("formants",), store=None):
+    os.makedirs(out_dir, exist_ok=True)
+    work = [(filename, intervals, output_prefix(filename, source, out_dir), plots, store)
+            for filename, intervals in jobs]
+    # longest recordings first so no worker is left with a big file at the end
+    work.sort(key=lambda job: os.path.getsize(job[0]) if os.path.isfile(job[0]) else 0, reverse=True)
+    processes = processes or os.cpu_count() or 1
+    if processes == 1 or len(work) <= 1:
+        yield from map(run_file, work)
+        return
+    with mp.Pool(min(processes, len(work))) as pool:
+        yield from pool.imap_unordered(run_file, work, chunksize=1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the formant plots and interval reports over many WAV files.")
+    parser.add_argument("source", help="directory of .wav files or a CSV manifest")
+    parser.add_argument("-o", "--out-dir", default="batch_output", help="directory for the plots and reports")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes (default: number of cores)")
+    parser.add_argument("--interval", nargs=2, type=float, action="append", default=[], metavar=("FROM", "TO"),
+                        help="interval to report on for every file in a directory, may be repeated")
+    parser.add_argument("--plots", nargs="+", choices=PLOT_KINDS, default=["formants"],
+                        help="plots to render for every file (default: formants)")
+    parser.add_argument("--no-plots", action="store_true", help="only write the interval reports")
+    parser.add_argument("--store", default=None, help="TrackStore directory to save the frame tables in")
+    args = parser.parse_args(argv)
+
+    jobs = find_jobs(args.source, args.interval)
+    if not jobs:
+        print(f"no .wav files found in {args.source}", file=sys.stderr)
+        return 1
+
+    start = time.perf_counter()
+    failed = 0
+    figures = 0
+    plots = () if args.no_plots else tuple(args.plots)
+    for filename, written, seconds, error in run_batch(jobs, args.source, args.out_dir, args.jobs, plots=plots,
+                                                        store=args.store):
+        figures += sum(name.endswith(".png") for name in written)
+        if error:
+            failed += 1
+            print(f"FAILED {filename}: {error}", file=sys.stderr)
+        else:
+            print(f"{filename}: {len(written)} files in {seconds:.2f} s")
+    elapsed = time.perf_counter() - start
+    print(f"{len(jobs) - failed}/{len(jobs)} files in {elapsed:.2f} s ({len(jobs) / elapsed:.2f} files/s, "
+          f"{figures / elapsed:.2f} figures/s)")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,381 @@
+##      Benchmarks.py
+##
+##      Description: timing harness for the analysis and plotting stages.
+##          Every stage (loading, each parselmouth analysis, value
+##          extraction, differences, smoothing, rendering) is timed on the
+##          bundled recordings and on longer synthetic recordings made by
+##          repeating one of them, at several analysis time steps. Results are
+##          written as JSON and can be compared against a stored baseline;
+##          any stage that got slower than the tolerance fails the run.
+##
+##          --imports instead checks what worker processes pay at start-up:
+##          each module in IMPORT_BUDGETS_MS is imported in a fresh
+##          interpreter under python -X importtime, and the run fails if one
+##          takes longer than its budget or pulls in a plotting or GUI module.
+##
+##          usage: python Benchmarks.py [-o RESULTS] [--baseline BASELINE] [--update-baseline]
+##                                      [--stages STAGE ...] [--time-steps STEP ...] [--lengths SECONDS ...]
+##                                      [--repeats N] [--tolerance FRACTION] [--quick]
+##                 python Benchmarks.py --imports [--repeats N]
+##
+##      ©2023
+##
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import matplotlib
+
+matplotlib.use("Agg")  # must happen before the plotting modules import pyplot
+
+import parselmouth as pm
+import numpy as np
+from AnalysisCore import get_formants, get_formant_differences, clean_formants
+from MovingAverages import middleAvg, movingMedian
+from Rendering import FigureRenderer
+from WavReader import MappedWav
+
+BENCHMARK_FORMAT_VERSION = 1
+BUNDLED_WAVS = ("Thats.wav", "Thats One Small.wav", "One Small Step.wav")
+# recording repeated to make the synthetic long inputs
+SYNTHETIC_SOURCE = "One Small Step.wav"
+DEFAULT_TIME_STEPS = (0.001, 0.005, 0.01)
+DEFAULT_LENGTHS = (30.0, 120.0)
+DEFAULT_TOLERANCE = 0.25
+# slowdowns smaller than this many seconds per call are timer noise, not regressions (fast calls are looped)
+MIN_REGRESSION_SECONDS = 1e-5
+# cumulative -X importtime of the modules worker processes import, in ms; numpy and parselmouth alone take about
+# 190 ms on the reference machine (1 core, Python 3.11), AnalysisCore about 240 ms
+IMPORT_BUDGETS_MS = {"AnalysisCore": 400, "Assignment_2": 450, "ExtractValues": 450, "IntervalReports": 400}
+# top-level packages none of those modules may import
+FORBIDDEN_IMPORTS = ("matplotlib", "tkinter", "_tkinter", "PIL")
+
+
+class Input:
+    """
+    One recording at one time step, with the analysis objects the later stages need made on first use
+    """
+
+    def __init__(self, filename: str, time_step: float, out_dir: str):
+        self.filename = filename
+        self.time_step = time_step
+        self.out_dir = out_dir
+        self._cache = {}
+
+    def _get(self, name, make):
+        if name not in self._cache:
+            self._cache[name] = make()
+        return self._cache[name]
+
+    @property
+    def sound(self) -> pm.Sound:
+        return self._get("sound", lambda: pm.Sound(self.filename))
+
+    @property
+    def pitch(self) -> pm.Pitch:
+        return self._get("pitch", lambda: self.sound.to_pitch_ac(time_step=self.time_step, pitch_ceiling=300))
+
+    @property
+    def formants(self) -> pm.Formant:
+        return self._get("formants", lambda: self.sound.to_formant_burg(time_step=self.time_step))
+
+    @property
+    def intensity(self) -> pm.Intensity:
+        return self._get("intensity", lambda: self.sound.to_intensity(time_step=self.time_step))
+
+    @property
+    def spectrogram(self) -> pm.Spectrogram:
+        return self._get("spectrogram", lambda: self.sound.to_spectrogram(window_length=0.032169,
+                                                                          time_step=self.time_step))
+
+    @property
+    def values(self) -> list:
+        return self._get("values", lambda: get_formants(self.pitch, self.formants, self.intensity))
+
+    @property
+    def diffs(self) -> list:
+        return self._get("diffs", lambda: get_formant_differences(self.values))
+
+    @property
+    def renderer(self) -> FigureRenderer:
+        return self._get("renderer", FigureRenderer)
+
+    @property
+    def duration(self) -> float:
+        def read_duration():
+            with MappedWav(self.filename) as wav:
+                return wav.duration
+        return self._get("duration", read_duration)
+
+    @property
+    def frames(self) -> int:
+        return int(self.duration / self.time_step)
+
+
+def _load_interval(filename: str, from_time: float, length: float):
+    """
+    :return: a call that reads one short interval of the file the way second_part does
+    """
+    def call():
+        with MappedWav(filename) as wav:
+            return wav.extract_part(from_time, from_time + length)
+    return call
+
+
+# stage name -> (function taking an Input and returning the call to time, limits on the inputs it is run on)
+# the setup outside the returned call is not timed; limits are the most "frames" and/or "seconds" of audio
+STAGES = {
+    "load": (lambda inp: lambda: pm.Sound(inp.filename), {}),
+    "load_interval": (lambda inp: _load_interval(inp.filename, 0.4 * inp.duration, 0.13), {}),
+    "to_pitch": (lambda inp: lambda: inp.sound.to_pitch(time_step=inp.time_step), {}),
+    "to_pitch_ac": (lambda inp: lambda: inp.sound.to_pitch_ac(time_step=inp.time_step, pitch_ceiling=300), {}),
+    # SPINET takes seconds per second of audio
+    "to_pitch_spinet": (lambda inp: lambda: inp.sound.to_pitch_spinet(time_step=inp.time_step), {"seconds": 7}),
+    "to_formant_burg": (lambda inp: lambda: inp.sound.to_formant_burg(time_step=inp.time_step), {}),
+    "to_intensity": (lambda inp: lambda: inp.sound.to_intensity(time_step=inp.time_step), {}),
+    "to_spectrogram": (lambda inp: lambda: inp.sound.to_spectrogram(window_length=0.032169,
+                                                                    time_step=inp.time_step), {"frames": 30000}),
+    "get_formants": (lambda inp: lambda: get_formants(inp.pitch, inp.formants, inp.intensity), {}),
+    "clean_formants": (lambda inp: lambda: clean_formants(inp.pitch, inp.formants, inp.intensity), {}),
+    "get_formant_differences": (lambda inp: lambda: get_formant_differences(inp.values), {}),
+    "middleAvg": (lambda inp: lambda: middleAvg(inp.values[1][1], 5), {}),
+    "movingMedian": (lambda inp: lambda: movingMedian(np.array([v for _, v in inp.values[1:]]), 5), {}),
+    "render_formant_plots": (lambda inp: lambda: inp.renderer.formant_plots(
+        inp.values, inp.diffs, os.path.join(inp.out_dir, "bench_")), {"frames": 200000}),
+    "render_spectrogram": (lambda inp: lambda: inp.renderer.spectrogram(
+        inp.spectrogram, os.path.join(inp.out_dir, "bench_spectrogram.png")), {"frames": 30000}),
+}
+
+
+def measure(call, repeats: int = 3, min_time: float = 0.05) -> dict:
+    """
+    Times a call. Fast calls are run in loops long enough to time reliably.
+    :param call: function taking no arguments
+    :param repeats: number of timed repeats
+    :param min_time: shortest time in seconds a repeat should take
+    :return: dict of "min" and "median" seconds per call, and the "loops" per repeat
+    """
+    start = time.perf_counter()
+    call()  # warm-up, also tells how many loops are needed
+    first = time.perf_counter() - start
+    loops = 1 if first >= min_time else min(1000, int(min_time / max(first, 1e-6)) + 1)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(loops):
+            call()
+        times.append((time.perf_counter() - start) / loops)
+    return {"min": min(times), "median": statistics.median(times), "loops": loops}
+
+
+def make_synthetic(length: float, out_dir: str) -> str:
+    """
+    :param length: duration in seconds
+    :return: path of a .wav file of SYNTHETIC_SOURCE repeated to that length
+    """
+    source = pm.Sound(SYNTHETIC_SOURCE)
+    n = int(round(length * source.sampling_frequency))
+    repeats = -(-n // source.n_samples)
+    samples = np.tile(source.values, repeats)[:, :n]
+    filename = os.path.join(out_dir, f"synthetic_{length:g}s.wav")
+    pm.Sound(samples, sampling_frequency=source.sampling_frequency).save(filename, "WAV")
+    return filename
+
+
+def measure_import(module: str, repeats: int = 3) -> dict:
+    """
+    Imports a module in fresh interpreters with -X importtime
+    :param module: module name, importable from this directory
+    :param repeats: interpreters to start; the fastest is kept
+    :return: dict of module, ms (cumulative import time), slowest (the three slowest imports it caused, as
+                (name, ms) pairs) and forbidden (the FORBIDDEN_IMPORTS it loaded)
+    """
+    best = None
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stderr
+        times = {}
+        for line in output.splitlines():
+            if line.startswith("import time:") and "|" in line:
+                _, cumulative, name = line[len("import time:"):].split("|")
+                if cumulative.strip().isdigit():
+                    times[name.strip()] = int(cumulative) / 1000
+        if best is None or times[module] < best[module]:
+            best = times
+    loaded = {name.split(".")[0] for name in best}
+    slowest = sorted(((name, ms) for name, ms in best.items() if "." not in name and name != module),
+                     key=lambda item: -item[1])[:3]
+    return {"module": module, "ms": best[module], "slowest": slowest,
+            "forbidden": sorted(loaded & set(FORBIDDEN_IMPORTS))}
+
+
+def check_imports(budgets: dict = None, repeats: int = 3) -> int:
+    """
+    Prints the import time of each module against its budget
+    :param budgets: dict of module name -> budget in ms, defaults to IMPORT_BUDGETS_MS
+    :return: the number of modules over budget or importing a FORBIDDEN_IMPORTS package
+    """
+    failures = 0
+    for module, budget in (budgets or IMPORT_BUDGETS_MS).items():
+        result = measure_import(module, repeats)
+        problems = []
+        if result["ms"] > budget:
+            problems.append(f"over the {budget} ms budget")
+        if result["forbidden"]:
+            problems.append(f"imports {', '.join(result['forbidden'])}")
+        failures += bool(problems)
+        slowest = ", ".join(f"{name} {ms:.0f} ms" for name, ms in result["slowest"])
+        print(f"{module:<18}{result['ms']:7.1f} ms / {budget} ms  ({slowest})  {'; '.join(problems).upper()}")
+    return failures
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+def run_benchmarks(stages=None, time_steps=DEFAULT_TIME_STEPS, lengths=DEFAULT_LENGTHS, repeats: int = 3,
+                   progress=None) -> dict:
+    """
+    :param stages: names from STAGES, defaults to all of them
+    :param time_steps: analysis time steps in seconds
+    :param lengths: durations of the synthetic inputs in seconds
+    :param repeats: timed repeats per measurement
+    :param progress: optional function called with each result as it is measured
+    :return: dict with "meta" (versions, machine, commit) and "results", a list of dicts of stage, input,
+                duration, time_step, min, median, loops, or skipped
+    """
+    stages = stages or list(STAGES)
+    results = []
+    with tempfile.TemporaryDirectory() as out_dir:
+        inputs = [name for name in BUNDLED_WAVS if os.path.isfile(name)]
+        inputs += [make_synthetic(length, out_dir) for length in lengths]
+        for filename in inputs:
+            for time_step in time_steps:
+                inp = Input(filename, time_step, out_dir)
+                for stage in stages:
+                    make_call, limits = STAGES[stage]
+                    result = {"stage": stage, "input": os.path.basename(filename),
+                              "duration": round(inp.duration, 3), "time_step": time_step}
+                    if inp.frames > limits.get("frames", inp.frames):
+                        result["skipped"] = f"more than {limits['frames']} frames"
+                    elif inp.duration > limits.get("seconds", inp.duration):
+                        result["skipped"] = f"longer than {limits['seconds']} s"
+                    else:
+                        result.update(measure(make_call(inp), repeats))
+                    results.append(result)
+                    if progress:
+                        progress(result)
+    meta = {
+        "format": BENCHMARK_FORMAT_VERSION,
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "parselmouth": pm.VERSION,
+        "praat": pm.PRAAT_VERSION,
+        "matplotlib": matplotlib.__version__,
+        "machine": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+    return {"meta": meta, "results": results}
+
+
+def _key(result: dict) -> tuple:
+    return result["stage"], result["input"], result["time_step"]
+
+
+def compare(results: dict, baseline: dict, tolerance: float = DEFAULT_TOLERANCE) -> list[dict]:
+    """
+    :param results: from run_benchmarks
+    :param baseline: an earlier run_benchmarks result
+    :param tolerance: allowed slowdown as a fraction of the baseline time
+    :return: one dict per measurement found in both: stage, input, time_step, baseline and current min times,
+                ratio, and regression (True if slower than the tolerance allows)
+    """
+    old = {_key(r): r for r in baseline["results"] if "min" in r}
+    rows = []
+    for result in results["results"]:
+        before = old.get(_key(result))
+        if before is None or "min" not in result:
+            continue
+        ratio = result["min"] / before["min"] if before["min"] > 0 else float("inf")
+        regression = (result["min"] > before["min"] * (1 + tolerance)
+                      and result["min"] - before["min"] > MIN_REGRESSION_SECONDS)
+        rows.append({"stage": result["stage"], "input": result["input"], "time_step": result["time_step"],
+                     "baseline": before["min"], "current": result["min"], "ratio": ratio,
+                     "regression": regression})
+    return rows
+
+
+def _format_seconds(seconds: float) -> str:
+    return f"{seconds * 1000:9.2f} ms" if seconds < 1 else f"{seconds:9.3f} s "
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time every analysis and plotting stage.")
+    parser.add_argument("-o", "--output", default="benchmark_results.json", help="where to write the results")
+    parser.add_argument("--baseline", default=None, help="earlier results to compare against")
+    parser.add_argument("--update-baseline", action="store_true", help="write these results to --baseline")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=None)
+    parser.add_argument("--time-steps", nargs="+", type=float, default=list(DEFAULT_TIME_STEPS))
+    parser.add_argument("--lengths", nargs="*", type=float, default=list(DEFAULT_LENGTHS),
+                        help="durations of the synthetic inputs in seconds")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed slowdown against the baseline as a fraction (default: 0.25)")
+    parser.add_argument("--quick", action="store_true", help="one time step, one 10 s synthetic input")
+    parser.add_argument("--imports", action="store_true",
+                        help="only check the import time of the worker-side modules against IMPORT_BUDGETS_MS")
+    args = parser.parse_args(argv)
+    if args.imports:
+        return 1 if check_imports(repeats=args.repeats) else 0
+    if args.quick:
+        args.time_steps, args.lengths = [0.01], [10.0]
+
+    def progress(result):
+        timing = result.get("skipped") or f"{_format_seconds(result['min'])} (x{result['loops']})"
+        print(f"{result['stage']:<24}{result['input']:<24}{result['time_step']:<8g}{timing}")
+
+    results = run_benchmarks(args.stages, args.time_steps, args.lengths, args.repeats, progress)
+    with open(args.output, "w", encoding="utf8") as f:
+        json.dump(results, f, indent=1)
+    print(f"results written to {args.output}")
+
+    if not args.baseline:
+        return 0
+    if args.update_baseline or not os.path.isfile(args.baseline):
+        with open(args.baseline, "w", encoding="utf8") as f:
+            json.dump(results, f, indent=1)
+        print(f"baseline written to {args.baseline}")
+        return 0
+    with open(args.baseline, encoding="utf8") as f:
+        baseline = json.load(f)
+    rows = compare(results, baseline, args.tolerance)
+    regressions = [row for row in rows if row["regression"]]
+    print(f"\ncompared with {args.baseline} (commit {baseline['meta'].get('commit') or '?'}):")
+    for row in rows:
+        flag = "REGRESSION" if row["regression"] else ""
+        print(f"{row['stage']:<24}{row['input']:<24}{row['time_step']:<8g}{_format_seconds(row['baseline'])} -> "
+              f"{_format_seconds(row['current'])} x{row['ratio']:.2f} {flag}")
+    if regressions:
+        print(f"\n{len(regressions)} of {len(rows)} measurements are more than {args.tolerance:.0%} slower "
+              f"than the baseline", file=sys.stderr)
+        return 1
+    print(f"\nno regressions in {len(rows)} measurements")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+##      ChannelAnalysis.py
+##
+##      Description: pitch, F1-F4 and intensity for each channel of a
+##          multichannel recording on its own. pm.Sound(filename).to_pitch,
+##          to_formant_burg and to_intensity combine the channels of a stereo
+##          or array recording into one track, and the rest of the project
+##          reads only those combined tracks. Here every channel gets its own
+##          AnalysisSession: the workers memory-map the .wav file and convert
+##          only their channel's samples, and the analyses of all channels are
+##          started before any is waited for. Each channel's tracks are
+##          aligned with TimeGrid.align_tracks and cached under their own
+##          entry, so asking for one more channel analyses only that one. The
+##          result is a channels x tracks x frames array on one time grid
+##          shared by every channel.
+##
+##          usage: python ChannelAnalysis.py <sound.wav> [--channels CHANNEL ...]
+##
+##      ©2023
+##
+
+import argparse
+import sys
+import time
+import numpy as np
+from AnalysisCache import get_cache
+from AnalysisSession import AnalysisSession
+from IntervalReports import DEFAULT_SETTINGS
+from TimeGrid import TimeGrid, TRACK_NAMES, align_tracks
+from WavReader import MappedWav
+
+
+def _channel_arrays(filename: str, channel: int, session: AnalysisSession, settings: dict) -> dict:
+    """
+    :return: {"times", "values"} of one channel, values a 6 x n array with rows in TRACK_NAMES order, from the
+                analysis cache if it was analysed before
+    """
+    def compute():
+        pitch = session.pitch(time_step=settings["pitch_time_step"], pitch_floor=settings["pitch_floor"],
+                              pitch_ceiling=settings["pitch_ceiling"])
+        formants = session.formants(time_step=settings["formant_time_step"],
+                                    max_number_of_formants=settings["max_number_of_formants"],
+                                    maximum_formant=settings["maximum_formant"],
+                                    window_length=settings["window_length"],
+                                    pre_emphasis_from=settings["pre_emphasis_from"])
+        intensity = session.intensity(minimum_pitch=settings["minimum_pitch"],
+                                      time_step=settings["intensity_time_step"])
+        grid, values, _ = align_tracks(pitch.result(), formants.result(), intensity.result())
+        return {"times": grid.times, "values": values}
+
+    return get_cache().fetch(filename, "channel_tracks", compute, channel=channel, **settings)
+
+
+def analyse_channels(filename: str, channels=None, executor=AnalysisSession._USE_DEFAULT,
+                     **settings) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Analyses every channel separately and at the same time
+    :param filename: path to a .wav file
+    :param channels: channel numbers (0-based) to analyse, defaults to all of them
+    :param executor: process pool for the analyses, None for this process; defaults to the AnalysisSession pool
+    :param settings: overrides for IntervalReports.DEFAULT_SETTINGS
+    :return: (times, values) where values is a channels x 6 x n array, the second axis in TimeGrid.TRACK_NAMES
+                order, NaN where undefined
+    """
+    settings = {**DEFAULT_SETTINGS, **settings}
+    with MappedWav(filename) as wav:
+        n_channels = wav.n_channels
+    channels = list(range(n_channels)) if channels is None else [int(channel) for channel in channels]
+    for channel in channels:
+        if not 0 <= channel < n_channels:
+            raise ValueError(f"channel {channel} does not exist, {filename} has {n_channels} channels")
+
+    sessions = [AnalysisSession(filename, executor, channel=channel) for channel in channels]
+    try:
+        # every channel's analyses are submitted from its own thread, so all of them are running before any
+        # channel is waited for
+        loads = [session.background(_channel_arrays, filename, channel, session, settings)
+                 for channel, session in zip(channels, sessions)]
+        arrays = [load.result() for load in loads]
+    finally:
+        for session in sessions:
+            session.close()
+
+    times = arrays[0]["times"]
+    values = np.empty((len(channels), len(TRACK_NAMES), len(times)))
+    for i, channel_arrays in enumerate(arrays):
+        if len(channel_arrays["times"]) == len(times) and np.allclose(channel_arrays["times"], times):
+            values[i] = channel_arrays["values"]
+        else:
+            # channels of one file share their frame grid; this only guards against entries from older settings
+            grid = TimeGrid(times[0], times[1] - times[0] if len(times) > 1 else 1.0, len(times))
+            values[i] = grid.stack((channel_arrays["times"], row) for row in channel_arrays["values"])
+    return times, values
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyse pitch, formants and intensity of each channel of a "
+                                                 "multichannel .wav file separately.")
+    parser.add_argument("sound", help=".wav file")
+    parser.add_argument("--channels", nargs="+", type=int, default=None,
+                        help="channels to analyse, counting from 0 (default: all)")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    times, values = analyse_channels(args.sound, args.channels)
+    elapsed = time.perf_counter() - start
+    channels = args.channels if args.channels is not None else range(len(values))
+    print("channel\t" + "\t".join(f"{name} mean" for name in TRACK_NAMES) + "\tvoiced")
+    for channel, tracks in zip(channels, values):
+        with np.errstate(invalid="ignore"):
+            means = [np.nanmean(track) if np.any(~np.isnan(track)) else np.nan for track in tracks]
+        print(f"{channel}\t" + "\t".join(f"{mean:.1f}" for mean in means) +
+              f"\t{np.mean(~np.isnan(tracks[0])):.3f}")
+    print(f"{len(values)} channels x {len(times)} frames in {elapsed:.2f} s", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,447 @@
+##      CorpusIndex.py
+##
+##      Description: a SQLite index of many analysed recordings, for
+##          questions across the whole corpus such as "every frame with F1
+##          between 300 and 400 Hz, F2 above 2000 Hz and intensity above
+##          55 dB" or "every interval labelled a whose F0 is rising",
+##          without analysing any file again.
+##
+##          Each recording is analysed once, BLOCK_DURATION at a time through
+##          StreamingAnalysis rather than converted whole, so an hour of audio
+##          can be ingested (the tracks are kept in the analysis cache, as
+##          IntervalReports keeps them), and stored as frames on one
+##          FRAME_STEP grid plus the IntervalReporter summary of every
+##          labelled interval of its TextGrid. Frames are written to the
+##          database INSERT_FRAMES at a time. Frames are indexed by
+##          recording and time, and by pitch, F1-F3 and intensity together in
+##          an R*Tree: a range on several of them is answered from the tree
+##          without scanning every frame that matches only one. Intervals
+##          are indexed by label and by recording and time.
+##
+##          usage: python CorpusIndex.py <index.db> [sources ...] [--tier TIER] [--replace]
+##                                       [--frames CONDITION ...] [--intervals CONDITION ...]
+##          where a CONDITION is column=value or column=low:high (either end may be left out),
+##          e.g. --frames F1=300:400 F2=2000: intensity=55: --intervals label=a F0_trend=Rising
+##
+##      ©2023
+##
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+import numpy as np
+from AnalysisCache import get_cache
+from IntervalReports import IntervalReporter, TRACK_NAMES, DEFAULT_SETTINGS, read_textgrid
+from TimeGrid import TimeGrid
+
+INDEX_FORMAT_VERSION = 1
+# time step of the stored frames, in seconds; the tracks are resampled onto it
+FRAME_STEP = 0.01
+# seconds of frames analysed at a time while ingesting a recording
+BLOCK_DURATION = 60.0
+# frames inserted with one statement
+INSERT_FRAMES = 1 << 16
+# frame columns held in the R*Tree, which allows at most five dimensions; F4 has its own B-tree index
+RANGE_COLUMNS = ("F0", "F1", "F2", "F3", "intensity")
+# R*Tree coordinate of an undefined value: below any real one, and every range query has a lower bound above it
+UNDEFINED = -1e9
+FRAME_COLUMNS = ("recording", "time") + TRACK_NAMES
+INTERVAL_COLUMNS = ("recording", "tier", "label", "start", "end") + tuple(
+    f"{name}_{statistic}" for name in TRACK_NAMES for statistic in ("mean", "change", "trend"))
+_TEXT_COLUMNS = frozenset(["recording", "tier", "label"] + [f"{name}_trend" for name in TRACK_NAMES])
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS recordings (
+    id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, digest TEXT NOT NULL, settings TEXT NOT NULL,
+    first_frame INTEGER, last_frame INTEGER);
+CREATE TABLE IF NOT EXISTS frames (
+    id INTEGER PRIMARY KEY, recording INTEGER NOT NULL, time REAL NOT NULL,
+    {", ".join(f"{name} REAL" for name in TRACK_NAMES)});
+CREATE INDEX IF NOT EXISTS frames_time ON frames (recording, time);
+CREATE INDEX IF NOT EXISTS frames_F4 ON frames (F4);
+CREATE VIRTUAL TABLE IF NOT EXISTS frame_ranges USING rtree (
+    id, {", ".join(f"{name}_min, {name}_max" for name in RANGE_COLUMNS)});
+CREATE TABLE IF NOT EXISTS intervals (
+    id INTEGER PRIMARY KEY, recording INTEGER NOT NULL, tier TEXT NOT NULL, label TEXT NOT NULL,
+    start REAL NOT NULL, "end" REAL NOT NULL,
+    {", ".join(f"{name}_mean REAL, {name}_change REAL, {name}_trend TEXT" for name in TRACK_NAMES)});
+CREATE INDEX IF NOT EXISTS intervals_label ON intervals (label, tier);
+CREATE INDEX IF NOT EXISTS intervals_time ON intervals (recording, start);
+"""
+
+
+def frame_grid(tracks: dict) -> TimeGrid:
+    """
+    :param tracks: dict of track name -> (times, values)
+    :return: the FRAME_STEP grid over the span where every track has frames, with no frames if none has any
+    """
+    spans = [(times[0], times[-1]) for times, _ in tracks.values() if len(times)]
+    if not spans:
+        return TimeGrid(0.0, FRAME_STEP, 0)
+    start = max(first for first, _ in spans)
+    end = min(last for _, last in spans)
+    n = int(np.floor((end - start) / FRAME_STEP + 1e-9)) + 1 if end >= start else 0
+    return TimeGrid(start, FRAME_STEP, n)
+
+
+def parse_condition(text: str) -> tuple[str, object]:
+    """
+    :param text: column=value or column=low:high, e.g. "F1=300:400", "F2=2000:" or "label=a"
+    :return: (column, value) or (column, (low, high)) with None for a missing end
+    """
+    column, sep, value = text.partition("=")
+    if not sep:
+        raise ValueError(f"condition '{text}' is not column=value or column=low:high")
+    if ":" not in value:
+        return column, value
+    low, high = value.split(":", 1)
+    return column, (float(low) if low else None, float(high) if high else None)
+
+
+class CorpusIndex:
+    """
+    Frames and interval summaries of many recordings in one SQLite database
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: the database file, created if missing
+        """
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")  # queries from other processes while one ingests
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version not in (0, INDEX_FORMAT_VERSION):
+            raise ValueError(f"{path} has index format {version}, expected {INDEX_FORMAT_VERSION}")
+        with self.db:
+            self.db.executescript(_SCHEMA)
+            self.db.execute(f"PRAGMA user_version={INDEX_FORMAT_VERSION}")
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    # ------------------------------------------------------------------ ingestion
+
+    def recordings(self) -> dict[int, str]:
+        """
+        :return: dict of recording id -> path
+        """
+        return dict(self.db.execute("SELECT id, path FROM recordings"))
+
+    def add_recording(self, filename: str, textgrid: str = None, tier=None, replace: bool = False,
+                      **settings) -> bool:
+        """
+        Analyses a recording (or reads its analysis from the analysis cache) and stores its frames and the
+        summary of its labelled intervals, unless the same file contents are already stored with these settings
+        :param filename: path to a .wav file
+        :param textgrid: TextGrid annotating it, None for frames only
+        :param tier: tier name to store, None for every interval tier
+        :param replace: store it again even if it is up to date
+        :param settings: overrides for IntervalReports.DEFAULT_SETTINGS
+        :return: True if the recording was stored, False if the stored one was kept
+        """
+        path = os.path.abspath(filename)
+        digest = get_cache().file_digest(filename)
+        stored_settings = json.dumps({**DEFAULT_SETTINGS, **settings, "block_duration": BLOCK_DURATION,
+                                      "textgrid": textgrid and os.path.abspath(textgrid), "tier": tier},
+                                     sort_keys=True)
+        row = self.db.execute("SELECT digest, settings FROM recordings WHERE path = ?", (path,)).fetchone()
+        if row == (digest, stored_settings) and not replace:
+            return False
+
+        reporter = IntervalReporter(filename, BLOCK_DURATION, **settings)
+        tracks = {name: (index.times, index.values) for name, index in reporter.indexes.items()}
+        grid = frame_grid(tracks)
+        values = grid.stack([tracks[name] for name in TRACK_NAMES])
+        intervals = []
+        if textgrid is not None:
+            for name, items in read_textgrid(textgrid).items():
+                if tier is None or name == tier:
+                    intervals += [(name, start, end, label) for start, end, label in items
+                                  if end > start and label.strip()]
+
+        with self.db:
+            self._remove(path)
+            cursor = self.db.execute("INSERT INTO recordings (path, digest, settings) VALUES (?, ?, ?)",
+                                     (path, digest, stored_settings))
+            recording = cursor.lastrowid
+            first = self.db.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM frames").fetchone()[0]
+            times = grid.times
+            for start in range(0, grid.n, INSERT_FRAMES):
+                stop = min(start + INSERT_FRAMES, grid.n)
+                ids = np.arange(first + start, first + stop)
+                # SQLite stores NaN as NULL, which no range condition matches
+                rows = np.column_stack([ids, np.full(stop - start, recording), times[start:stop],
+                                        values[:, start:stop].T])
+                self.db.executemany(f"INSERT INTO frames (id, recording, time, {', '.join(TRACK_NAMES)}) "
+                                    f"VALUES ({', '.join('?' * (3 + len(TRACK_NAMES)))})",
+                                    ((int(r[0]), int(r[1]), *r[2:]) for r in rows.tolist()))
+                ranged = np.nan_to_num(values[[TRACK_NAMES.index(name) for name in RANGE_COLUMNS], start:stop],
+                                       nan=UNDEFINED)
+                self.db.executemany(f"INSERT INTO frame_ranges "
+                                    f"VALUES ({', '.join('?' * (1 + 2 * len(RANGE_COLUMNS)))})",
+                                    ((int(i), *np.repeat(r, 2).tolist()) for i, r in zip(ids, ranged.T)))
+            self.db.execute("UPDATE recordings SET first_frame = ?, last_frame = ? WHERE id = ?",
+                            (first, first + grid.n - 1, recording))
+            if intervals:
+                summary = reporter.summarise([start for _, start, _, _ in intervals],
+                                             [end for _, _, end, _ in intervals])
+                self.db.executemany(
+                    f"INSERT INTO intervals ({', '.join(_quoted(INTERVAL_COLUMNS))}) "
+                    f"VALUES ({', '.join('?' * len(INTERVAL_COLUMNS))})",
+                    ((recording, name, label, start, end,
+                      *(value for track in TRACK_NAMES for value in (float(summary[track]["mean"][i]),
+                                                                      float(summary[track]["net_change"][i]),
+                                                                      str(summary[track]["trend"][i]))))
+                     for i, (name, start, end, label) in enumerate(intervals)))
+        return True
+
+    def _remove(self, path: str):
+        row = self.db.execute("SELECT id, first_frame, last_frame FROM recordings WHERE path = ?",
+                              (path,)).fetchone()
+        if row is None:
+            return
+        recording, first, last = row
+        self.db.execute("DELETE FROM frame_ranges WHERE id BETWEEN ? AND ?", (first, last))
+        self.db.execute("DELETE FROM frames WHERE recording = ?", (recording,))
+        self.db.execute("DELETE FROM intervals WHERE recording = ?", (recording,))
+        self.db.execute("DELETE FROM recordings WHERE id = ?", (recording,))
+
+    def remove(self, filename: str):
+        """
+        Deletes a recording's frames and intervals
+        """
+        with self.db:
+            self._remove(os.path.abspath(filename))
+
+    def analyse(self):
+        """
+        Gathers the statistics SQLite uses to choose between the indexes; worth running after a large ingest
+        """
+        with self.db:
+            self.db.execute("ANALYZE")
+
+    # ------------------------------------------------------------------ queries
+
+    def _recording_id(self, recording: str) -> int:
+        row = self.db.execute("SELECT id FROM recordings WHERE path = ?", (os.path.abspath(recording),)).fetchone()
+        if row is None:
+            raise KeyError(f"no recording '{recording}' in {self.path}")
+        return row[0]
+
+    def _frame_query(self, select: str, recording: str, from_time: float, to_time: float,
+                     ranges: dict) -> tuple[str, list]:
+        unknown = set(ranges) - set(TRACK_NAMES)
+        if unknown:
+            raise ValueError(f"unknown frame columns {sorted(unknown)}, expected some of {', '.join(TRACK_NAMES)}")
+        ranged = {name: bounds for name, bounds in ranges.items() if name in RANGE_COLUMNS}
+        where, params = [], []
+        if recording is not None:
+            where.append("f.recording = ?")
+            params.append(self._recording_id(recording))
+        if from_time is not None:
+            where.append("f.time >= ?")
+            params.append(from_time)
+        if to_time is not None:
+            where.append("f.time <= ?")
+            params.append(to_time)
+        for name, (low, high) in ranges.items():
+            # the exact test on the frame; the tree stores 32-bit floats, so it is only asked for an overlap
+            where.append(f"f.{name} IS NOT NULL")
+            if low is not None:
+                where.append(f"f.{name} >= ?")
+                params.append(low)
+            if high is not None:
+                where.append(f"f.{name} <= ?")
+                params.append(high)
+        source = "frames f"
+        if ranged:
+            source = "frame_ranges r JOIN frames f ON f.id = r.id"
+            tree, tree_params = [], []
+            for name, (low, high) in ranged.items():
+                tree.append(f"r.{name}_max >= ?")
+                tree_params.append(UNDEFINED / 2 if low is None else low)
+                if high is not None:
+                    tree.append(f"r.{name}_min <= ?")
+                    tree_params.append(high)
+            where, params = tree + where, tree_params + params
+        return f"SELECT {select} FROM {source}" + (f" WHERE {' AND '.join(where)}" if where else ""), params
+
+    def frames(self, columns=None, recording: str = None, from_time: float = None, to_time: float = None,
+               limit: int = None, **ranges) -> dict[str, np.ndarray]:
+        """
+        Finds frames, e.g. frames(F1=(300, 400), F2=(2000, None), intensity=(55, None))
+        :param columns: columns to return from FRAME_COLUMNS, defaults to all of them
+        :param recording: path of one recording, None for all
+        :param from_time: earliest frame time
+        :param to_time: latest frame time
+        :param limit: most frames to return, None for all
+        :param ranges: track name from TRACK_NAMES -> (low, high), inclusive, None for an open end; frames where
+                        the track is undefined never match
+        :return: dict of column name -> array, NaN where a track is undefined; "recording" holds paths
+        """
+        columns = list(columns or FRAME_COLUMNS)
+        unknown = set(columns) - set(FRAME_COLUMNS)
+        if unknown:
+            raise ValueError(f"unknown frame columns {sorted(unknown)}, expected some of {', '.join(FRAME_COLUMNS)}")
+        sql, params = self._frame_query(", ".join(f"f.{name}" for name in columns), recording, from_time, to_time,
+                                         ranges)
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        return self._columns(columns, self.db.execute(sql, params).fetchall())
+
+    def count_frames(self, recording: str = None, from_time: float = None, to_time: float = None,
+                     **ranges) -> int:
+        """
+        :return: the number of frames frames() would return for the same conditions
+        """
+        sql, params = self._frame_query("COUNT(*)", recording, from_time, to_time, ranges)
+        return self.db.execute(sql, params).fetchone()[0]
+
+    def intervals(self, columns=None, recording: str = None, limit: int = None, **conditions) -> \
+            dict[str, np.ndarray]:
+        """
+        Finds interval summaries, e.g. intervals(label="a", F0_trend="Rising") or intervals(F1_mean=(300, 400))
+        :param columns: columns to return from INTERVAL_COLUMNS, defaults to all of them
+        :param recording: path of one recording, None for all
+        :param limit: most intervals to return, None for all
+        :param conditions: column from INTERVAL_COLUMNS -> a value it must equal, or (low, high) for a numeric
+                            column, inclusive, None for an open end
+        :return: dict of column name -> array, NaN where a mean or change is undefined; "recording" holds paths
+        """
+        columns = list(columns or INTERVAL_COLUMNS)
+        unknown = (set(columns) | set(conditions)) - set(INTERVAL_COLUMNS)
+        if unknown:
+            raise ValueError(f"unknown interval columns {sorted(unknown)}, "
+                             f"expected some of {', '.join(INTERVAL_COLUMNS)}")
+        where, params = [], []
+        if recording is not None:
+            where.append("recording = ?")
+            params.append(self._recording_id(recording))
+        for name, value in conditions.items():
+            if isinstance(value, tuple):
+                low, high = value
+                if low is not None:
+                    where.append(f'"{name}" >= ?')
+                    params.append(low)
+                if high is not None:
+                    where.append(f'"{name}" <= ?')
+                    params.append(high)
+            else:
+                where.append(f'"{name}" = ?')
+                params.append(value)
+        sql = f"SELECT {', '.join(_quoted(columns))} FROM intervals" + \
+              (f" WHERE {' AND '.join(where)}" if where else "") + " ORDER BY recording, start"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        return self._columns(columns, self.db.execute(sql, params).fetchall())
+
+    def _columns(self, columns: list, rows: list) -> dict[str, np.ndarray]:
+        """
+        :return: the rows of a query as one array per column, with recording ids replaced by paths
+        """
+        if not rows:
+            return {name: np.empty(0, dtype=str if name in _TEXT_COLUMNS else float) for name in columns}
+        transposed = list(zip(*rows))
+        out = {}
+        for name, values in zip(columns, transposed):
+            if name == "recording":
+                paths = self.recordings()
+                out[name] = np.array([paths[value] for value in values], dtype=str)
+            elif name in _TEXT_COLUMNS:
+                out[name] = np.array(values, dtype=str)
+            else:
+                out[name] = np.array(values, dtype=float)  # None (SQL NULL) becomes NaN
+        return out
+
+
+def _quoted(columns) -> list[str]:
+    return [f'"{name}"' for name in columns]
+
+
+def _sources(sources: list[str]) -> list[tuple[str, str]]:
+    """
+    :param sources: .wav files or directories of them
+    :return: (wav, TextGrid or None) pairs, the TextGrid being the file with the same name next to the wav
+    """
+    filenames = []
+    for source in sources:
+        if os.path.isdir(source):
+            filenames += sorted(os.path.join(folder, name) for folder, _, files in os.walk(source)
+                                for name in files if name.lower().endswith(".wav"))
+        else:
+            filenames.append(source)
+    pairs = []
+    for filename in filenames:
+        textgrid = os.path.splitext(filename)[0] + ".TextGrid"
+        pairs.append((filename, textgrid if os.path.exists(textgrid) else None))
+    return pairs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Index the frames and labelled intervals of many recordings in "
+                                                 "SQLite and query them across the corpus.")
+    parser.add_argument("index", help="SQLite database, created if missing")
+    parser.add_argument("sources", nargs="*", help=".wav files or directories of them to add; a TextGrid with "
+                                                   "the same name next to a .wav is added with it")
+    parser.add_argument("--tier", default=None, help="only index this tier of the TextGrids (default: all)")
+    parser.add_argument("--replace", action="store_true", help="add recordings again even if up to date")
+    parser.add_argument("--frames", nargs="+", metavar="CONDITION", help="list the frames matching these")
+    parser.add_argument("--intervals", nargs="+", metavar="CONDITION", help="list the intervals matching these")
+    parser.add_argument("--limit", type=int, default=20, help="most rows to list per query (default: 20)")
+    args = parser.parse_args(argv)
+
+    with CorpusIndex(args.index) as index:
+        added = 0
+        for filename, textgrid in _sources(args.sources):
+            start = time.perf_counter()
+            if index.add_recording(filename, textgrid, args.tier, args.replace):
+                added += 1
+                print(f"{filename}: added in {time.perf_counter() - start:.2f} s", file=sys.stderr)
+        if added:
+            index.analyse()
+
+        if args.frames:
+            ranges = {}
+            for column, value in map(parse_condition, args.frames):
+                ranges[column] = value if isinstance(value, tuple) else (float(value), float(value))
+            start = time.perf_counter()
+            total = index.count_frames(**ranges)
+            found = index.frames(limit=args.limit, **ranges)
+            elapsed = time.perf_counter() - start
+            print("\t".join(FRAME_COLUMNS))
+            for row in zip(*found.values()):
+                print("\t".join([row[0], f"{row[1]:.3f}"] + [f"{value:.1f}" for value in row[2:]]))
+            print(f"{total} frames match, found in {elapsed * 1000:.1f} ms", file=sys.stderr)
+
+        if args.intervals:
+            conditions = dict(map(parse_condition, args.intervals))
+            start = time.perf_counter()
+            found = index.intervals(**conditions)
+            elapsed = time.perf_counter() - start
+            columns = ("recording", "tier", "label", "start", "end")
+            print("\t".join(columns + tuple(name for name in TRACK_NAMES for name in (f"{name}_mean",
+                                                                                       f"{name}_trend"))))
+            for i in range(min(len(found["label"]), args.limit)):
+                row = [str(found[column][i]) for column in columns[:3]]
+                row += [f"{found['start'][i]:.3f}", f"{found['end'][i]:.3f}"]
+                for name in TRACK_NAMES:
+                    row += [f"{found[f'{name}_mean'][i]:.1f}", str(found[f"{name}_trend"][i])]
+                print("\t".join(row))
+            print(f"{len(found['label'])} intervals match, found in {elapsed * 1000:.1f} ms", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,17 @@
 
 import parselmouth as pm
-import matplotlib.pyplot as plt
 import numpy as np
 import os.path as path
+from contextlib import nullcontext
 from FormantCleaning import *
 from MovingAverages import *
+# getVals, getTracks, loadCleanFormants and loadCleanFrames live in AnalysisCore; pyplot is imported where it's used
+from AnalysisCore import getVals, getTracks, loadCleanFormants, loadCleanFrames
+from AnalysisCache import get_cache, CachedSpectrogram
+from WavReader import MappedWav
+from Rendering import spectrogram_db, spectrogram_extent, spectrogram_band, SpectrogramBand, VALUES_MAX_FREQUENCY
+from Profiling import profiled, stage
+from AnalysisSession import AnalysisSession
 
 ##  plotWaveform
 ##  pre:
@@ -14,13 +21,15 @@ from MovingAverages import *
 ##          an image of the waveform plot is saved to [outFile].png
 ##          returns - a waveform plot figure
 ##
+@profiled(params=("inFile",))
 def plotWaveform(inFile, outFile="default"):
     if path.isfile(inFile) and inFile.endswith(".wav"):
+        import matplotlib.pyplot as plt
         wf = plt.figure(figsize=(12.8, 7.2))
-        snd = pm.Sound(inFile)
-        plt.plot()
-        plt.plot(snd.xs(), snd.values.T)
-        plt.xlim([snd.xmin, snd.xmax])
+        with MappedWav(inFile) as wav:
+            plt.plot()
+            plt.plot(wav.times(), wav.read().T)
+            plt.xlim([0, wav.duration])
         plt.xlabel("time [s]")
         plt.ylabel("amplitude")
         plt.savefig(outFile + "waveform.png")
@@ -34,14 +43,16 @@ def plotWaveform(inFile, outFile="default"):
 ##          an image of the spectrogram plot is saved to [outFile].png
 ##          returns - a spectrogram plot figure
 ##
+@profiled(params=("inFile",))
 def plotSpectrogram(inFile, outFile="default", dynamic_range = 70):
     if path.isfile(inFile) and inFile.endswith(".wav"):
+        import matplotlib.pyplot as plt
         fig = plt.figure(figsize=(12.8, 7.2))  # set figure to 1280x720
-        snd = pm.Sound(inFile)
-        sg = snd.to_spectrogram(window_length=0.032169, time_step=0.001)
-        X, Y = sg.x_grid(), sg.y_grid()
-        sg_db = 10 * np.log10(sg.values)
-        plt.pcolormesh(X, Y, sg_db, vmin=sg_db.max() - dynamic_range, cmap='binary')
+        sg = loadSpectrogramBand(inFile, window_length=0.032169, time_step=0.001)
+        sg_db, vmin, vmax = spectrogram_db(sg, dynamic_range)
+        # one image raster, much faster to draw than a pcolormesh cell per frame
+        plt.imshow(sg_db, vmin=vmin, vmax=vmax, cmap='binary', origin='lower', aspect='auto',
+                   extent=spectrogram_extent(sg))
         plt.ylim([sg.ymin, sg.ymax])
         plt.xlabel("time [s]")
         plt.ylabel("frequency [Hz]")
@@ -56,21 +67,16 @@ def plotSpectrogram(inFile, outFile="default", dynamic_range = 70):
 ##          an image of the formants plot is saved to "[outFile]_formants.png"
 ##          returns - a spectrogram plot figure
 ##
+@profiled(params=("inFile",))
 def plotValues(inFile, outFile):
     if path.isfile(inFile) and inFile.endswith(".wav"):
-        fig = plt.figure(figsize=(12.8, 7.2))  # set figure to 1280x720
-        # Load the sound file
-        snd = pm.Sound(inFile)
-        # get spectrogram
-        spec = snd.to_spectrogram(window_length=0.032169, time_step=0.001)
-        # get intensity
-        intensity = snd.to_intensity(time_step=0.001)
-        # Get the formants
-        formants = snd.to_formant_burg(time_step=0.001, window_length=0.032169)
-        # Get the pitch
-        pitch = snd.to_pitch(time_step=0.001019)
-        # Extract the formant/pitch/intensity values and times
-        values = clean_formants(pitch, formants, intensity)
+        with AnalysisSession(inFile) as session:
+            # get spectrogram, while the formant/pitch/intensity analyses run
+            spec = session.background(loadSpectrogramBand, inFile, window_length=0.032169, time_step=0.001,
+                                      max_frequency=VALUES_MAX_FREQUENCY, session=session)
+            # Extract the formant/pitch/intensity values and times
+            values = loadCleanFrames(inFile, session=session)
+            spec = spec.result()
         # draw values
         fig = draw_values(values, spec)
         fig.savefig(outFile + "_formants.png")
@@ -78,86 +84,45 @@ def plotValues(inFile, outFile):
     else:
         return False
 
-def getVals(inFile: str):
-    #check if valid wave file
-    if path.isfile(inFile) and inFile.endswith(".wav"):
-        #import sound object
-        snd = pm.Sound(inFile)
-
-        #extract data objects
-        pitch = snd.to_pitch(time_step=0.001)
-        formants = snd.to_formant_burg(time_step=0.001, window_length=pitch.get_time_from_frame_number(1))
-        intensity = snd.to_intensity(time_step=0.001)
-
-        #get time sequences and make times superlist
-        pitch_ts = pitch.ts()
-        formants_ts = formants.ts()
-        intensity_ts = intensity.ts()
-        times = [pitch_ts, formants_ts, intensity_ts]
-
-        #get raw pitch and formant data
-        f0 = []
-        f1 = []
-        f2 = []
-        f3 = []
-        f4 = []
-        int = []
-        vals = [f0, f1, f2, f3, f4, int]
-        for i in times[0]:
-            temp = pitch.get_value_at_time(i)
-            if (math.isnan(temp) == True):
-                vals[0].append(0)
-            else:
-                vals[0].append(temp)
-        for i in range(1, 5):
-            for j in times[1]:
-                temp = formants.get_value_at_time(i, j)
-                if (math.isnan(temp) == True):
-                    vals[i].append(0)
-                else:
-                    vals[i].append(temp)
-        for i in times[2]:
-            temp = intensity.get_value(i)
-            if (math.isnan(temp) == True):
-                vals[5].append(0)
-            else:
-                vals[5].append(temp)
-
-        #calculate differences
-        f0_diffs = [0]
-        f1_diffs = [0]
-        f2_diffs = [0]
-        f3_diffs = [0]
-        f4_diffs = [0]
-        int_diffs = [0]
-        diffs = [f0_diffs, f1_diffs, f2_diffs, f3_diffs, f4_diffs, int_diffs]
-        for i in range(len(vals[0])-1):
-            temp = vals[0][i] - vals[0][i + 1]
-            if (math.isnan(temp) == True):
-                diffs[0].append(0)
-            else:
-                diffs[0].append(temp)
-        for i in range(1, 5):
-            for j in range(len(vals[i])-1):
-                temp = vals[i][j] - vals[i][j + 1]
-                if (math.isnan(temp) == True):
-                    diffs[i].append(0)
-                else:
-                    diffs[i].append(temp)
-        for i in range(len(vals[5])-1):
-            temp = vals[5][i] - vals[5][i+1]
-            if (math.isnan(temp) == True):
-                diffs[5].append(0)
-            else:
-                diffs[5].append(temp)
-
-        # 3-D array of format values[time_sequence[pitch=0/formants=1[index]]][raw data[data 0-5[index]]][differences[data  0-5[index]]]
-        values = [times, vals, diffs]
-        return values
+##  loadSpectrogram
+##  pre:
+##          inFile is a valid .wav file
+##          session is an AnalysisSession of inFile to run the analysis in, or None for a new one
+##  Post:
+##          returns - the spectrogram of inFile, from the analysis cache if it was computed before
+##
+@profiled(params=("inFile", "time_step"))
+def loadSpectrogram(inFile, window_length=0.032169, time_step=0.001, session=None):
+    def compute():
+        with stage("to_spectrogram"), nullcontext(session) if session else AnalysisSession(inFile) as analyses:
+            sg = analyses.spectrogram(window_length=window_length, time_step=time_step).result()
+        return CachedSpectrogram.to_arrays(sg)
+    arrays = get_cache().fetch(inFile, "spectrogram", compute, window_length=window_length, time_step=time_step)
+    return CachedSpectrogram(arrays)
+
+##  loadSpectrogramBand
+##  pre:
+##          inFile is a valid .wav file
+##          min_frequency and max_frequency are the band to keep in Hz, max_frequency None for the whole spectrogram
+##          session is an AnalysisSession of inFile to run the analysis in, or None for a new one
+##  Post:
+##          returns - that band of the spectrogram of inFile in dB as a SpectrogramBand, from the analysis cache if
+##                    it was computed before; reading it back costs memory and time in proportion to the band
+##
+@profiled(params=("inFile", "max_frequency"))
+def loadSpectrogramBand(inFile, window_length=0.032169, time_step=0.001, min_frequency=0, max_frequency=None,
+                        session=None):
+    def compute():
+        sg = loadSpectrogram(inFile, window_length=window_length, time_step=time_step, session=session)
+        return spectrogram_band(sg, min_frequency, max_frequency).to_arrays()
+    arrays = get_cache().fetch(inFile, "spectrogram_db", compute, window_length=window_length, time_step=time_step,
+                               min_frequency=min_frequency, max_frequency=max_frequency)
+    return SpectrogramBand(arrays)
 
 
 
 def main():
+    import matplotlib.pyplot as plt
     inFile = "Thats One Small.wav"
     outFile = inFile.replace(".wav", "")
 
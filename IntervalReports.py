@@ -0,0 +1,334 @@
+##      IntervalReports.py
+##
+##      Description: averages and trajectories of pitch, F1-F4 and intensity
+##          for every labelled interval of a TextGrid tier, as in
+##          klattGrid_asamala_automated.praat. The recording is analysed once
+##          and each track gets prefix sums of its defined values and counts,
+##          so the mean over any interval is two binary searches and a
+##          subtraction, however many intervals there are.
+##
+##          usage: python IntervalReports.py <sound.wav> <annotation.TextGrid> [--tier TIER] [-o REPORT]
+##
+##      ©2023
+##
+
+import argparse
+import codecs
+import os
+import re
+import sys
+import parselmouth as pm
+import numpy as np
+from TrackExtraction import pitch_samples, formant_samples, intensity_samples, FORMANT_NUMBERS
+from AnalysisCache import get_cache
+from StreamingAnalysis import StreamingAnalyser, ANALYSES
+
+TRACK_NAMES = ("F0", "F1", "F2", "F3", "F4", "intensity")
+# just noticeable differences for a net change to count as rising or falling: the Assignment_2 values for
+# F0-F4 in Hz, and about 1 dB for intensity
+JNDS = {"F0": 5, "F1": 60, "F2": 200, "F3": 400, "F4": 650, "intensity": 1}
+UNITS = {"F0": "Hz", "F1": "Hz", "F2": "Hz", "F3": "Hz", "F4": "Hz", "intensity": "dB"}
+
+# analysis settings of the Praat script
+DEFAULT_SETTINGS = dict(pitch_time_step=0.01, pitch_floor=75.0, pitch_ceiling=500.0, formant_time_step=None,
+                        max_number_of_formants=5, maximum_formant=5500.0, window_length=0.025,
+                        pre_emphasis_from=50.0, minimum_pitch=100.0, intensity_time_step=0.01)
+
+# quoted strings (with "" for a literal quote), <exists>/<absent> flags, numbers, and everything else
+_TOKEN = re.compile(r'"((?:[^"]|"")*)"|(<exists>|<absent>)|([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)(?=\s|$)|\S+')
+
+
+def _read_text(filename: str) -> str:
+    """
+    :return: the contents of a Praat text file, which may be UTF-16 (Praat's default for non-ASCII text) or UTF-8
+    """
+    with open(filename, "rb") as f:
+        raw = f.read()
+    if raw.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return raw.decode("utf-16")
+    try:
+        return raw.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return raw.decode("latin-1")
+
+
+def read_textgrid(filename: str) -> dict[str, list[tuple[float, float, str]]]:
+    """
+    Reads a TextGrid in Praat's long or short text format
+    :param filename: path to the .TextGrid file
+    :return: dict of tier name -> list of (start, end, label) in file order; points of point tiers have
+                start == end
+    """
+    values = []
+    for match in _TOKEN.finditer(_read_text(filename)):
+        string, flag, number = match.groups()
+        if string is not None:
+            values.append(string.replace('""', '"'))
+        elif flag is not None:
+            values.append(flag)
+        elif number is not None:
+            values.append(float(number))
+        # anything else is a long-format label such as "xmin =" or "intervals [3]:"
+
+    if values[:2] != ["ooTextFile", "TextGrid"]:
+        raise ValueError(f"{filename} is not a TextGrid text file")
+    position = 6  # file type, object class, xmin, xmax, tiers flag, number of tiers
+    tiers = {}
+    for _ in range(int(values[5]) if values[4] == "<exists>" else 0):
+        tier_class, name, _, _, size = values[position:position + 5]
+        position += 5
+        items = []
+        if tier_class == "IntervalTier":
+            for _ in range(int(size)):
+                start, end, label = values[position:position + 3]
+                items.append((start, end, label))
+                position += 3
+        else:
+            for _ in range(int(size)):
+                time, mark = values[position:position + 2]
+                items.append((time, time, mark))
+                position += 2
+        tiers[name] = items
+    return tiers
+
+
+def labelled_intervals(tiers: dict, tier) -> list[tuple[float, float, str]]:
+    """
+    :param tiers: from read_textgrid
+    :param tier: tier name, or its number counting from 1 as in Praat
+    :return: the (start, end, label) intervals of that tier whose label is not blank
+    """
+    if isinstance(tier, int) or (isinstance(tier, str) and tier.isdigit() and tier not in tiers):
+        names = list(tiers)
+        number = int(tier)
+        if not 1 <= number <= len(names):
+            raise ValueError(f"tier {number} does not exist, the TextGrid has {len(names)} tiers")
+        tier = names[number - 1]
+    if tier not in tiers:
+        raise ValueError(f"no tier named '{tier}', the TextGrid has {', '.join(tiers)}")
+    return [(start, end, label) for start, end, label in tiers[tier] if label.strip()]
+
+
+class TrackIndex:
+    """
+    Prefix sums over one track, for constant-time statistics of any time interval. Undefined frames (NaN) are
+    left out of every statistic.
+    """
+
+    def __init__(self, times, values, averaging: str = "mean"):
+        """
+        :param times: frame times in seconds, ascending
+        :param values: frame values, NaN where undefined
+        :param averaging: "mean" for an arithmetic mean, "energy" to average dB values as energies like
+                            Praat's Intensity "Get mean" with "energy"
+        """
+        if averaging not in ("mean", "energy"):
+            raise ValueError(f"unknown averaging '{averaging}', use 'mean' or 'energy'")
+        self.times = np.asarray(times, dtype=float)
+        self.values = np.asarray(values, dtype=float)
+        self.averaging = averaging
+        defined = ~np.isnan(self.values)
+        summed = np.where(defined, self.values, 0.0)
+        if averaging == "energy":
+            summed = np.where(defined, 10.0 ** (summed / 10.0), 0.0)
+        n = len(self.values)
+        self._sums = np.concatenate([[0.0], np.cumsum(summed)])
+        self._counts = np.concatenate([[0], np.cumsum(defined)])
+        # nearest defined frame at or after / at or before each frame, n / -1 if there is none
+        index = np.arange(n)
+        self._next = np.minimum.accumulate(np.where(defined, index, n)[::-1])[::-1]
+        self._previous = np.maximum.accumulate(np.where(defined, index, -1))
+
+    def frames(self, starts, ends) -> tuple[np.ndarray, np.ndarray]:
+        """
+        :param starts: interval start times
+        :param ends: interval end times
+        :return: (first, stop) frame indices, so frames first..stop-1 have times in [start, end]
+        """
+        return (np.searchsorted(self.times, np.asarray(starts, dtype=float), side="left"),
+                np.searchsorted(self.times, np.asarray(ends, dtype=float), side="right"))
+
+    def count(self, starts, ends) -> np.ndarray:
+        """
+        :return: number of defined frames in each interval
+        """
+        first, stop = self.frames(starts, ends)
+        return self._counts[stop] - self._counts[first]
+
+    def mean(self, starts, ends) -> np.ndarray:
+        """
+        :return: mean of the defined frames in each interval, NaN where there are none
+        """
+        first, stop = self.frames(starts, ends)
+        counts = self._counts[stop] - self._counts[first]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = (self._sums[stop] - self._sums[first]) / counts
+            if self.averaging == "energy":
+                means = 10.0 * np.log10(means)
+        means[counts == 0] = np.nan
+        return means
+
+    def net_change(self, starts, ends) -> np.ndarray:
+        """
+        :return: last minus first defined value in each interval, NaN where there are none
+        """
+        first, stop = self.frames(starts, ends)
+        n = len(self.values)
+        if n == 0:
+            return np.full(np.shape(first), np.nan)
+        first_defined = self._next[np.minimum(first, n - 1)]
+        last_defined = self._previous[np.maximum(stop - 1, 0)]
+        ok = (first < n) & (stop > 0) & (first_defined < stop) & (last_defined >= first)
+        change = np.full(np.shape(first), np.nan)
+        change[ok] = self.values[last_defined[ok]] - self.values[first_defined[ok]]
+        return change
+
+
+def trend(net_change, jnd: float) -> np.ndarray:
+    """
+    :param net_change: net changes over intervals
+    :param jnd: just noticeable difference
+    :return: "Rising", "Falling" or "Flat" for each change, "Undefined" where it is NaN
+    """
+    net_change = np.asarray(net_change, dtype=float)
+    return np.select([net_change > jnd, net_change < -jnd, np.isnan(net_change)],
+                     ["Rising", "Falling", "Undefined"], "Flat")
+
+
+def analyse_tracks(filename: str, block_duration: float = None, **settings) -> dict[str, tuple[np.ndarray, np.ndarray]]:
+    """
+    Analyses the whole recording once, with results kept in the analysis cache
+    :param filename: path to a .wav file
+    :param block_duration: None to analyse the recording in one piece; otherwise seconds of frames analysed at a
+                            time by StreamingAnalysis, which never converts or resamples the whole recording at
+                            once, and matches whole-file analysis up to the residuals it describes
+    :param settings: overrides for DEFAULT_SETTINGS
+    :return: dict of TRACK_NAMES -> (times, values), values NaN where undefined
+    """
+    settings = {**DEFAULT_SETTINGS, **settings}
+
+    def compute():
+        snd = pm.Sound(filename)
+        pitch = snd.to_pitch(time_step=settings["pitch_time_step"], pitch_floor=settings["pitch_floor"],
+                             pitch_ceiling=settings["pitch_ceiling"])
+        formants = snd.to_formant_burg(time_step=settings["formant_time_step"],
+                                       max_number_of_formants=settings["max_number_of_formants"],
+                                       maximum_formant=settings["maximum_formant"],
+                                       window_length=settings["window_length"],
+                                       pre_emphasis_from=settings["pre_emphasis_from"])
+        intensity = snd.to_intensity(minimum_pitch=settings["minimum_pitch"],
+                                     time_step=settings["intensity_time_step"])
+        arrays = {"pitch_times": pitch.xs(), "F0": pitch_samples(pitch), "formant_times": formants.xs(),
+                  "intensity_times": intensity.xs(), "intensity": intensity_samples(intensity)}
+        for number in FORMANT_NUMBERS:
+            arrays[f"F{number}"] = formant_samples(number, formants)
+        return arrays
+
+    def compute_blocks():
+        # a StreamingAnalyser has one time step, so the analyses are grouped by theirs; a step left as None is
+        # Praat's default for the analysis
+        steps = {"pitch": settings["pitch_time_step"] or 0.75 / settings["pitch_floor"],
+                 "formant": settings["formant_time_step"] or 0.25 * settings["window_length"],
+                 "intensity": settings["intensity_time_step"] or 0.8 / settings["minimum_pitch"]}
+        tracks = {}
+        for step in sorted(set(steps.values())):
+            analyser = StreamingAnalyser(filename, time_step=step, pitch_floor=settings["pitch_floor"],
+                                         pitch_ceiling=settings["pitch_ceiling"],
+                                         max_number_of_formants=settings["max_number_of_formants"],
+                                         maximum_formant=settings["maximum_formant"],
+                                         window_length=settings["window_length"],
+                                         pre_emphasis_from=settings["pre_emphasis_from"],
+                                         minimum_pitch=settings["minimum_pitch"])
+            tracks.update(analyser.analyse(block_duration, analyses=[name for name in ANALYSES
+                                                                      if steps[name] == step]))
+        arrays = {"pitch_times": tracks["pitch"][0], "F0": tracks["pitch"][1], "formant_times": tracks["formant"][0],
+                  "intensity_times": tracks["intensity"][0], "intensity": tracks["intensity"][1]}
+        for number, values in zip(FORMANT_NUMBERS, tracks["formant"][1]):
+            arrays[f"F{number}"] = values
+        return arrays
+
+    if block_duration is None:
+        arrays = get_cache().fetch(filename, "interval_tracks", compute, **settings)
+    else:
+        arrays = get_cache().fetch(filename, "interval_tracks_blockwise", compute_blocks,
+                                   block_duration=block_duration, **settings)
+    tracks = {"F0": (arrays["pitch_times"], arrays["F0"])}
+    for number in FORMANT_NUMBERS:
+        tracks[f"F{number}"] = (arrays["formant_times"], arrays[f"F{number}"])
+    tracks["intensity"] = (arrays["intensity_times"], arrays["intensity"])
+    return tracks
+
+
+class IntervalReporter:
+    """
+    Statistics of one recording over any number of intervals, from a single analysis
+    """
+
+    def __init__(self, filename: str, block_duration: float = None, **settings):
+        """
+        :param filename: path to a .wav file
+        :param block_duration: see analyse_tracks
+        :param settings: overrides for DEFAULT_SETTINGS
+        """
+        self.filename = filename
+        self.indexes = {name: TrackIndex(times, values, "energy" if name == "intensity" else "mean")
+                        for name, (times, values) in analyse_tracks(filename, block_duration, **settings).items()}
+
+    def summarise(self, starts, ends) -> dict[str, dict[str, np.ndarray]]:
+        """
+        :param starts: interval start times
+        :param ends: interval end times
+        :return: dict of TRACK_NAMES -> {"mean", "net_change", "trend", "frames"} arrays, one entry per interval
+        """
+        summary = {}
+        for name, index in self.indexes.items():
+            change = index.net_change(starts, ends)
+            summary[name] = {"mean": index.mean(starts, ends), "net_change": change,
+                             "trend": trend(change, JNDS[name]), "frames": index.count(starts, ends)}
+        return summary
+
+    def report(self, intervals: list[tuple[float, float, str]]) -> str:
+        """
+        :param intervals: list of (start, end, label), e.g. from labelled_intervals
+        :return: tab-separated report with one row per interval: its label and times, then the mean, net
+                    change and trend of every track
+        """
+        starts = [start for start, _, _ in intervals]
+        ends = [end for _, end, _ in intervals]
+        summary = self.summarise(starts, ends)
+        header = ["interval", "label", "from", "to"]
+        for name in TRACK_NAMES:
+            header += [f"{name} mean ({UNITS[name]})", f"{name} change ({UNITS[name]})", f"{name} trend"]
+        lines = ["\t".join(header)]
+        for i, (start, end, label) in enumerate(intervals):
+            row = [str(i + 1), label.replace("\t", " ").replace("\n", " "), f"{start:.6f}", f"{end:.6f}"]
+            for name in TRACK_NAMES:
+                stats = summary[name]
+                row += [f"{stats['mean'][i]:.1f}", f"{stats['net_change'][i]:.1f}", stats['trend'][i]]
+            lines.append("\t".join(row))
+        return "\n".join(lines) + "\n"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report pitch, formant and intensity averages and trajectories "
+                                                 "for every labelled interval of a TextGrid tier.")
+    parser.add_argument("sound", help=".wav file")
+    parser.add_argument("textgrid", help="TextGrid annotating the sound")
+    parser.add_argument("--tier", default="1", help="tier name or number, counting from 1 (default: 1)")
+    parser.add_argument("-o", "--output", default=None,
+                        help="report file (default: <sound>_intervals.tsv next to the sound)")
+    parser.add_argument("--pitch-ceiling", type=float, default=DEFAULT_SETTINGS["pitch_ceiling"])
+    parser.add_argument("--maximum-formant", type=float, default=DEFAULT_SETTINGS["maximum_formant"])
+    args = parser.parse_args(argv)
+
+    intervals = labelled_intervals(read_textgrid(args.textgrid), args.tier)
+    reporter = IntervalReporter(args.sound, pitch_ceiling=args.pitch_ceiling, maximum_formant=args.maximum_formant)
+    output = args.output or os.path.splitext(args.sound)[0] + "_intervals.tsv"
+    with open(output, "w", encoding="utf8") as f:
+        f.write(reporter.report(intervals))
+    print(f"{len(intervals)} intervals written to {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
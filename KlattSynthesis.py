@@ -0,0 +1,200 @@
+##      KlattSynthesis.py
+##
+##      Description: a Python port of klattGrid_asamala_automated.praat. The
+##          average pitch, F1-F4 and intensity of every labelled interval of a
+##          TextGrid tier are computed in one vectorized pass over a single
+##          analysis of the recording (see IntervalReports), written into a
+##          KlattGrid through parselmouth, and optionally resynthesised. Pairs
+##          of sounds and TextGrids can be processed in a pool of worker
+##          processes to make stimuli for a whole corpus at once.
+##
+##          usage: python KlattSynthesis.py <sound.wav> <annotation.TextGrid> [--tier TIER] [-o OUT_DIR]
+##                 python KlattSynthesis.py <directory> [--tier TIER] [-o OUT_DIR] [-j JOBS]
+##
+##          In a directory, every .wav file with a .TextGrid of the same name
+##          next to it is processed.
+##
+##      ©2023
+##
+
+import argparse
+import multiprocessing as mp
+import os
+import sys
+import time
+import parselmouth as pm
+import numpy as np
+from parselmouth.praat import call
+from IntervalReports import IntervalReporter, read_textgrid, labelled_intervals
+
+# tier the Praat script reads by default
+DEFAULT_TIER = 4
+# oral formant bandwidths of the Praat script, F1-F4, in Hz
+FORMANT_BANDWIDTHS = (137, 147, 277, 751)
+
+
+def interval_parameters(filename: str, intervals: list[tuple[float, float, str]], packed: bool = True,
+                        **settings) -> dict[str, np.ndarray]:
+    """
+    Computes the KlattGrid parameters of every interval at once
+    :param filename: path to a .wav file
+    :param intervals: list of (start, end, label), e.g. from IntervalReports.labelled_intervals
+    :param packed: place the intervals back to back from time 0, so they fill a KlattGrid as long as their total
+                    duration; False keeps the recording's times, as the Praat script does
+    :param settings: analysis settings, see IntervalReports.DEFAULT_SETTINGS
+    :return: dict of "times" (where each interval's points go), "duration" (of the KlattGrid), "F0" (rounded),
+                "F1"-"F4" and "intensity" arrays, one entry per interval, NaN where a track is undefined
+    """
+    starts = np.array([start for start, _, _ in intervals], dtype=float)
+    ends = np.array([end for _, end, _ in intervals], dtype=float)
+    durations = ends - starts
+    summary = IntervalReporter(filename, **settings).summarise(starts, ends)
+    parameters = {name: stats["mean"] for name, stats in summary.items()}
+    parameters["F0"] = np.round(parameters["F0"])
+    parameters["times"] = np.concatenate([[0.0], np.cumsum(durations)[:-1]]) if packed else starts
+    parameters["duration"] = durations.sum()
+    return parameters
+
+
+def build_klatt_grid(parameters: dict[str, np.ndarray], name: str = "asamala") -> pm.Data:
+    """
+    Creates the KlattGrid of the Praat script from interval parameters. Points are not added for undefined
+    parameters (e.g. F0 of an unvoiced interval), which Praat would reject.
+    :param parameters: from interval_parameters
+    :param name: name of the KlattGrid object
+    :return: the KlattGrid as a parselmouth.Data
+    """
+    duration = max(float(parameters["duration"]), float(np.max(parameters["times"], initial=0.0)))
+    klatt = call("Create KlattGrid", name, 0, duration, 6, 1, 1, 6, 1, 1, 1)
+    # the script adds these for every interval, but a tier keeps only one point per time
+    call(klatt, "Add frication amplitude point", 0, 5)
+    call(klatt, "Add frication bypass point", 0.5, 0)
+
+    times = parameters["times"]
+    for t, f0 in zip(times, parameters["F0"]):
+        if not np.isnan(f0):
+            call(klatt, "Add pitch point", t, f0)
+    for t, level in zip(times, parameters["intensity"]):
+        if not np.isnan(level):
+            call(klatt, "Add voicing amplitude point", t, level)
+    for number, bandwidth in enumerate(FORMANT_BANDWIDTHS, start=1):
+        for t, frequency in zip(times, parameters[f"F{number}"]):
+            if not np.isnan(frequency):
+                call(klatt, "Add oral formant frequency point", number, t, frequency)
+                call(klatt, "Add oral formant bandwidth point", number, t, bandwidth)
+    return klatt
+
+
+def synthesise(filename: str, textgrid: str, tier=DEFAULT_TIER, out_dir: str = None, packed: bool = True,
+               **settings) -> tuple[pm.Data, pm.Sound]:
+    """
+    Runs the whole script for one recording
+    :param filename: path to a .wav file
+    :param textgrid: path to the TextGrid annotating it
+    :param tier: tier name, or number counting from 1
+    :param out_dir: if given, the KlattGrid and the resynthesised sound are saved there as
+                    "<name>.KlattGrid" and "<name>_klatt.wav"
+    :param packed: see interval_parameters
+    :param settings: analysis settings, see IntervalReports.DEFAULT_SETTINGS
+    :return: (KlattGrid, resynthesised parselmouth.Sound)
+    """
+    intervals = labelled_intervals(read_textgrid(textgrid), tier)
+    if not intervals:
+        raise ValueError(f"{textgrid} has no labelled intervals on tier {tier}")
+    klatt = build_klatt_grid(interval_parameters(filename, intervals, packed, **settings))
+    sound = call(klatt, "To Sound")
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+        name = os.path.splitext(os.path.basename(filename))[0]
+        call(klatt, "Save as text file", os.path.join(out_dir, name + ".KlattGrid"))
+        sound.save(os.path.join(out_dir, name + "_klatt.wav"), "WAV")
+    return klatt, sound
+
+
+def find_pairs(directory: str) -> list[tuple[str, str]]:
+    """
+    :return: (sound, TextGrid) for every .wav file under directory with a .TextGrid of the same name beside it
+    """
+    pairs = []
+    for folder, _, files in os.walk(directory):
+        grids = {os.path.splitext(name)[0]: name for name in files if name.lower().endswith(".textgrid")}
+        for name in sorted(files):
+            stem, ext = os.path.splitext(name)
+            if ext.lower() == ".wav" and stem in grids:
+                pairs.append((os.path.join(folder, name), os.path.join(folder, grids[stem])))
+    return pairs
+
+
+def _synthesise_job(job) -> tuple[str, float, str]:
+    """
+    :param job: (sound, TextGrid, tier, out_dir, packed)
+    :return: (sound, seconds taken, error message or None)
+    """
+    filename, textgrid, tier, out_dir, packed = job
+    start = time.perf_counter()
+    try:
+        synthesise(filename, textgrid, tier, out_dir, packed)
+    except Exception as e:
+        return filename, time.perf_counter() - start, f"{type(e).__name__}: {e}"
+    return filename, time.perf_counter() - start, None
+
+
+def synthesise_batch(pairs: list[tuple[str, str]], out_dir: str, tier=DEFAULT_TIER, packed: bool = True,
+                     processes: int = None):
+    """
+    Resynthesises many recordings, one per worker process at a time
+    :param pairs: list of (sound, TextGrid), e.g. from find_pairs
+    :param out_dir: directory for the KlattGrids and sounds
+    :param tier: tier name, or number counting from 1
+    :param packed: see interval_parameters
+    :param processes: worker processes, defaults to the number of cores; 1 runs in this process
+    :return: generator of (sound, seconds taken, error message or None) as recordings finish
+    """
+    jobs = [(filename, textgrid, tier, out_dir, packed) for filename, textgrid in pairs]
+    jobs.sort(key=lambda job: os.path.getsize(job[0]), reverse=True)  # longest first
+    processes = processes or os.cpu_count() or 1
+    if processes == 1 or len(jobs) <= 1:
+        yield from map(_synthesise_job, jobs)
+        return
+    with mp.Pool(min(processes, len(jobs))) as pool:
+        yield from pool.imap_unordered(_synthesise_job, jobs, chunksize=1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build KlattGrids from the interval averages of TextGrid tiers "
+                                                 "and resynthesise them.")
+    parser.add_argument("source", help="a .wav file, or a directory of .wav files with matching .TextGrid files")
+    parser.add_argument("textgrid", nargs="?", help="TextGrid for a single .wav file")
+    parser.add_argument("--tier", default=str(DEFAULT_TIER), help=f"tier name or number (default: {DEFAULT_TIER})")
+    parser.add_argument("-o", "--out-dir", default="klatt_output", help="directory for the KlattGrids and sounds")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes (default: number of cores)")
+    parser.add_argument("--original-times", action="store_true",
+                        help="keep the intervals at their times in the recording instead of packing them from 0")
+    args = parser.parse_args(argv)
+
+    if os.path.isdir(args.source):
+        pairs = find_pairs(args.source)
+    elif args.textgrid:
+        pairs = [(args.source, args.textgrid)]
+    else:
+        parser.error("a TextGrid is needed for a single .wav file")
+    if not pairs:
+        print(f"no .wav files with matching TextGrids in {args.source}", file=sys.stderr)
+        return 1
+
+    start = time.perf_counter()
+    failed = 0
+    for filename, seconds, error in synthesise_batch(pairs, args.out_dir, args.tier, not args.original_times,
+                                                     args.jobs):
+        if error:
+            failed += 1
+            print(f"FAILED {filename}: {error}", file=sys.stderr)
+        else:
+            print(f"{filename}: {seconds:.2f} s")
+    elapsed = time.perf_counter() - start
+    print(f"{len(pairs) - failed}/{len(pairs)} files in {elapsed:.2f} s ({len(pairs) / elapsed:.2f} files/s)")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,385 @@
+##      LiveAnalysis.py
+##
+##      Description: incremental pitch, formant and intensity analysis of
+##          audio arriving in blocks, e.g. from a capture device. Blocks go
+##          into a ring buffer. After each block, every analysis frame whose
+##          window has been completely received is analysed and emitted
+##          straight away, together with the JND rising/falling events it
+##          triggers, and the time taken to process the block is recorded.
+##          When the stream ends, flush emits the frames that were still
+##          waiting for audio past its end. A file played back at real-time
+##          rate stands in for a device.
+##
+##          Frames lie on one lattice of time steps for all three analyses.
+##          Each analysis call covers only the new frames plus a little
+##          context before them, so the work per block stays constant
+##          however long the stream runs. The values differ from whole-file
+##          analysis, formants the most: on a 180 s recording 6% of F1-F4
+##          values are more than 2% off and the largest error is 2300 Hz
+##          (see LiveAnalyser).
+##
+##          usage: python LiveAnalysis.py <sound.wav> [--block SECONDS] [--time-step SECONDS] [--fast]
+##
+##      ©2023
+##
+
+import argparse
+import math
+import sys
+import time
+import parselmouth as pm
+import numpy as np
+from TrackExtraction import pitch_samples, formant_samples, intensity_samples, FORMANT_NUMBERS
+from IntervalReports import JNDS
+from Segmentation import RISING, FLAT, FALLING, DIRECTION_NAMES
+from WavReader import MappedWav
+
+
+class RingBuffer:
+    """
+    The most recent samples of a mono stream, addressed by their index counted from the start of the stream
+    """
+
+    def __init__(self, capacity: int):
+        """
+        :param capacity: number of samples kept
+        """
+        self.capacity = capacity
+        self.data = np.zeros(capacity)
+        self.written = 0  # samples received so far
+        self.oldest = 0  # index of the oldest sample still held
+
+    def write(self, samples: np.ndarray):
+        samples = np.asarray(samples, dtype=float)
+        total = len(samples)
+        samples = samples[-self.capacity:]
+        start = (self.written + total - len(samples)) % self.capacity
+        first = min(len(samples), self.capacity - start)
+        self.data[start:start + first] = samples[:first]
+        self.data[:len(samples) - first] = samples[first:]
+        self.written += total
+        self.oldest = max(self.oldest, self.written - self.capacity)
+
+    def grow(self, capacity: int):
+        """
+        Enlarges the buffer, keeping the samples it holds
+        """
+        if capacity <= self.capacity:
+            return
+        kept = min(self.written, self.capacity)
+        samples = self.read(self.written - kept, self.written)
+        self.capacity = capacity
+        self.data = np.zeros(capacity)
+        self.written -= kept
+        self.write(samples)
+
+    def read(self, start: int, stop: int) -> np.ndarray:
+        """
+        :param start: index of the first sample, counted from the start of the stream
+        :param stop: index after the last sample
+        :return: a copy of the samples
+        """
+        if start < self.oldest or stop > self.written:
+            raise IndexError(f"samples {start}-{stop} are not in the buffer, which holds {self.oldest}-{self.written}")
+        return np.take(self.data, np.arange(start, stop) % self.capacity)
+
+
+class JndTracker:
+    """
+    Online version of Segmentation.segment_track for one track: a change of direction is reported as soon as the
+    track has moved more than the JND away from the extreme of the current run
+    """
+
+    def __init__(self, name: str, jnd: float):
+        self.name = name
+        self.jnd = jnd
+        self.direction = FLAT
+        self.reference = math.nan  # value the current run is measured from
+        self.reference_time = math.nan
+
+    def update(self, times: np.ndarray, values: np.ndarray) -> list[tuple[float, str, str, float, float]]:
+        """
+        :param times: new frame times
+        :param values: new frame values, NaN where undefined
+        :return: list of (time, track, "Rising"/"Falling", change since the run started, start of the run)
+        """
+        events = []
+        for t, value in zip(times.tolist(), values.tolist()):
+            if math.isnan(value):  # a gap ends any run
+                self.direction, self.reference = FLAT, math.nan
+                continue
+            if math.isnan(self.reference):
+                self.reference, self.reference_time = value, t
+                continue
+            change = value - self.reference
+            if self.direction == RISING and value >= self.reference or \
+                    self.direction == FALLING and value <= self.reference:
+                # a new extreme of the current run
+                self.reference, self.reference_time = value, t
+            elif change > self.jnd or change < -self.jnd:
+                self.direction = RISING if change > 0 else FALLING
+                events.append((t, self.name, DIRECTION_NAMES[self.direction], change, self.reference_time))
+                self.reference, self.reference_time = value, t
+        return events
+
+
+class LiveAnalyser:
+    """
+    Incremental analysis of a mono stream with snd.to_pitch_ac, snd.to_formant_burg and snd.to_intensity, each run
+    over a short stretch of audio around the new frames. Values are not identical with whole-file analysis: pitch
+    path finding has no lookahead past the new frames, and to_formant_burg resamples each stretch on its own, which
+    Praat low-passes with one FFT over whatever it is given. Against whole-file analysis with frames on the same
+    lattice, at the default settings:
+        One Small Step.wav (6 s)    F1-F4 4.2% of values more than 2% off, p99 200 Hz, max 2110 Hz;
+                                    pitch 20 of 605 frames voiced in only one, max 156 Hz
+        a 180 s recording           F1-F4 6.0% more than 2% off, p99 443 Hz, max 2300 Hz;
+                                    pitch 347 of 17995 frames voiced in only one, max 163 Hz
+    Resampling the stream incrementally before Burg does not close the gap (3.8% off on One Small Step.wav) and
+    delays formants by another 110 ms, so the tracks suit live display and events, not measurement.
+    """
+
+    def __init__(self, sampling_frequency: float, time_step: float = 0.01, pitch_floor: float = 75.0,
+                 pitch_ceiling: float = 300.0, max_number_of_formants: float = 5.0, maximum_formant: float = 5500.0,
+                 window_length: float = 0.025, pre_emphasis_from: float = 50.0, minimum_pitch: float = 100.0,
+                 silence_threshold: float = 0.03, context: float = 0.05, reference_peak: float = None,
+                 jnds: dict = None):
+        """
+        :param sampling_frequency: sample rate of the stream in Hz
+        :param time_step: time between frames; the defaults are those of first_part_separate
+        :param silence_threshold: to_pitch_ac's silence threshold, as a fraction of reference_peak rather than of
+                            the peak of the audio each call is given
+        :param context: audio before the new frames that each analysis call also covers, in seconds; helps the
+                            pitch path finding and the formant resampling settle
+        :param reference_peak: absolute peak the pitch silence threshold is relative to, as Praat uses the whole
+                            sound's peak; None uses the highest peak received so far
+        :param jnds: overrides for IntervalReports.JNDS used for the rising/falling events
+        """
+        self.sampling_frequency = sampling_frequency
+        self.dx = 1.0 / sampling_frequency
+        self.time_step = time_step
+        self.args = {
+            "pitch": dict(time_step=time_step, pitch_floor=pitch_floor, pitch_ceiling=pitch_ceiling),
+            "formant": dict(time_step=time_step, max_number_of_formants=max_number_of_formants,
+                            maximum_formant=maximum_formant, window_length=window_length,
+                            pre_emphasis_from=pre_emphasis_from),
+            "intensity": dict(time_step=time_step, minimum_pitch=minimum_pitch),
+        }
+        # full window lengths Praat uses for each analysis
+        self.windows = {"pitch": 3.0 / pitch_floor, "formant": 2.0 * window_length, "intensity": 6.4 / minimum_pitch}
+        self.context_frames = math.ceil(context / time_step)
+        # to_formant_burg first resamples to twice the maximum formant, which can shorten the audio by a sample
+        # of the new rate; segments are cut a little longer than their frames need
+        self.margin = math.ceil(sampling_frequency / maximum_formant) + 1
+        self.silence_threshold = silence_threshold
+        self.reference_peak = reference_peak
+        self.peak = 0.0
+
+        # frame k is at k * time_step; the first frame is the first one every analysis window fits before
+        self.first_frame = math.ceil((0.5 * max(self.windows.values()) + (self.margin + 1) * self.dx) / time_step)
+        self.next_frame = dict.fromkeys(self.windows, self.first_frame)
+        # samples the analysis of one new frame needs; a block's frames need as many more as it has samples
+        longest = max(self.windows.values()) + (self.context_frames + 2) * time_step
+        self.frame_samples = math.ceil(longest * sampling_frequency)
+        self.buffer = RingBuffer(self.frame_samples)
+        jnds = {**JNDS, **(jnds or {})}
+        self.trackers = {name: JndTracker(name, jnds[name]) for name in ("F0", "F1", "F2", "F3", "F4", "intensity")}
+        self.latencies = []
+
+    def _segment(self, analysis: str, first: int, last: int) -> tuple[int, int, int]:
+        """
+        :return: (start sample, end sample, frames of context) of the audio whose analysis frames are
+                    first - context ... last, centred as Praat centres them
+        """
+        window = self.windows[analysis]
+        context = min(self.context_frames, first - self.first_frame)
+        n_frames = last - first + 1 + context
+        half = math.ceil(0.5 * (window + (n_frames - 1) * self.time_step) * self.sampling_frequency) + self.margin
+        centre = 0.5 * (first - context + last) * self.time_step * self.sampling_frequency
+        start = math.floor(centre) - half
+        return start, start + 2 * half, context
+
+    def _ready(self, analysis: str) -> int:
+        """
+        :return: the last frame whose audio has been received completely
+        """
+        last = math.floor((self.buffer.written * self.dx - 0.5 * self.windows[analysis]) / self.time_step)
+        while last >= self.next_frame[analysis] and self._segment(analysis, self.next_frame[analysis], last)[1] > \
+                self.buffer.written:
+            last -= 1
+        return last
+
+    def _analyse(self, analysis: str, first: int, last: int):
+        """
+        :return: (times, values) of frames first...last; formant values are a 4 x n array of F1-F4
+        """
+        start, stop, _ = self._segment(analysis, first, last)
+        samples = self.buffer.read(start, stop)
+        snd = pm.Sound(samples, sampling_frequency=self.sampling_frequency, start_time=start * self.dx)
+        if analysis == "pitch":
+            # Praat judges silence against the peak (about the mean) of the audio it is given; scale the threshold
+            # so every call judges it against the stream's peak instead
+            peak = float(np.abs(samples - samples.mean()).max()) if len(samples) else 0.0
+            reference = self.reference_peak or self.peak
+            threshold = self.silence_threshold * reference / peak if peak > 0 and reference > 0 else \
+                self.silence_threshold
+            result = snd.to_pitch_ac(silence_threshold=threshold, **self.args["pitch"])
+            values = pitch_samples(result)
+        elif analysis == "formant":
+            result = snd.to_formant_burg(**self.args["formant"])
+            values = np.vstack([formant_samples(f, result) for f in FORMANT_NUMBERS])
+        else:
+            result = snd.to_intensity(**self.args["intensity"])
+            values = intensity_samples(result)
+
+        # place the frames on the lattice; they are within half a sample of it
+        frames = np.rint(np.asarray(result.xs()) / self.time_step).astype(int)
+        keep = (frames >= first) & (frames <= last)
+        out = np.full(values.shape[:-1] + (last - first + 1,), np.nan)
+        out[..., frames[keep] - first] = values[..., keep]
+        return self.time_step * np.arange(first, last + 1), out
+
+    def push(self, block) -> dict:
+        """
+        Adds a block of audio and analyses every frame it completes
+        :param block: samples, 1-d or channels x samples (channels are averaged)
+        :return: dict of "pitch", "formant" and "intensity" -> (times, values) of the new frames, in the layout of
+                    StreamingAnalysis.iter_blocks; "events" -> list of JND events, see JndTracker.update; and
+                    "latency" -> seconds taken to process the block
+        """
+        start = time.perf_counter()
+        block = np.asarray(block, dtype=float)
+        if block.ndim > 1:
+            block = block.mean(axis=0)
+        if len(block):
+            self.peak = max(self.peak, float(np.abs(block).max()))
+        self.buffer.grow(self.frame_samples + len(block))
+        self.buffer.write(block)
+
+        result = {"events": []}
+        for analysis in self.windows:
+            self._emit(result, analysis, self._ready(analysis))
+        return self._finish(result, start)
+
+    def flush(self) -> dict:
+        """
+        Analyses the frames left at the end of the stream: those whose window has been received but whose audio
+        with context and margins has not. The missing margin is filled with silence, which no frame's window
+        reaches. Call once, after the last push.
+        :return: the same as push
+        """
+        start = time.perf_counter()
+        received = self.buffer.written
+        result = {"events": []}
+        for analysis, window in self.windows.items():
+            # the frames whole-file analysis has: every window ends within the stream
+            last = math.floor((received * self.dx - 0.5 * window) / self.time_step)
+            if last >= self.next_frame[analysis]:
+                missing = self._segment(analysis, self.next_frame[analysis], last)[1] - self.buffer.written
+                if missing > 0:
+                    self.buffer.grow(self.frame_samples + missing)
+                    self.buffer.write(np.zeros(missing))
+            self._emit(result, analysis, last)
+        return self._finish(result, start)
+
+    def _emit(self, result: dict, analysis: str, last: int):
+        """
+        Analyses the frames of one analysis up to last, adding them and their JND events to result
+        """
+        first = self.next_frame[analysis]
+        if last < first:
+            result[analysis] = (np.empty(0), np.empty((4, 0)) if analysis == "formant" else np.empty(0))
+            return
+        times, values = self._analyse(analysis, first, last)
+        self.next_frame[analysis] = last + 1
+        result[analysis] = (times, values)
+        if analysis == "pitch":
+            result["events"] += self.trackers["F0"].update(times, values)
+        elif analysis == "formant":
+            for number, row in zip(FORMANT_NUMBERS, values):
+                result["events"] += self.trackers[f"F{number}"].update(times, row)
+        else:
+            result["events"] += self.trackers["intensity"].update(times, values)
+
+    def _finish(self, result: dict, start: float) -> dict:
+        result["events"].sort()
+        result["latency"] = time.perf_counter() - start
+        self.latencies.append(result["latency"])
+        return result
+
+    def delays(self) -> dict[str, float]:
+        """
+        :return: for each analysis, how long after a frame's time the audio it needs has arrived, in seconds,
+                    not counting block size or processing time
+        """
+        return {name: 0.5 * window + (self.margin + 1) * self.dx for name, window in self.windows.items()}
+
+    def stats(self) -> dict[str, float]:
+        """
+        :return: "blocks", and the "mean", "p50", "p99" and "max" processing latency per block in seconds
+        """
+        latencies = np.array(self.latencies)
+        if not len(latencies):
+            return {"blocks": 0}
+        return {"blocks": len(latencies), "mean": float(latencies.mean()), "p50": float(np.percentile(latencies, 50)),
+                "p99": float(np.percentile(latencies, 99)), "max": float(latencies.max())}
+
+
+def play_file(filename: str, block_duration: float = 0.01, realtime: bool = True):
+    """
+    Reads a file block by block, as a capture device would deliver it
+    :param filename: path to a .wav file
+    :param block_duration: length of each block in seconds
+    :param realtime: wait until each block would have been recorded before yielding it
+    :return: generator of channels x samples blocks
+    """
+    with MappedWav(filename) as reader:
+        block_samples = max(1, round(block_duration * reader.sampling_frequency))
+        start_time = time.perf_counter()
+        for start in range(0, reader.n_samples, block_samples):
+            stop = min(start + block_samples, reader.n_samples)
+            if realtime:
+                wait = stop * reader.dx - (time.perf_counter() - start_time)
+                if wait > 0:
+                    time.sleep(wait)
+            yield reader.read(start, stop)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyse a recording block by block as if it were live audio, "
+                                                 "printing JND rising/falling events as they happen.")
+    parser.add_argument("sound", help=".wav file to play back")
+    parser.add_argument("--block", type=float, default=0.01, help="block length in seconds (default: 0.01)")
+    parser.add_argument("--time-step", type=float, default=0.01, help="analysis time step (default: 0.01)")
+    parser.add_argument("--fast", action="store_true", help="push blocks as fast as possible instead of in real time")
+    args = parser.parse_args(argv)
+
+    with MappedWav(args.sound) as reader:
+        sampling_frequency, duration = reader.sampling_frequency, reader.duration
+    analyser = LiveAnalyser(sampling_frequency, time_step=args.time_step)
+    frames = 0
+    start = time.perf_counter()
+    def results():
+        for block in play_file(args.sound, args.block, realtime=not args.fast):
+            yield analyser.push(block)
+        yield analyser.flush()
+
+    for result in results():
+        frames += len(result["pitch"][0])
+        for t, track, direction, change, since in result["events"]:
+            print(f"{t:8.2f} s  {track:<9} {direction:<7} {change:+8.1f} since {since:.2f} s")
+    elapsed = time.perf_counter() - start
+
+    stats = analyser.stats()
+    busy = sum(analyser.latencies)
+    print(f"{frames} frames in {stats['blocks']} blocks of {args.block * 1000:.0f} ms; "
+          f"processing {busy:.2f} s for {duration:.2f} s of audio ({busy / duration:.2f} x real time), "
+          f"wall {elapsed:.2f} s", file=sys.stderr)
+    print(f"latency per block: mean {stats['mean'] * 1000:.2f} ms, p50 {stats['p50'] * 1000:.2f} ms, "
+          f"p99 {stats['p99'] * 1000:.2f} ms, max {stats['max'] * 1000:.2f} ms", file=sys.stderr)
+    print("window delays: " + ", ".join(f"{name} {delay * 1000:.0f} ms" for name, delay in analyser.delays().items()),
+          file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
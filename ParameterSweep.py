@@ -0,0 +1,262 @@
+##      ParameterSweep.py
+##
+##      Description: runs every combination of a grid of analysis settings
+##          over a set of recordings and tabulates how stable each resulting
+##          track is and how long it took, to choose pitch and formant
+##          settings on evidence. The scripts use time steps from 0.001 to
+##          0.05 s, window lengths of 0.025 and 0.032169 s, pitch ceilings of
+##          300 and 500 Hz, and to_pitch as well as to_pitch_ac; DEFAULT_SWEEPS
+##          covers those.
+##
+##          Every recording is read once and shared with the AnalysisSession
+##          worker pool; each run analyses it in a worker and sends back only
+##          its statistics. Tracks are compared on one STABILITY_STEP grid,
+##          so runs with different time steps are measured alike:
+##              defined         fraction of grid frames with a value
+##              median change   median absolute change between neighbouring
+##                              defined frames
+##              jumps           fraction of those changes larger than the
+##                              track's JND (IntervalReports.JNDS)
+##              breaks/s        times per second the track stops being defined
+##
+##          usage: python ParameterSweep.py <sources ...> [--sweep "METHOD NAME=VALUE,VALUE ..." ...]
+##                                          [-j JOBS] [-o SUMMARY] [--runs RUNS]
+##          e.g. --sweep "to_pitch_ac time_step=0.005,0.01 pitch_ceiling=300,500"
+##
+##      ©2023
+##
+
+import argparse
+import itertools
+import os
+import sys
+import time
+import parselmouth as pm
+import numpy as np
+from AnalysisSession import AnalysisSession, get_executor
+from IntervalReports import JNDS, UNITS
+from TimeGrid import TimeGrid
+from TrackExtraction import pitch_samples, formant_samples, FORMANT_NUMBERS
+
+PITCH_METHODS = ("to_pitch", "to_pitch_ac", "to_pitch_cc", "to_pitch_shs", "to_pitch_spinet")
+FORMANT_METHODS = ("to_formant_burg",)
+# (method, grid of keyword arguments) pairs swept when none are given
+DEFAULT_SWEEPS = (
+    ("to_pitch", {"time_step": [0.001, 0.01], "pitch_ceiling": [300.0, 500.0]}),
+    ("to_pitch_ac", {"time_step": [0.001, 0.01], "pitch_ceiling": [300.0, 500.0]}),
+    ("to_pitch_spinet", {"time_step": [0.01], "ceiling": [300.0, 500.0]}),
+    ("to_formant_burg", {"time_step": [0.001, 0.01], "window_length": [0.025, 0.032169],
+                         "maximum_formant": [5000.0, 5500.0]}),
+)
+# grid the tracks are resampled onto before they are measured, in seconds
+STABILITY_STEP = 0.01
+# recordings read and shared with the workers at a time, so the pool has the next file's runs queued
+FILES_IN_FLIGHT = 2
+
+RUN_COLUMNS = ("file", "method", "settings", "track", "seconds", "frames", "defined", "median_change", "jumps",
+               "breaks_per_s")
+
+
+def expand(method: str, grid: dict) -> list[tuple[str, dict]]:
+    """
+    :param method: a parselmouth Sound method from PITCH_METHODS or FORMANT_METHODS
+    :param grid: dict of keyword argument -> list of values
+    :return: (method, keyword arguments) for every combination of the values
+    """
+    if method not in PITCH_METHODS + FORMANT_METHODS:
+        raise ValueError(f"unknown method '{method}', expected one of {', '.join(PITCH_METHODS + FORMANT_METHODS)}")
+    names = list(grid)
+    return [(method, dict(zip(names, values))) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def parse_sweep(text: str) -> tuple[str, dict]:
+    """
+    :param text: a method followed by name=value,value,... pairs, e.g. "to_pitch time_step=0.001,0.01"
+    :return: (method, grid) for expand
+    """
+    method, *pairs = text.split()
+    grid = {}
+    for pair in pairs:
+        name, sep, values = pair.partition("=")
+        if not sep or not values:
+            raise ValueError(f"'{pair}' in sweep '{text}' is not name=value,value,...")
+        grid[name] = [_number(value) for value in values.split(",")]
+    return method, grid
+
+
+def _number(text: str):
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def settings_label(params: dict) -> str:
+    return " ".join(f"{name}={value}" for name, value in params.items())
+
+
+def track_stability(times, values, jnd: float) -> dict:
+    """
+    :param times: frame times of a track
+    :param values: its values, NaN where undefined
+    :param jnd: just noticeable difference of the track
+    :return: dict of the statistics described at the top, measured on the STABILITY_STEP grid, with the number
+                of changes they were taken from as "changes"
+    """
+    times = np.asarray(times, dtype=float)
+    if len(times) < 2:
+        return {"defined": 0.0, "median_change": np.nan, "jumps": np.nan, "breaks_per_s": 0.0, "changes": 0}
+    grid = TimeGrid(times[0], STABILITY_STEP, int(np.floor((times[-1] - times[0]) / STABILITY_STEP + 1e-9)) + 1)
+    resampled = grid.resample(times, values, "nearest")
+    defined = ~np.isnan(resampled)
+    both = defined[1:] & defined[:-1]
+    changes = np.abs(np.diff(resampled)[both])
+    breaks = np.count_nonzero(defined[:-1] & ~defined[1:])
+    return {"defined": float(defined.mean()),
+            "median_change": float(np.median(changes)) if len(changes) else np.nan,
+            "jumps": float(np.mean(changes > jnd)) if len(changes) else np.nan,
+            "breaks_per_s": breaks / (grid.n * STABILITY_STEP), "changes": len(changes)}
+
+
+def measure_run(sound: pm.Sound, method: str, params: dict) -> list[dict]:
+    """
+    Runs one analysis and measures its tracks; runs in an AnalysisSession worker
+    :return: one dict per track (F0, or F1-F4) with "track", "seconds", "frames" and the track_stability
+                statistics; "error" instead if the analysis failed
+    """
+    start = time.perf_counter()
+    try:
+        result = getattr(sound, method)(**params)
+    except Exception as e:
+        return [{"track": "F0" if method in PITCH_METHODS else "F1-F4", "error": f"{type(e).__name__}: {e}"}]
+    seconds = time.perf_counter() - start
+    if method in PITCH_METHODS:
+        tracks = {"F0": pitch_samples(result)}
+    else:
+        tracks = {f"F{number}": formant_samples(number, result) for number in FORMANT_NUMBERS}
+    times = result.xs()
+    return [{"track": name, "seconds": seconds, "frames": len(times), **track_stability(times, values, JNDS[name])}
+            for name, values in tracks.items()]
+
+
+def run_sweep(filenames: list[str], runs: list[tuple[str, dict]], executor=AnalysisSession._USE_DEFAULT):
+    """
+    Runs every (method, params) of runs over every file, reading each file once
+    :param filenames: paths to sound files
+    :param runs: from expand
+    :param executor: process pool for the runs, None for this process; defaults to the AnalysisSession pool
+    :return: generator of row dicts with RUN_COLUMNS (or "error"), yielded a file at a time
+    """
+    executor = get_executor() if executor is AnalysisSession._USE_DEFAULT else executor
+    in_flight = []
+
+    def finish(filename, session, futures):
+        with session:
+            for (method, params), future in zip(runs, futures):
+                for row in future.result():
+                    yield {"file": filename, "method": method, "settings": settings_label(params), **row}
+
+    for filename in filenames:
+        session = AnalysisSession(pm.Sound(filename), executor)
+        in_flight.append((filename, session, [session.apply(measure_run, method, params)
+                                              for method, params in runs]))
+        if len(in_flight) >= FILES_IN_FLIGHT:
+            yield from finish(*in_flight.pop(0))
+    for job in in_flight:
+        yield from finish(*job)
+
+
+def summarise(rows: list[dict]) -> list[dict]:
+    """
+    :param rows: from run_sweep
+    :return: one row per method, settings and track over all files: total seconds, and the statistics averaged
+                over the files (weighted by frames, or by changes for median change and jumps), most defined first
+    """
+    groups = {}
+    for row in rows:
+        if "error" not in row:
+            groups.setdefault((row["method"], row["settings"], row["track"]), []).append(row)
+    summary = []
+    for (method, settings, track), group in groups.items():
+        frames = np.array([row["frames"] for row in group], dtype=float)
+        changes = np.array([row["changes"] for row in group], dtype=float)
+        out = {"method": method, "settings": settings, "track": track, "files": len(group),
+               "seconds": sum(row["seconds"] for row in group), "frames": int(frames.sum())}
+        for name, weights in (("defined", frames), ("breaks_per_s", frames), ("median_change", changes),
+                              ("jumps", changes)):
+            values = np.array([row[name] for row in group], dtype=float)
+            ok = ~np.isnan(values) & (weights > 0)
+            out[name] = float(np.average(values[ok], weights=weights[ok])) if ok.any() else np.nan
+        summary.append(out)
+    summary.sort(key=lambda row: (row["track"], -row["defined"], np.nan_to_num(row["jumps"], nan=np.inf)))
+    return summary
+
+
+def format_table(summary: list[dict]) -> str:
+    """
+    :return: the summary as tab-separated text
+    """
+    lines = ["\t".join(["track", "method", "settings", "files", "seconds", "frames", "defined",
+                        "median change", "jumps", "breaks/s"])]
+    for row in summary:
+        lines.append("\t".join([row["track"], row["method"], row["settings"], str(row["files"]),
+                                f"{row['seconds']:.3f}", str(row["frames"]), f"{row['defined']:.3f}",
+                                f"{row['median_change']:.1f} {UNITS[row['track']]}", f"{row['jumps']:.3f}",
+                                f"{row['breaks_per_s']:.2f}"]))
+    return "\n".join(lines) + "\n"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run every combination of pitch and formant analysis settings "
+                                                 "over recordings and tabulate track stability and runtime.")
+    parser.add_argument("sources", nargs="+", help="sound files or directories of .wav files")
+    parser.add_argument("--sweep", action="append", default=[], metavar="SWEEP",
+                        help='a method and its grid, e.g. "to_pitch time_step=0.001,0.01 pitch_ceiling=300,500"; '
+                             'may be repeated (default: DEFAULT_SWEEPS)')
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="worker processes (default: ANALYSIS_WORKERS or the number of cores)")
+    parser.add_argument("-o", "--output", default=None, help="also write the summary to this file")
+    parser.add_argument("--runs", default=None, help="write every file's statistics to this file")
+    args = parser.parse_args(argv)
+
+    if args.jobs:
+        os.environ["ANALYSIS_WORKERS"] = str(args.jobs)
+    filenames = []
+    for source in args.sources:
+        if os.path.isdir(source):
+            filenames += sorted(os.path.join(folder, name) for folder, _, files in os.walk(source)
+                                for name in files if name.lower().endswith(".wav"))
+        else:
+            filenames.append(source)
+    if not filenames:
+        print("no .wav files found", file=sys.stderr)
+        return 1
+    sweeps = [parse_sweep(text) for text in args.sweep] or DEFAULT_SWEEPS
+    runs = [run for method, grid in sweeps for run in expand(method, grid)]
+
+    start = time.perf_counter()
+    rows = []
+    failed = 0
+    for row in run_sweep(filenames, runs):
+        rows.append(row)
+        if "error" in row:
+            failed += 1
+            print(f"FAILED {row['file']} {row['method']} {row['settings']}: {row['error']}", file=sys.stderr)
+    print(f"{len(runs)} settings x {len(filenames)} files in {time.perf_counter() - start:.2f} s", file=sys.stderr)
+
+    table = format_table(summarise(rows))
+    print(table, end="")
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as f:
+            f.write(table)
+    if args.runs:
+        with open(args.runs, "w", encoding="utf8") as f:
+            f.write("\t".join(RUN_COLUMNS) + "\n")
+            for row in rows:
+                if "error" not in row:
+                    f.write("\t".join(str(row[column]) for column in RUN_COLUMNS) + "\n")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
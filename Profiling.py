@@ -0,0 +1,262 @@
+##      Profiling.py
+##
+##      Description: opt-in instrumentation of the pipeline stages. Functions
+##          decorated with @profiled, and blocks wrapped in stage(), record
+##          their wall time, CPU time, the process's peak RSS, frame counts
+##          and chosen parameters as one JSON line per call. Set
+##          ANALYSIS_PROFILE to a .jsonl file (or call enable) to turn it on;
+##          worker processes inherit the setting and append to the same file.
+##          When it is off, a profiled call costs one extra function call and
+##          a global lookup.
+##
+##          usage: python Profiling.py <profile.jsonl> [--chrome TRACE.json]
+##              prints the time per stage, and converts the profile to the
+##              Chrome trace format (chrome://tracing, Perfetto) if asked
+##
+##      ©2023
+##
+
+import argparse
+import collections
+import functools
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# open file descriptor of the profile, None when profiling is off
+_fd = None
+_path = None
+_local = threading.local()
+
+
+def enable(path: str):
+    """
+    Starts recording stages, appending to path as JSON lines
+    :param path: the profile file; created if missing
+    """
+    global _fd, _path
+    disable()
+    _fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    _path = path
+    os.environ["ANALYSIS_PROFILE"] = path  # so worker processes started later record too
+
+
+def disable():
+    """
+    Stops recording
+    """
+    global _fd, _path
+    if _fd is not None:
+        os.close(_fd)
+    _fd = _path = None
+    os.environ.pop("ANALYSIS_PROFILE", None)
+
+
+def is_enabled() -> bool:
+    return _fd is not None
+
+
+def _peak_rss() -> int:
+    """
+    :return: the most memory this process has had resident so far, in bytes, or None where unavailable
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _jsonable(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if hasattr(value, "item") and getattr(value, "ndim", 1) == 0:  # NumPy scalars
+        return value.item()
+    text = repr(value)
+    return text if len(text) <= 80 else text[:77] + "..."
+
+
+class _Stage:
+    """
+    One timed stage. Stages nest per thread; each records the name of the stage it ran inside.
+    """
+
+    def __init__(self, name: str, fields: dict):
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1].name if stack else None
+        self.depth = len(stack)
+        stack.append(self)
+        self.start = time.time()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        _local.stack.pop()
+        fd = _fd
+        if fd is None:  # disabled while the stage ran
+            return False
+        event = {"name": self.name, "start": self.start, "wall": wall, "cpu": cpu, "peak_rss": _peak_rss(),
+                 "pid": os.getpid(), "tid": threading.get_ident(), "depth": self.depth, "parent": self.parent}
+        if self.fields:
+            event["params"] = self.fields
+        if exc_type is not None:
+            event["error"] = exc_type.__name__
+        # one write per line, so lines from several processes appending at once don't interleave
+        os.write(fd, (json.dumps(event) + "\n").encode("utf8"))
+        return False
+
+
+class _NullStage:
+    """
+    Stand-in for _Stage when profiling is off
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name: str, **params):
+    """
+    Times a block: with stage("log10", frames=n): ...
+    :param name: stage name
+    :param params: parameters to record with it
+    :return: a context manager
+    """
+    if _fd is None:
+        return _NULL_STAGE
+    return _Stage(name, {key: _jsonable(value) for key, value in params.items()})
+
+
+def annotate(**fields):
+    """
+    Adds fields (e.g. frames=n) to the innermost running stage of this thread
+    """
+    if _fd is None:
+        return
+    stack = getattr(_local, "stack", None)
+    if stack:
+        stack[-1].fields.update({key: _jsonable(value) for key, value in fields.items()})
+
+
+def profiled(name: str = None, params: tuple = (), frames=None):
+    """
+    Decorator recording every call of a function as a stage
+    :param name: stage name, defaults to the function's name
+    :param params: names of the function's arguments to record
+    :param frames: function taking the return value and returning the number of frames it holds
+    """
+    def decorate(fn):
+        stage_name = name or fn.__name__
+        signature = inspect.signature(fn) if params else None
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _fd is None:
+                return fn(*args, **kwargs)
+            fields = {}
+            if signature is not None:
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                fields = {p: _jsonable(bound.arguments[p]) for p in params if p in bound.arguments}
+            with _Stage(stage_name, fields) as record:
+                result = fn(*args, **kwargs)
+                if frames is not None:
+                    record.fields["frames"] = _jsonable(frames(result))
+                return result
+        return wrapper
+    return decorate
+
+
+def load_events(path: str) -> list[dict]:
+    """
+    :return: the recorded stages in a profile, skipping any line cut short by a crash
+    """
+    events = []
+    with open(path, encoding="utf8") as f:
+        for line in f:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                continue
+    return events
+
+
+def summarise(events: list[dict]) -> list[dict]:
+    """
+    :return: per stage name: calls, total and mean wall time, total CPU time, frames and highest peak RSS,
+                slowest total first
+    """
+    stages = collections.defaultdict(lambda: {"calls": 0, "wall": 0.0, "cpu": 0.0, "frames": 0, "peak_rss": 0})
+    for event in events:
+        s = stages[event["name"]]
+        s["calls"] += 1
+        s["wall"] += event["wall"]
+        s["cpu"] += event["cpu"]
+        s["frames"] += (event.get("params") or {}).get("frames") or 0
+        s["peak_rss"] = max(s["peak_rss"], event.get("peak_rss") or 0)
+    rows = [{"name": name, **s, "mean_wall": s["wall"] / s["calls"]} for name, s in stages.items()]
+    return sorted(rows, key=lambda row: row["wall"], reverse=True)
+
+
+def to_chrome_trace(events: list[dict]) -> dict:
+    """
+    :return: the events in the Chrome trace event format, as complete ("X") events in microseconds
+    """
+    t0 = min((event["start"] for event in events), default=0.0)
+    trace = []
+    for event in events:
+        args = dict(event.get("params") or {})
+        args.update(cpu_ms=round(event["cpu"] * 1000, 3), peak_rss_mb=round((event.get("peak_rss") or 0) / 1e6, 1))
+        if "error" in event:
+            args["error"] = event["error"]
+        trace.append({"name": event["name"], "ph": "X", "ts": (event["start"] - t0) * 1e6,
+                      "dur": event["wall"] * 1e6, "pid": event["pid"], "tid": event["tid"], "args": args})
+    return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+
+if os.environ.get("ANALYSIS_PROFILE"):
+    enable(os.environ["ANALYSIS_PROFILE"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarise a profile recorded with ANALYSIS_PROFILE.")
+    parser.add_argument("profile", help="the .jsonl profile")
+    parser.add_argument("--chrome", default=None, help="also write the profile as a Chrome trace to this file")
+    args = parser.parse_args(argv)
+
+    events = load_events(args.profile)
+    print(f"{'stage':<28}{'calls':>7}{'wall s':>10}{'mean ms':>10}{'cpu s':>10}{'frames':>10}{'peak MB':>9}")
+    for row in summarise(events):
+        print(f"{row['name']:<28}{row['calls']:>7}{row['wall']:>10.3f}{row['mean_wall'] * 1000:>10.2f}"
+              f"{row['cpu']:>10.3f}{row['frames']:>10}{row['peak_rss'] / 1e6:>9.1f}")
+    if args.chrome:
+        with open(args.chrome, "w", encoding="utf8") as f:
+            json.dump(to_chrome_trace(events), f)
+        print(f"Chrome trace written to {args.chrome}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
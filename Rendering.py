@@ -0,0 +1,320 @@
+##      Rendering.py
+##
+##      Description: headless rendering of the project's plots for batch use.
+##          Figures are drawn on Agg canvases that never go through pyplot, so
+##          nothing accumulates in pyplot's figure list, and each kind of plot
+##          keeps one figure whose artists are updated with the next file's
+##          data rather than rebuilt. Spectrograms are drawn as one image
+##          raster instead of a pcolormesh with a cell per analysis frame,
+##          and only the displayed frequency band is converted to dB.
+##          matplotlib is imported when the first figure is made, so the
+##          spectrogram helpers cost nothing extra to import.
+##
+##      ©2023
+##
+
+import numpy as np
+from Profiling import profiled, stage
+from AnalysisFrames import clean_layout_arrays
+
+FORMANT_COLORS = ('r', '#FFA500', 'y', 'g', 'b')
+FORMANT_LABELS = ('Pitch', 'F1', 'F2', 'F3', 'F4')
+
+
+# top of the band drawn under the pitch and formant tracks, in Hz
+VALUES_MAX_FREQUENCY = 5000
+# power that zero bins are raised to before taking the log, so they come out at about -379 dB instead of -inf
+POWER_FLOOR = float(np.finfo(np.float32).tiny)
+
+
+class SpectrogramBand:
+    """
+    A frequency band of a spectrogram in dB, as float32. Has the x_grid, y_grid, ymin and ymax of a
+    parselmouth.Spectrogram, so it can be drawn wherever one can.
+    """
+
+    def __init__(self, arrays: dict):
+        """
+        :param arrays: "db" (frequency bins x frames), "x_grid" and "y_grid" (cell edges), as from to_arrays
+        """
+        self.db = arrays["db"]
+        self._x_grid = arrays["x_grid"]
+        self._y_grid = arrays["y_grid"]
+        self.xmin, self.xmax = self._x_grid[0], self._x_grid[-1]
+        self.ymin, self.ymax = self._y_grid[0], self._y_grid[-1]
+
+    def to_arrays(self) -> dict:
+        return {"db": self.db, "x_grid": self._x_grid, "y_grid": self._y_grid}
+
+    def x_grid(self) -> np.ndarray:
+        return self._x_grid
+
+    def y_grid(self) -> np.ndarray:
+        return self._y_grid
+
+
+def _band_rows(y_grid: np.ndarray, min_frequency: float, max_frequency: float) -> slice:
+    """
+    :return: the rows whose cells overlap min_frequency to max_frequency
+    """
+    start = max(int(np.searchsorted(y_grid, min_frequency, side="right")) - 1, 0)
+    stop = max(int(np.searchsorted(y_grid, max_frequency, side="left")), start + 1)
+    return slice(start, min(stop, len(y_grid) - 1))
+
+
+@profiled(name="log10", frames=lambda result: result.db.shape[-1])
+def spectrogram_band(spectrogram, min_frequency: float = 0, max_frequency: float = None) -> SpectrogramBand:
+    """
+    Crops a spectrogram to a frequency band and converts only that band to dB
+    :param spectrogram: a parselmouth.Spectrogram, CachedSpectrogram or SpectrogramBand
+    :param min_frequency: bottom of the band in Hz
+    :param max_frequency: top of the band in Hz, None for the top of the spectrogram
+    :return: the band; a view when spectrogram is already a SpectrogramBand
+    """
+    y_grid = spectrogram.y_grid()
+    rows = _band_rows(y_grid, min_frequency, spectrogram.ymax if max_frequency is None else max_frequency)
+    y_grid = y_grid[rows.start:rows.stop + 1]
+    if isinstance(spectrogram, SpectrogramBand):
+        return SpectrogramBand({"db": spectrogram.db[rows], "x_grid": spectrogram.x_grid(), "y_grid": y_grid})
+    # float32 in place: one copy of the band, never of the whole matrix
+    db = spectrogram.values[rows].astype(np.float32)
+    np.maximum(db, POWER_FLOOR, out=db)
+    np.log10(db, out=db)
+    db *= 10
+    return SpectrogramBand({"db": db, "x_grid": spectrogram.x_grid(), "y_grid": y_grid})
+
+
+def spectrogram_db(spectrogram, dynamic_range: float = 70) -> tuple[np.ndarray, float, float]:
+    """
+    :param spectrogram: a parselmouth.Spectrogram, CachedSpectrogram or SpectrogramBand
+    :param dynamic_range: dB below the maximum that are still shaded
+    :return: (power in dB, vmin, vmax) for drawing the spectrogram
+    """
+    if not isinstance(spectrogram, SpectrogramBand):
+        spectrogram = spectrogram_band(spectrogram)
+    vmax = float(np.max(spectrogram.db))
+    return spectrogram.db, vmax - dynamic_range, vmax
+
+
+def spectrogram_extent(spectrogram) -> tuple[float, float, float, float]:
+    """
+    :return: (left, right, bottom, top) of the spectrogram's cells, for imshow
+    """
+    x, y = spectrogram.x_grid(), spectrogram.y_grid()
+    return x[0], x[-1], y[0], y[-1]
+
+
+class FigureRenderer:
+    """
+    Saves plots to image files, reusing one figure per kind of plot. Not thread-safe; use one renderer per
+    process or thread.
+    """
+
+    def __init__(self, dpi: float = 100, png_compression: int = 1):
+        """
+        :param dpi: resolution of the saved images
+        :param png_compression: zlib level for PNG files, 0-9; encoding at the default of 6 takes longer than
+                                    drawing the plot
+        """
+        self.dpi = dpi
+        self.png_compression = png_compression
+        self.figures_saved = 0
+        self._figures = {}
+
+    def _figure(self, kind: str, figsize: tuple[float, float], build) -> tuple["Figure", dict]:
+        """
+        :param kind: name of the plot
+        :param figsize: size in inches the first time the figure is made
+        :param build: function taking the new figure and returning a dict of its reusable artists
+        :return: (figure, artists) for that kind of plot
+        """
+        if kind not in self._figures:
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            from matplotlib.figure import Figure
+            fig = Figure(figsize=figsize, dpi=self.dpi)
+            FigureCanvasAgg(fig)
+            self._figures[kind] = fig, build(fig)
+        return self._figures[kind]
+
+    def _save(self, fig: "Figure", out_file: str) -> str:
+        with stage("savefig", out_file=out_file):
+            if out_file.lower().endswith(".png"):
+                fig.savefig(out_file, pil_kwargs={'compress_level': self.png_compression})
+            else:
+                fig.savefig(out_file)
+        self.figures_saved += 1
+        return out_file
+
+    def close(self):
+        """
+        Drops every kept figure
+        """
+        self._figures.clear()
+
+    def waveform(self, times: np.ndarray, samples: np.ndarray, out_file: str, xlim: tuple = None) -> str:
+        """
+        :param times: sample times
+        :param samples: channels x samples array
+        :param out_file: image file to write
+        :param xlim: time axis limits, defaults to the first and last sample times
+        :return: out_file
+        """
+        def build(fig):
+            ax = fig.add_subplot()
+            ax.set_xlabel("time [s]")
+            ax.set_ylabel("amplitude")
+            return {'ax': ax, 'lines': []}
+
+        fig, artists = self._figure('waveform', (12.8, 7.2), build)
+        ax, lines = artists['ax'], artists['lines']
+        samples = np.atleast_2d(samples)
+        while len(lines) > len(samples):
+            lines.pop().remove()
+        while len(lines) < len(samples):
+            lines.append(ax.plot([], [])[0])
+        for line, channel in zip(lines, samples):
+            line.set_data(times, channel)
+        ax.relim()
+        ax.autoscale_view(scalex=False)
+        ax.set_xlim(xlim or (times[0], times[-1]))
+        return self._save(fig, out_file)
+
+    def spectrogram(self, spectrogram, out_file: str, dynamic_range: float = 70) -> str:
+        """
+        :param spectrogram: a parselmouth.Spectrogram, CachedSpectrogram or SpectrogramBand
+        :param out_file: image file to write
+        :param dynamic_range: dB below the maximum that are still shaded
+        :return: out_file
+        """
+        def build(fig):
+            ax = fig.add_subplot()
+            image = ax.imshow(np.zeros((1, 1)), cmap='binary', origin='lower', aspect='auto')
+            ax.set_xlabel("time [s]")
+            ax.set_ylabel("frequency [Hz]")
+            return {'ax': ax, 'image': image}
+
+        fig, artists = self._figure('spectrogram', (12.8, 7.2), build)
+        sg_db, vmin, vmax = spectrogram_db(spectrogram, dynamic_range)
+        extent = spectrogram_extent(spectrogram)
+        image = artists['image']
+        image.set_data(sg_db)
+        image.set_clim(vmin, vmax)
+        image.set_extent(extent)
+        artists['ax'].set_xlim(extent[0], extent[1])
+        artists['ax'].set_ylim(spectrogram.ymin, spectrogram.ymax)
+        return self._save(fig, out_file)
+
+    def values(self, values, spectrogram, out_file: str, dynamic_range: float = 70) -> str:
+        """
+        The FormantCleaning.draw_values plot: pitch and F1-F4 over the spectrogram, with intensity on a second axis
+        :param values: in the layout returned by FormantCleaning.clean_formants, or an AnalysisFrameSet
+        :param spectrogram: a parselmouth.Spectrogram, CachedSpectrogram or SpectrogramBand
+        :param out_file: image file to write
+        :param dynamic_range: dB below the maximum that are still shaded
+        :return: out_file
+        """
+        def build(fig):
+            ax = fig.add_subplot()
+            image = ax.imshow(np.zeros((1, 1)), cmap='binary', origin='lower', aspect='auto', alpha=0.7)
+            points = [ax.scatter([], [], label=label, color=color, linewidths=1)
+                      for label, color in zip(FORMANT_LABELS, FORMANT_COLORS)]
+            ax.set_xlabel("time [s]")
+            ax.set_ylabel("frequency [Hz]")
+            ax.legend(loc='upper left')
+            twin = ax.twinx()
+            twin.set_ylabel("intensity [dB]")
+            intensity = twin.plot([], [], label='Intensity')[0]
+            twin.legend(loc='upper right')
+            return {'ax': ax, 'image': image, 'points': points, 'twin': twin, 'intensity': intensity}
+
+        fig, artists = self._figure('values', (12.8, 7.2), build)
+        spectrogram = spectrogram_band(spectrogram, max_frequency=VALUES_MAX_FREQUENCY)
+        sg_db, vmin, vmax = spectrogram_db(spectrogram, dynamic_range)
+        extent = spectrogram_extent(spectrogram)
+        artists['image'].set_data(sg_db)
+        artists['image'].set_clim(vmin, vmax)
+        artists['image'].set_extent(extent)
+        tracks, times, intensity = clean_layout_arrays(values)
+        for points, track in zip(artists['points'], tracks):
+            points.set_offsets(np.column_stack([times, track]))
+        artists['ax'].set_xlim(extent[0], extent[1])
+        artists['ax'].set_ylim(spectrogram.ymin, VALUES_MAX_FREQUENCY)
+        artists['intensity'].set_data(times, intensity)
+        artists['twin'].relim()
+        artists['twin'].autoscale_view(scalex=False)
+        return self._save(fig, out_file)
+
+    def formant_plots(self, values: list, diffs: list, out_prefix: str = '') -> list[str]:
+        """
+        The Assignment_2.first_part_separate plots: each formant over time, with the background colored by the
+        frame-to-frame differences
+        :param values: list of (times, values) for F0-F4, in the form returned by get_formants
+        :param diffs: the differences from get_formant_differences
+        :param out_prefix: prepended to each output file name
+        :return: list of the saved file names
+        """
+        from matplotlib.colors import TwoSlopeNorm
+
+        def build(fig):
+            ax = fig.add_subplot()
+            line = ax.plot([], [])[0]
+            image = ax.imshow(np.zeros((1, 2)), cmap='seismic', aspect='auto', alpha=0.4,
+                              norm=TwoSlopeNorm(0, -1, 1), interpolation='none')
+            colorbar = fig.colorbar(image, ax=ax)
+            ax.set_xlabel('Time (s)')
+            ax.set_ylabel('Frequency (Hz)')
+            return {'ax': ax, 'line': line, 'image': image, 'colorbar': colorbar}
+
+        fig, artists = self._figure('formant', (11, 9), build)
+        ax, image = artists['ax'], artists['image']
+        saved = []
+        for f_n, ((f_times, f_vals), (_, f_diffs)) in enumerate(zip(values, diffs)):
+            y_max = np.nanmax(f_vals) * 1.20  # 20% higher than the data to give space at the top
+            color_matrix = np.array(f_diffs, dtype=float).reshape(1, len(f_diffs))
+            norm = TwoSlopeNorm(0)
+            norm.autoscale_None(color_matrix)
+            artists['line'].set_data(f_times, f_vals)
+            image.set_data(color_matrix)
+            image.set_norm(norm)
+            image.set_extent((f_times[0], f_times[-1], -1, y_max))
+            artists['colorbar'].update_normal(image)
+            ax.set_title(f'F{f_n}')
+            ax.set_xlim(f_times[0], f_times[-1])
+            ax.set_ylim(0, y_max)
+            saved.append(self._save(fig, f'{out_prefix}formant_{f_n}_plot.png'))
+        return saved
+
+
+_default_renderer = None
+
+
+def get_renderer() -> FigureRenderer:
+    """
+    :return: the process-wide renderer, so figures are reused across calls in one process
+    """
+    global _default_renderer
+    if _default_renderer is None:
+        _default_renderer = FigureRenderer()
+    return _default_renderer
+
+
+def main():
+    import time
+    from ExtractValues import loadSpectrogramBand, loadCleanFrames
+    from WavReader import MappedWav
+
+    inFile = "Thats One Small.wav"
+    renderer = get_renderer()
+    start = time.perf_counter()
+    for i in range(5):
+        with MappedWav(inFile) as wav:
+            renderer.waveform(wav.times(), wav.read(), f"render_{i}_waveform.png", xlim=(0, wav.duration))
+        sg = loadSpectrogramBand(inFile)
+        renderer.spectrogram(sg, f"render_{i}_spectrogram.png")
+        renderer.values(loadCleanFrames(inFile), sg, f"render_{i}_formants.png")
+    elapsed = time.perf_counter() - start
+    print(f"{renderer.figures_saved} figures in {elapsed:.2f} s ({renderer.figures_saved / elapsed:.2f} figures/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+##      Segmentation.py
+##
+##      Description: labels every track of a whole recording as rising,
+##          falling and flat runs against the just noticeable differences,
+##          where Assignment_2 only compares the first and last frames of a
+##          single interval. Tracks are cut into monotonic pieces with np.diff,
+##          the pieces are classified by their net change and merged into
+##          runs, all without a Python loop over frames. Each run is kept as
+##          (start, end, direction, delta), and the runs of many recordings
+##          are concatenated into one RunTable, so a query such as "all F2
+##          rises longer than 50 ms" is one pass over a few arrays.
+##
+##          usage: python Segmentation.py <sound.wav or directory> ... [--track F2] [--direction rising]
+##                     [--min-duration 0.05] [--min-delta HZ] [-o runs.npz]
+##
+##      ©2023
+##
+
+import argparse
+import os
+import sys
+import numpy as np
+from IntervalReports import TRACK_NAMES, JNDS, UNITS, analyse_tracks
+
+RISING, FLAT, FALLING = 1, 0, -1
+DIRECTION_NAMES = {RISING: "Rising", FLAT: "Flat", FALLING: "Falling"}
+
+# step label of a pair of frames that are not both defined
+_GAP = 2
+
+
+def _classify(delta: np.ndarray, jnd: float) -> np.ndarray:
+    return np.where(delta > jnd, RISING, np.where(delta < -jnd, FALLING, FLAT)).astype(np.int8)
+
+
+def _merge(first: np.ndarray, last: np.ndarray, direction: np.ndarray):
+    """
+    Joins neighbouring runs of the same direction that share a frame
+    :return: (first, last, direction) of the merged runs
+    """
+    if len(first) == 0:
+        return first, last, direction
+    joined = (direction[1:] == direction[:-1]) & (first[1:] == last[:-1])
+    heads = np.concatenate([[True], ~joined])
+    tails = np.concatenate([~joined, [True]])
+    return first[heads], last[tails], direction[heads]
+
+
+def segment_track(times, values, jnd: float) -> dict[str, np.ndarray]:
+    """
+    Splits one track into rising, falling and flat runs. A run rises (falls) when its net change is more than
+    the JND up (down); a reversal smaller than the JND between two rising (falling) stretches doesn't end the run.
+    Runs never span undefined frames, so unvoiced stretches are left out of every run.
+    :param times: frame times in seconds, ascending
+    :param values: frame values, NaN where undefined (convert the zeros of get_formants first)
+    :param jnd: just noticeable difference, in the track's unit
+    :return: dict of "start", "end" (times of the run's first and last frame), "direction" (RISING, FLAT or
+                FALLING) and "delta" (net change) arrays, one entry per run in time order
+    """
+    times = np.asarray(times, dtype=float)
+    values = np.asarray(values, dtype=float)
+    if len(values) < 2:
+        return {"start": np.empty(0), "end": np.empty(0), "direction": np.empty(0, np.int8),
+                "delta": np.empty(0, np.float32)}
+
+    # label each step between neighbouring frames by its sign, and run-length encode the labels
+    steps = np.diff(values)
+    with np.errstate(invalid="ignore"):
+        labels = np.where(np.isnan(steps), _GAP, np.sign(steps)).astype(np.int8)
+    boundaries = np.flatnonzero(labels[1:] != labels[:-1]) + 1
+    step_starts = np.concatenate([[0], boundaries])
+    step_ends = np.concatenate([boundaries, [len(labels)]])
+    monotonic = labels[step_starts] != _GAP
+    # frame indices of the monotonic pieces; neighbouring pieces share their boundary frame
+    first, last = step_starts[monotonic], step_ends[monotonic]
+    direction = _classify(values[last] - values[first], jnd)
+
+    # sub-JND pieces between two runs of the same direction are part of that run
+    if len(first) > 2:
+        joined = first[1:] == last[:-1]
+        bridged = ((direction[1:-1] == FLAT) & (direction[:-2] == direction[2:]) & (direction[:-2] != FLAT)
+                   & joined[:-1] & joined[1:])
+        direction[1:-1][bridged] = direction[:-2][bridged]
+    first, last, direction = _merge(first, last, direction)
+
+    # a stretch of small steps can still add up to more than the JND
+    flat = direction == FLAT
+    direction[flat] = _classify(values[last[flat]] - values[first[flat]], jnd)
+    first, last, direction = _merge(first, last, direction)
+
+    return {"start": times[first], "end": times[last], "direction": direction,
+            "delta": (values[last] - values[first]).astype(np.float32)}
+
+
+def segment_tracks(tracks: dict[str, tuple[np.ndarray, np.ndarray]], jnds: dict = None) -> \
+        dict[str, dict[str, np.ndarray]]:
+    """
+    :param tracks: dict of track name -> (times, values), e.g. from IntervalReports.analyse_tracks
+    :param jnds: dict of track name -> JND, defaults to IntervalReports.JNDS
+    :return: dict of track name -> runs, in the form returned by segment_track
+    """
+    jnds = {**JNDS, **(jnds or {})}
+    return {name: segment_track(times, values, jnds[name]) for name, (times, values) in tracks.items()}
+
+
+class RunTable:
+    """
+    The runs of any number of recordings and tracks in flat arrays, one entry per run
+    """
+
+    COLUMNS = ("recording", "track", "start", "end", "direction", "delta")
+
+    def __init__(self, recordings: list[str], columns: dict[str, np.ndarray]):
+        """
+        :param recordings: recording names; the "recording" column holds indices into it
+        :param columns: arrays for every name in COLUMNS; "track" holds indices into TRACK_NAMES
+        """
+        self.recordings = list(recordings)
+        self.recording = np.asarray(columns["recording"], dtype=np.int32)
+        self.track = np.asarray(columns["track"], dtype=np.int8)
+        self.start = np.asarray(columns["start"], dtype=float)
+        self.end = np.asarray(columns["end"], dtype=float)
+        self.direction = np.asarray(columns["direction"], dtype=np.int8)
+        self.delta = np.asarray(columns["delta"], dtype=np.float32)
+
+    @classmethod
+    def from_segments(cls, segments: dict[str, dict[str, dict[str, np.ndarray]]]) -> "RunTable":
+        """
+        :param segments: dict of recording name -> segment_tracks result
+        """
+        parts = {column: [] for column in cls.COLUMNS}
+        for number, tracks in enumerate(segments.values()):
+            for name, runs in tracks.items():
+                n = len(runs["start"])
+                parts["recording"].append(np.full(n, number, dtype=np.int32))
+                parts["track"].append(np.full(n, TRACK_NAMES.index(name), dtype=np.int8))
+                for column in ("start", "end", "direction", "delta"):
+                    parts[column].append(runs[column])
+        columns = {column: np.concatenate(arrays) if arrays else np.empty(0) for column, arrays in parts.items()}
+        return cls(list(segments), columns)
+
+    @classmethod
+    def from_files(cls, filenames: list[str], jnds: dict = None, **settings) -> "RunTable":
+        """
+        Segments every track of every recording; the analyses are read from the analysis cache when present
+        :param filenames: paths to .wav files
+        :param jnds: overrides for IntervalReports.JNDS
+        :param settings: overrides for IntervalReports.DEFAULT_SETTINGS
+        """
+        return cls.from_segments({filename: segment_tracks(analyse_tracks(filename, **settings), jnds)
+                                  for filename in filenames})
+
+    def __len__(self):
+        return len(self.start)
+
+    @property
+    def duration(self) -> np.ndarray:
+        return self.end - self.start
+
+    def select(self, mask: np.ndarray) -> "RunTable":
+        """
+        :return: a RunTable of the runs where mask is True
+        """
+        return RunTable(self.recordings, {column: getattr(self, column)[mask] for column in self.COLUMNS})
+
+    def query(self, track: str = None, direction: int = None, min_duration: float = 0.0, min_delta: float = 0.0,
+              recording: str = None) -> "RunTable":
+        """
+        Finds runs in one pass over the table, e.g. query("F2", RISING, min_duration=0.05)
+        :param track: track name from TRACK_NAMES, None for all
+        :param direction: RISING, FLAT or FALLING, None for all
+        :param min_duration: shortest run to keep, in seconds
+        :param min_delta: smallest absolute net change to keep
+        :param recording: recording name, None for all
+        :return: the matching runs
+        """
+        mask = self.end - self.start >= min_duration
+        if min_delta:
+            mask &= np.abs(self.delta) >= min_delta
+        if track is not None:
+            mask &= self.track == TRACK_NAMES.index(track)
+        if direction is not None:
+            mask &= self.direction == direction
+        if recording is not None:
+            mask &= self.recording == self.recordings.index(recording)
+        return self.select(mask)
+
+    def rows(self):
+        """
+        :return: generator of (recording, track, start, end, direction name, delta) per run
+        """
+        for i in range(len(self)):
+            yield (self.recordings[self.recording[i]], TRACK_NAMES[self.track[i]], float(self.start[i]),
+                   float(self.end[i]), DIRECTION_NAMES[int(self.direction[i])], float(self.delta[i]))
+
+    def save(self, path: str):
+        """
+        Saves the table as a .npz file
+        """
+        np.savez(path, recordings=np.array(self.recordings, dtype=str),
+                 **{column: getattr(self, column) for column in self.COLUMNS})
+
+    @classmethod
+    def load(cls, path: str) -> "RunTable":
+        with np.load(path) as data:
+            return cls(data["recordings"].tolist(), {column: data[column] for column in cls.COLUMNS})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Segment recordings into rising, falling and flat runs of pitch, "
+                                                 "formants and intensity, and list the runs that match a query.")
+    parser.add_argument("sources", nargs="+", help=".wav files or directories of them")
+    parser.add_argument("--track", choices=TRACK_NAMES, default=None, help="only runs of this track")
+    parser.add_argument("--direction", choices=("rising", "falling", "flat"), default=None)
+    parser.add_argument("--min-duration", type=float, default=0.0, help="shortest run to list, in seconds")
+    parser.add_argument("--min-delta", type=float, default=0.0, help="smallest absolute net change to list")
+    parser.add_argument("-o", "--output", default=None, help="also save all runs to this .npz file")
+    args = parser.parse_args(argv)
+
+    filenames = []
+    for source in args.sources:
+        if os.path.isdir(source):
+            filenames += sorted(os.path.join(folder, name) for folder, _, files in os.walk(source)
+                                for name in files if name.lower().endswith(".wav"))
+        else:
+            filenames.append(source)
+    if not filenames:
+        print("no .wav files found", file=sys.stderr)
+        return 1
+
+    table = RunTable.from_files(filenames)
+    if args.output:
+        table.save(args.output)
+    direction = {"rising": RISING, "falling": FALLING, "flat": FLAT}.get(args.direction)
+    matches = table.query(args.track, direction, args.min_duration, args.min_delta)
+    print("recording\ttrack\tstart\tend\tdirection\tdelta")
+    for recording, track, start, end, name, delta in matches.rows():
+        print(f"{recording}\t{track}\t{start:.3f}\t{end:.3f}\t{name}\t{delta:.1f} {UNITS[track]}")
+    print(f"{len(matches)} of {len(table)} runs in {len(filenames)} files", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
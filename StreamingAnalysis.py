@@ -0,0 +1,574 @@
+##      StreamingAnalysis.py
+##
+##      Description: block-wise pitch, formant and intensity analysis for
+##          recordings too long to load and analyse in one piece. The file is
+##          read in overlapping blocks, each block is analysed on its own with
+##          enough padding for the analysis windows, and the frames from the
+##          middle of each block are stitched into whole-file tracks.
+##
+##          Praat centres its analysis frames on the sound, so a block only
+##          lands on the whole-file frame grid if it is cut a whole number of
+##          time steps from the start (or from the end) of the file, and a
+##          whole number of samples. Blocks are cut on that lattice, which
+##          makes every stitched frame time identical to whole-file analysis.
+##
+##          to_formant_burg first resamples its sound to twice the maximum
+##          formant, and resampling is not local: a block resampled on its
+##          own differs from the same stretch of the resampled file, by
+##          kilohertz in some formant frames. So the file is resampled once,
+##          as to_formant_burg would resample it, into a temporary file, and
+##          Burg runs on blocks of that, which it uses as they are. Where the
+##          frames fall exactly on resampled samples, which side of a sample
+##          a frame's window starts on is decided by rounding in Praat, and
+##          burg_frames works out that choice for the whole file so that the
+##          blocks can make the same one. Up to RESAMPLE_WHOLE_SAMPLES per
+##          channel the stitched formants are then identical to whole-file
+##          analysis. Praat filters the whole file in one FFT to resample it,
+##          which longer files don't fit in memory for, so those are
+##          resampled in chunks overlapping by RESAMPLE_OVERLAP seconds; the
+##          result differs from Praat's by about 1e-6 of the signal's peak,
+##          which Burg turns into large differences in some frames. On a
+##          300 s field recording resampled this way 7% of the frames have a
+##          formant more than 1 Hz off, by at most 1690 Hz, and 3 of the
+##          120000 values are defined in only one of the two; of the frames
+##          above 55 dB, 0.34% are more than 1 Hz off, by at most 24 Hz.
+##
+##          The pitch of a block is judged against the whole file's peak,
+##          which is put into one padding sample of a copy of the block used
+##          only for pitch. Stitched pitch and intensity still differ from
+##          whole-file analysis in a few frames, by at most 0.17 Hz and
+##          0.026 dB on that recording at a 10 ms step, with the same frames
+##          voiced. At a 5 ms step and 44.1 kHz every other pitch frame falls
+##          on a sample, and on a 180 s recording 5 of 36000 frames were
+##          voiced in only one of the two (2 of the 15600 above 55 dB in
+##          analyse_loud, whose voiced frames were at most 3.2 Hz off).
+##
+##          analyse_loud runs the cheap intensity analysis over the whole file
+##          first and the pitch and formant analyses only on blocks around
+##          the frames loud enough to pass an intensity floor. On recordings
+##          that are mostly silence or background this skips most of the
+##          Burg and autocorrelation work. The frames that pass the floor get
+##          the values block-wise analysis gives them.
+##
+##          main compares both with whole-file analysis and prints, per
+##          track, the largest difference and the share of frames that
+##          differ by more than 1 Hz (0.1 dB for intensity).
+##
+##          usage: python StreamingAnalysis.py [sound.wav] [--floor DB] [--time-step SECONDS] [--block SECONDS]
+##
+##      ©2023
+##
+
+import argparse
+import math
+import tempfile
+import parselmouth as pm
+import numpy as np
+from TrackExtraction import (pitch_samples, formant_samples, intensity_samples, FORMANT_NUMBERS, FrameGrid,
+                             grid_intensity_track)
+from WavReader import MappedWav
+
+ANALYSES = ("pitch", "formant", "intensity")
+# files up to this many samples per channel (12.7 minutes at 44.1 kHz) are resampled for Burg in one piece, as
+# to_formant_burg does; Praat needs about 24 bytes per sample of the next power of two to do it
+RESAMPLE_WHOLE_SAMPLES = 1 << 25
+# samples resampled at a time from longer files, overlap included; Praat pads them by 2000 samples and rounds
+# up to a power of two, so this stays just under 1 << 22
+RESAMPLE_CHUNK_SAMPLES = (1 << 22) - 4096
+# seconds resampled and thrown away on each side of a chunk of a longer file, where the chunk's edges still
+# change the resampled signal
+RESAMPLE_OVERLAP = 10.0
+
+
+def frame_grid(duration: float, x1: float, dx: float, window_duration: float,
+               time_step: float) -> tuple[int, float]:
+    """
+    The frame layout of Praat's short-term analyses (Sampled_shortTermAnalysis): as many frames as fit the
+    window, centred on the sound
+    :param duration: duration of the analysed samples, number of samples * dx
+    :param x1: time of the first sample
+    :param dx: sampling period
+    :param window_duration: full length of the analysis window in seconds
+    :param time_step: time between frames
+    :return: (number of frames, time of the first frame)
+    """
+    n_frames = math.floor((duration - window_duration) / time_step) + 1
+    mid_time = x1 - 0.5 * dx + 0.5 * duration
+    return n_frames, mid_time - 0.5 * n_frames * time_step + 0.5 * time_step
+
+
+def burg_frames(x1: float, dx: float, nx: int, window_duration: float, time_step: float) -> tuple[float, np.ndarray]:
+    """
+    The frames to_formant_burg analyses a sound in, worked out in the same floating point arithmetic as Praat
+    (Sound_to_Formant_any), which places each frame's window from the sample just left of the frame's time
+    :param x1: time of the first sample of the (resampled) sound
+    :param dx: its sampling period
+    :param nx: its number of samples
+    :param window_duration: full length of the analysis window, twice the window_length argument
+    :param time_step: time between frames
+    :return: (time of the first frame, index of the sample left of each frame's time)
+    """
+    n_frames = math.floor((nx * dx - window_duration) / time_step) + 1
+    t1 = x1 + 0.5 * (nx * dx - dx - (n_frames - 1) * time_step)
+    return t1, np.floor((t1 + np.arange(n_frames) * time_step - x1) / dx).astype(np.int64)
+
+
+class StreamingAnalyser:
+    """
+    Analysis settings for one file, with the whole-file frame grids they produce. The analyses match
+    snd.to_pitch_ac, snd.to_formant_burg and snd.to_intensity called with the same parameters.
+    """
+
+    def __init__(self, filename: str, time_step: float = 0.01, pitch_floor: float = 75.0,
+                 pitch_ceiling: float = 600.0, max_number_of_formants: float = 5.0,
+                 maximum_formant: float = 5500.0, window_length: float = 0.025, pre_emphasis_from: float = 50.0,
+                 minimum_pitch: float = 100.0):
+        self.filename = filename
+        self.time_step = time_step
+        self.pitch_args = dict(time_step=time_step, pitch_floor=pitch_floor, pitch_ceiling=pitch_ceiling)
+        self.formant_args = dict(time_step=time_step, max_number_of_formants=max_number_of_formants,
+                                 maximum_formant=maximum_formant, window_length=window_length,
+                                 pre_emphasis_from=pre_emphasis_from)
+        self.intensity_args = dict(time_step=time_step, minimum_pitch=minimum_pitch)
+        self._peak = None
+        self._resampled = None
+        # the blocks the last analyse_loud analysed pitch and formants in
+        self.regions = []
+
+        with MappedWav(filename) as reader:
+            self.n_samples = reader.n_samples
+            self.sampling_frequency = reader.sampling_frequency
+        dx = 1.0 / self.sampling_frequency
+        duration = self.n_samples * dx
+        # window lengths used by Praat for each analysis
+        self.windows = {
+            "pitch": 3.0 / pitch_floor,
+            "formant": 2.0 * window_length,
+            "intensity": 6.4 / minimum_pitch,
+        }
+        # to_formant_burg resamples to twice the maximum formant first, centred on the original sound
+        resampled_rate = self.resampled_rate = 2.0 * maximum_formant
+        n_resampled = self.n_resampled = round(duration * resampled_rate)
+        self.resampled_x1 = 0.5 * (duration - (n_resampled - 1) / resampled_rate)
+        self._burg_frames = None
+        self.grids = {
+            "pitch": frame_grid(duration, 0.5 * dx, dx, self.windows["pitch"], time_step),
+            "formant": frame_grid(n_resampled / resampled_rate, self.resampled_x1, 1.0 / resampled_rate,
+                                  self.windows["formant"], time_step),
+            "intensity": frame_grid(duration, 0.5 * dx, dx, self.windows["intensity"], time_step),
+        }
+
+        # blocks must start and end a whole number of samples that is also a whole number of time steps
+        # from the file's edges; find the smallest such number of time steps
+        samples_per_step = time_step * self.sampling_frequency
+        for steps in range(1, 1001):
+            if abs(steps * samples_per_step - round(steps * samples_per_step)) < 1e-6:
+                self.cut_samples = round(steps * samples_per_step)
+                break
+        else:
+            raise ValueError(f"no block boundary falls on both the sample and frame grids for a {time_step} s step "
+                             f"at {self.sampling_frequency} Hz")
+        # the same for the resampled sound Burg analyses, in time steps
+        resampled_per_step = time_step * resampled_rate
+        for steps in range(1, 1001):
+            if abs(steps * resampled_per_step - round(steps * resampled_per_step)) < 1e-6:
+                self.resampled_cut_steps = steps
+                break
+        else:
+            raise ValueError(f"no block boundary falls on both the resampled and frame grids for a {time_step} s "
+                             f"step at {resampled_rate} Hz")
+
+    def times(self, analysis: str) -> np.ndarray:
+        """
+        :param analysis: 'pitch', 'formant' or 'intensity'
+        :return: the frame times whole-file analysis would produce
+        """
+        n_frames, t1 = self.grids[analysis]
+        return t1 + self.time_step * np.arange(n_frames)
+
+    def _pad(self, padding: float) -> int:
+        """
+        :return: samples read on each side of a block's kept frames: half the longest window plus padding
+        """
+        return math.ceil((0.5 * max(self.windows.values()) + padding) * self.sampling_frequency)
+
+    def _split(self, start: int, end: int, block_duration: float, pad: int) -> list[tuple[int, int, int, int]]:
+        """
+        Splits samples [start, end) into blocks of about block_duration, read with pad samples either side
+        :return: list of blocks in the form returned by blocks
+        """
+        cut = self.cut_samples
+        n = self.n_samples
+        core = max(cut, round(block_duration * self.sampling_frequency / cut) * cut)
+        edges = list(range(start, end, core)) + [end]
+        if len(edges) > 2 and edges[-1] - edges[-2] < pad:
+            del edges[-2]  # fold a short tail into the previous block
+        blocks = []
+        for core_start, core_end in zip(edges[:-1], edges[1:]):
+            read_start = max(0, (core_start - pad) // cut * cut)
+            from_end = max(0, (n - core_end - pad) // cut * cut)
+            blocks.append((core_start, core_end, read_start, n - from_end))
+        return blocks
+
+    def blocks(self, block_duration: float = 60.0, padding: float = 1.0):
+        """
+        Splits the file into analysis blocks on the cut lattice
+        :param block_duration: approximate length of the frames kept from each block in seconds
+        :param padding: extra audio analysed on each side of a block beyond half the longest window, so that
+                            edge effects (pitch path finding, resampling filters) die out before the kept frames
+        :return: list of (core_start, core_end, read_start, read_end) in samples; frames centred in
+                    [core_start, core_end) are kept from the block read from [read_start, read_end)
+        """
+        return self._split(0, self.n_samples, block_duration, self._pad(padding))
+
+    def loud_regions(self, loud_times: np.ndarray, margin: float = 0.05, block_duration: float = 60.0,
+                     padding: float = 1.0):
+        """
+        Blocks covering only the given frames. Stretches closer together than the audio read around a block are
+        joined, since analysing the gap costs less than reading the padding twice.
+        :param loud_times: times of the frames to analyse, in any order
+        :param margin: extra seconds kept on each side of every frame
+        :param block_duration: longest block in seconds, longer stretches are split
+        :param padding: extra audio analysed on each side of a block, see blocks
+        :return: list of blocks in the form returned by blocks
+        """
+        if len(loud_times) == 0:
+            return []
+        cut = self.cut_samples
+        n = self.n_samples
+        pad = self._pad(padding)
+        loud_times = np.sort(np.asarray(loud_times, dtype=float))
+        starts = np.clip(np.floor((loud_times - margin) * self.sampling_frequency / cut) * cut, 0, n).astype(np.int64)
+        ends = np.clip(np.ceil((loud_times + margin) * self.sampling_frequency / cut) * cut, 0, n).astype(np.int64)
+        # ends only grow with the sorted times, so a new stretch starts wherever the gap to the last end is too big
+        ends = np.maximum.accumulate(ends)
+        new = np.concatenate([[True], starts[1:] - ends[:-1] > 2 * pad])
+        stretch_starts = starts[new]
+        stretch_ends = ends[np.concatenate([np.flatnonzero(new)[1:] - 1, [len(ends) - 1]])]
+        blocks = []
+        for start, end in zip(stretch_starts.tolist(), stretch_ends.tolist()):
+            blocks += self._split(start, end, block_duration, pad)
+        return blocks
+
+    def peak(self, chunk_samples: int = 1 << 20) -> tuple[float, int]:
+        """
+        The file's absolute peak around its mean, which Praat's pitch analysis uses as the reference for its
+        silence threshold. Found with one streaming pass over the file.
+        :param chunk_samples: samples read at a time
+        :return: (peak, channel it is in)
+        """
+        if self._peak is None:
+            sums = maxima = minima = None
+            with MappedWav(self.filename) as reader:
+                for start in range(0, self.n_samples, chunk_samples):
+                    block = reader.read(start, min(start + chunk_samples, self.n_samples))
+                    if sums is None:
+                        sums, maxima, minima = block.sum(axis=1), block.max(axis=1), block.min(axis=1)
+                    else:
+                        sums += block.sum(axis=1)
+                        maxima = np.maximum(maxima, block.max(axis=1))
+                        minima = np.minimum(minima, block.min(axis=1))
+            means = sums / self.n_samples
+            peaks = np.maximum(maxima - means, means - minima)
+            self._peak = float(peaks.max()), int(peaks.argmax())
+        return self._peak
+
+    def _first_frame(self, analysis: str, x1: float) -> int:
+        """
+        :return: the whole-file index of a block's first frame, which is at x1
+        """
+        n_frames, t1 = self.grids[analysis]
+        first = round((x1 - t1) / self.time_step)
+        if abs(x1 - (t1 + first * self.time_step)) > 1e-6 * self.time_step:
+            raise RuntimeError(f"{analysis} block frames at {x1} s are off the whole-file grid")
+        return first
+
+    def _stitch(self, analysis: str, first: int, samples: np.ndarray, lo: float, hi: float):
+        """
+        :param first: whole-file index of the first of the block's frames, whose values are samples
+        :return: (first global frame index, times, values) of the block frames centred in [lo, hi)
+        """
+        n_frames, t1 = self.grids[analysis]
+        index = first + np.arange(samples.shape[-1])
+        times = t1 + self.time_step * index
+        keep = (times >= lo) & (times < hi) & (index >= 0) & (index < n_frames)
+        return first + int(np.argmax(keep)) if keep.any() else first, times[keep], samples[..., keep]
+
+    def iter_blocks(self, block_duration: float = 60.0, padding: float = 1.0, analyses=ANALYSES):
+        """
+        Analyses the file block by block; only one block of audio is in memory at a time
+        :param block_duration: approximate length of the frames kept from each block in seconds
+        :param padding: extra audio analysed on each side of a block, see blocks
+        :param analyses: the analyses to run, from ANALYSES
+        :return: generator of dicts, one per block, of analysis name -> (times, values) for the block's frames;
+                    pitch values are NaN where unvoiced, formant values are a 4 x n array of F1-F4
+        """
+        for block in self._analyse_blocks(self.blocks(block_duration, padding), analyses):
+            yield {name: (times, values) for name, (_, times, values) in block.items()}
+
+    def resampled(self) -> np.ndarray:
+        """
+        The file resampled to twice the maximum formant the way to_formant_burg resamples it, made on first use
+        and kept in a temporary file
+        :return: channels x samples memory-mapped array, sample j at resampled_x1 + j / resampled_rate seconds
+        """
+        if self._resampled is not None:
+            return self._resampled
+        with MappedWav(self.filename) as reader:
+            out = np.memmap(tempfile.TemporaryFile(), dtype=np.float64, mode="w+",
+                            shape=(reader.n_channels, self.n_resampled))
+            if self.n_samples <= RESAMPLE_WHOLE_SAMPLES:
+                out[:] = pm.Sound(reader.read(), sampling_frequency=self.sampling_frequency).resample(
+                    self.resampled_rate).values
+            else:
+                self._resample_chunks(reader, out)
+        self._resampled = out
+        return out
+
+    def _resample_chunks(self, reader: MappedWav, out: np.ndarray):
+        """
+        Resamples a long file chunk by chunk into out. A chunk starts a whole number of resampled samples from the
+        start of the file and ends a whole number from its end, so Sound.resample puts the chunk's samples exactly
+        on the whole file's resampled lattice; only the middle of each chunk, away from its edges, is kept.
+        """
+        rate, rate_r = self.sampling_frequency, self.resampled_rate
+        if rate != int(rate) or rate_r != int(rate_r):
+            raise ValueError(f"can't resample {self.filename} in chunks from {rate} Hz to {rate_r} Hz")
+        lattice = int(rate) // math.gcd(int(rate), int(rate_r))  # samples per whole number of resampled samples
+        per_lattice = lattice * rate_r / rate
+        n = self.n_samples
+        overlap = math.ceil(RESAMPLE_OVERLAP * rate / lattice) * lattice
+        core = max(lattice, (RESAMPLE_CHUNK_SAMPLES - 2 * overlap) // lattice * lattice)
+        for core_start in range(0, n, core):
+            core_end = min(n, core_start + core)
+            read_start = max(0, core_start - overlap)
+            read_end = n - max(0, (n - core_end - overlap) // lattice * lattice)
+            chunk = pm.Sound(reader.read(read_start, read_end), sampling_frequency=rate,
+                             start_time=read_start / rate).resample(rate_r)
+            first = round(read_start // lattice * per_lattice)  # resampled index of the chunk's first sample
+            keep_start = 0 if core_start == 0 else round(core_start / rate * rate_r) - first
+            keep_end = chunk.nx if core_end == n else round(core_end / rate * rate_r) - first
+            out[:, first + keep_start:first + keep_end] = chunk.values[:, keep_start:keep_end]
+
+    def _burg(self, start: int, end: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Runs to_formant_burg on samples [start, end) of resampled(); a sample before the first or after the last
+        is silent, which changes none of the frames whose windows lie inside the file
+        :return: (time of the first frame, index of the resampled sample left of each frame's time, 4 x n F1-F4
+                    values)
+        """
+        dx = 1.0 / self.resampled_rate
+        start_time = self.resampled_x1 + (start - 0.5) * dx
+        samples = np.asarray(self.resampled()[:, max(start, 0):min(end, self.n_resampled)])
+        if start < 0 or end > self.n_resampled:
+            samples = np.pad(samples, ((0, 0), (max(-start, 0), max(end - self.n_resampled, 0))))
+        block = pm.Sound(samples, sampling_frequency=self.resampled_rate, start_time=start_time)
+        formants = block.to_formant_burg(**self.formant_args)
+        _, left = burg_frames(start_time + 0.5 * dx, dx, end - start, self.windows["formant"], self.time_step)
+        return formants.x1, left + start, np.vstack([formant_samples(f, formants) for f in FORMANT_NUMBERS])
+
+    def _formant_block(self, read_start: int, read_end: int, lo: float, hi: float):
+        """
+        Burg formants of the frames centred in [lo, hi) from the stretch of resampled() covering samples
+        [read_start, read_end) of the file, cut on the lattice that keeps them on the whole-file grid.
+        When the frame times fall on resampled samples, rounding decides which side of the sample Praat starts a
+        frame's window, differently in the block than in the whole file; those frames are taken from the block
+        one sample longer or shorter, which moves its frames half a sample to either side (at the ends of the file
+        the longer ones reach a silent sample past it). When the block's duration less the window is a whole
+        number of time steps, rounding can also give it one frame more or fewer than the whole file, which moves
+        all its frames half a time step; then only the variants of the other length are on the grid.
+        :return: (first global frame index, times, values) as from _stitch
+        """
+        cut = self.resampled_cut_steps
+        per_step = self.time_step * self.resampled_rate
+        from_start = round(read_start / self.sampling_frequency / self.time_step) // cut * cut
+        from_end = round((self.n_samples - read_end) / self.sampling_frequency / self.time_step) // cut * cut
+        start = round(from_start * per_step)
+        end = self.n_resampled - round(from_end * per_step)
+
+        n_frames, t1 = self.grids["formant"]
+        dx = 1.0 / self.resampled_rate
+        variants = [(start, end), (start - 1, end), (start, end + 1), (start, end - 1), (start + 1, end)]
+        stitched = None
+        for variant_start, variant_end in variants:
+            x1, left, values = self._burg(variant_start, variant_end)
+            block_first = round((x1 - t1) / self.time_step)
+            if abs(x1 - (t1 + block_first * self.time_step)) > dx:
+                continue  # a frame more or fewer than the whole file: half a time step off the grid
+            if stitched is None:
+                stitched = self._stitch("formant", block_first, values, lo, hi)
+                first, times, kept = stitched
+                if len(times) == 0:
+                    return stitched
+                if self._burg_frames is None:
+                    self._burg_frames = burg_frames(self.resampled_x1, dx, self.n_resampled, self.windows["formant"],
+                                                    self.time_step)[1]
+                wanted = self._burg_frames[first:first + len(times)]
+                found = np.zeros(len(times), dtype=bool)
+            at = np.arange(first, first + len(times)) - block_first
+            inside = (at >= 0) & (at < len(left))
+            at = np.clip(at, 0, len(left) - 1)
+            fixed = ~found & inside & (left[at] == wanted)
+            kept[:, fixed] = values[:, at[fixed]]
+            found |= fixed
+            if found.all():
+                break
+        if stitched is None:
+            raise RuntimeError(f"formant block frames from resampled samples {start}-{end} are off the whole-file "
+                               f"grid")
+        return stitched
+
+    def _analyse_blocks(self, block_list: list, analyses):
+        """
+        :return: generator of dicts, one per block, of analysis name -> (first global frame index, times, values)
+        """
+        dx = 1.0 / self.sampling_frequency
+        whole_file = len(block_list) == 1 and block_list[0][2:] == (0, self.n_samples)
+        peak, peak_channel = self.peak() if "pitch" in analyses and not whole_file else (None, None)
+        with MappedWav(self.filename) as reader:
+            for core_start, core_end, read_start, read_end in block_list:
+                lo = -math.inf if core_start == 0 else core_start * dx
+                hi = math.inf if core_end == self.n_samples else core_end * dx
+                block = {}
+                if "pitch" in analyses or "intensity" in analyses:
+                    samples = reader.read(read_start, read_end)
+                    snd = pm.Sound(samples, sampling_frequency=self.sampling_frequency, start_time=read_start * dx)
+                if "intensity" in analyses:
+                    intensity = snd.to_intensity(**self.intensity_args)
+                    block["intensity"] = self._stitch("intensity", self._first_frame("intensity", intensity.x1),
+                                                      intensity_samples(intensity), lo, hi)
+                if "pitch" in analyses:
+                    if peak is not None:
+                        # give the block the file's peak in one padding sample, so pitch voicing is judged against
+                        # the same silence threshold as in whole-file analysis; snd keeps the samples as they were
+                        edge = -1 if read_start == 0 else 0
+                        samples[peak_channel, edge] = samples[peak_channel].mean() + peak
+                        snd = pm.Sound(samples, sampling_frequency=self.sampling_frequency,
+                                       start_time=read_start * dx)
+                    pitch = snd.to_pitch_ac(**self.pitch_args)
+                    block["pitch"] = self._stitch("pitch", self._first_frame("pitch", pitch.x1), pitch_samples(pitch),
+                                                  lo, hi)
+                if "formant" in analyses:
+                    block["formant"] = self._formant_block(read_start, read_end, lo, hi)
+                snd = samples = None
+                yield block
+
+    def analyse(self, block_duration: float = 60.0, padding: float = 1.0, analyses=ANALYSES) -> dict:
+        """
+        Analyses the whole file block by block and stitches the tracks together
+        :param block_duration: approximate length of the frames kept from each block in seconds
+        :param padding: extra audio analysed on each side of a block, see blocks
+        :param analyses: the analyses to run, from ANALYSES
+        :return: dict of analysis name -> (times, values) covering the whole file, in the layout of iter_blocks
+        """
+        parts = {name: [] for name in analyses}
+        for block in self.iter_blocks(block_duration, padding, analyses):
+            for name, track in block.items():
+                parts[name].append(track)
+        return {name: (np.concatenate([t for t, _ in tracks]), np.concatenate([v for _, v in tracks], axis=-1))
+                for name, tracks in parts.items()}
+
+    def analyse_loud(self, intensity_floor: float = 55.0, margin: float = 0.05, block_duration: float = 60.0,
+                     padding: float = 1.0) -> dict:
+        """
+        Intensity first: analyses intensity over the whole file, then pitch and formants only in loud_regions
+        around the pitch and formant frames whose intensity (interpolated as intensity_gate does) reaches the floor.
+        The blocks analysed are kept in self.regions.
+        :param intensity_floor: in dB, as the intensity_filter of get_formants or the intensity_floor of
+                                    extract_frames
+        :param margin: extra seconds analysed on each side of every loud frame
+        :param block_duration: longest block in seconds
+        :param padding: extra audio analysed on each side of a block, see blocks
+        :return: dict in the layout of analyse covering the whole file; pitch and formant frames that were skipped
+                    are NaN, as unvoiced or undefined frames are. Every frame that reaches the floor was analysed.
+        """
+        intensity = self.analyse(block_duration, padding, analyses=("intensity",))["intensity"]
+        i_times, i_values = intensity
+        grid = FrameGrid(i_times[0], self.time_step) if len(i_times) else None
+        tracks = {"intensity": intensity}
+        loud_times = []
+        for name, shape in (("pitch", ()), ("formant", (len(FORMANT_NUMBERS),))):
+            times = self.times(name)
+            tracks[name] = (times, np.full(shape + (len(times),), np.nan))
+            if grid is not None:
+                with np.errstate(invalid="ignore"):
+                    loud_times.append(times[grid_intensity_track(grid, i_values, times) >= intensity_floor])
+        self.regions = self.loud_regions(np.concatenate(loud_times) if loud_times else np.empty(0), margin,
+                                         block_duration, padding)
+        for block in self._analyse_blocks(self.regions, ("pitch", "formant")):
+            for name, (first, _, values) in block.items():
+                tracks[name][1][..., first:first + values.shape[-1]] = values
+        return tracks
+
+    def analysed_fraction(self) -> float:
+        """
+        :return: the share of the file's samples the last analyse_loud read for pitch and formants
+        """
+        return sum(read_end - read_start for _, _, read_start, read_end in self.regions) / max(1, self.n_samples)
+
+
+def compare(values: np.ndarray, reference: np.ndarray, tolerance: float) -> str:
+    """
+    :return: the largest difference between two tracks, the share of frames defined in both that differ by more
+                than tolerance, and the number of frames defined in only one of them
+    """
+    defined = ~np.isnan(values) & ~np.isnan(reference)
+    diff = np.abs(values - reference)[defined]
+    largest = diff.max() if diff.size else 0.0
+    over = np.mean(diff > tolerance) if diff.size else 0.0
+    return (f"max difference {largest:.3g}, {over:.2%} of frames off by more than {tolerance:g}, "
+            f"voicing mismatches {np.sum(np.isnan(values) != np.isnan(reference))}")
+
+
+def main(argv=None):
+    import time
+
+    parser = argparse.ArgumentParser(description="Compare block-wise and intensity-first analysis with whole-file "
+                                                 "analysis.")
+    parser.add_argument("sound", nargs="?", default="One Small Step.wav")
+    parser.add_argument("--time-step", type=float, default=0.01)
+    parser.add_argument("--floor", type=float, default=55.0, help="intensity floor of analyse_loud, in dB")
+    parser.add_argument("--block", type=float, default=1.0, help="block length of the block-wise analysis, in s")
+    args = parser.parse_args(argv)
+
+    inFile = args.sound
+    analyser = StreamingAnalyser(inFile, time_step=args.time_step, pitch_ceiling=300)
+    tolerances = {"pitch": 1.0, "formant": 1.0, "intensity": 0.1}
+
+    start = time.perf_counter()
+    streamed = analyser.analyse(block_duration=args.block, padding=0.5)
+    print(f"streamed in {len(analyser.blocks(args.block, 0.5))} blocks: {time.perf_counter() - start:.2f} s")
+
+    start = time.perf_counter()
+    snd = pm.Sound(inFile)
+    formants = snd.to_formant_burg(time_step=args.time_step)
+    whole = {
+        "pitch": pitch_samples(snd.to_pitch_ac(time_step=args.time_step, pitch_ceiling=300)),
+        "formant": np.vstack([formant_samples(f, formants) for f in FORMANT_NUMBERS]),
+        "intensity": intensity_samples(snd.to_intensity(time_step=args.time_step)),
+    }
+    whole_time = time.perf_counter() - start
+    print(f"whole file: {whole_time:.2f} s")
+
+    for name, (times, values) in streamed.items():
+        same_times = np.array_equal(times, analyser.times(name))
+        print(f"{name}:\t{len(times)} frames, times identical: {same_times}, "
+              f"{compare(values, whole[name], tolerances[name])}")
+
+    start = time.perf_counter()
+    loud = analyser.analyse_loud(args.floor)
+    loud_time = time.perf_counter() - start
+    print(f"\nintensity first, {args.floor:g} dB floor: {loud_time:.2f} s ({whole_time / loud_time:.1f}x faster than "
+          f"whole file), pitch and formants analysed on {analyser.analysed_fraction():.0%} of the file in "
+          f"{len(analyser.regions)} blocks")
+    i_times, i_values = loud["intensity"]
+    for name in ("pitch", "formant"):
+        times, values = loud[name]
+        with np.errstate(invalid="ignore"):
+            kept = grid_intensity_track(FrameGrid(i_times[0], args.time_step), i_values, times) >= args.floor
+        print(f"{name}:\t{kept.sum()} of {len(times)} frames reach the floor, "
+              f"{compare(values[..., kept], whole[name][..., kept], tolerances[name])}")
+
+
+if __name__ == "__main__":
+    main()
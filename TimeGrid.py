@@ -0,0 +1,188 @@
+##      TimeGrid.py
+##
+##      Description: a shared time axis for pitch, formant and intensity
+##          tracks. to_pitch, to_formant_burg and to_intensity each produce
+##          their own frame grid (different first frame and frame count, see
+##          AlignmentTesting.py); TimeGrid resamples any set of tracks onto
+##          one grid with vectorized nearest or linear interpolation and
+##          reports how far each grid time is from the source frames.
+##
+##      ©2023
+##
+
+import parselmouth as pm
+import numpy as np
+from TrackExtraction import pitch_samples, formant_samples, intensity_samples, FORMANT_NUMBERS
+
+# row names of the stacked array returned by align_tracks
+TRACK_NAMES = ("pitch", "F1", "F2", "F3", "F4", "intensity")
+
+
+class TimeGrid:
+    """
+    A uniform time axis: n frames, the first centred at t1, dt seconds apart.
+    """
+
+    def __init__(self, t1: float, dt: float, n: int):
+        if dt <= 0:
+            raise ValueError(f"time step must be positive, got {dt}")
+        self.t1 = float(t1)
+        self.dt = float(dt)
+        self.n = max(int(n), 0)
+
+    def __len__(self):
+        return self.n
+
+    def __repr__(self):
+        return f"TimeGrid(t1={self.t1}, dt={self.dt}, n={self.n})"
+
+    @classmethod
+    def from_sampled(cls, sampled) -> "TimeGrid":
+        """
+        :param sampled: any parselmouth object with frames (Pitch, Formant, Intensity, Spectrogram, ...)
+        :return: the frame grid of that object
+        """
+        return cls(sampled.x1, sampled.dx, sampled.nx)
+
+    @classmethod
+    def common(cls, *sampled, time_step: float = None) -> "TimeGrid":
+        """
+        Builds the grid that covers the time span where every one of the given objects has frames
+        :param sampled: parselmouth objects with frames
+        :param time_step: step of the new grid, defaults to the finest step among the objects
+        :return: a TimeGrid starting at the latest first frame and ending at or before the earliest last frame
+        """
+        if not sampled:
+            raise ValueError("need at least one object to build a common grid")
+        start = max(s.x1 for s in sampled)
+        end = min(s.x1 + (s.nx - 1) * s.dx for s in sampled)
+        dt = time_step or min(s.dx for s in sampled)
+        n = int(np.floor((end - start) / dt + 1e-9)) + 1 if end >= start else 0
+        return cls(start, dt, n)
+
+    @property
+    def times(self) -> np.ndarray:
+        return self.t1 + self.dt * np.arange(self.n)
+
+    def _neighbours(self, src_times: np.ndarray):
+        """
+        :return: (left, right, phase) where left/right index the source frames around each grid time and
+                    phase is the position between them (0 at left, 1 at right)
+        """
+        times = self.times
+        right = np.clip(np.searchsorted(src_times, times), 1, len(src_times) - 1)
+        left = right - 1
+        span = src_times[right] - src_times[left]
+        phase = (times - src_times[left]) / span
+        return left, right, phase
+
+    def resample(self, src_times, values, method: str = "linear") -> np.ndarray:
+        """
+        Resamples one track onto this grid. NaN marks undefined source frames. With 'nearest' the closest source
+        frame is taken; with 'linear' the two surrounding frames are interpolated, falling back to the nearer frame
+        when the other is undefined, the same rule Praat uses for get_value_at_time. Grid times more than half a
+        source step outside the source frames are NaN.
+        :param src_times: increasing frame times of the track
+        :param values: the track values, one per frame
+        :param method: 'nearest' or 'linear'
+        :return: array with one value per grid frame
+        """
+        if method not in ("nearest", "linear"):
+            raise ValueError(f"unknown resampling method '{method}', use 'nearest' or 'linear'")
+        src_times = np.asarray(src_times, dtype=float)
+        values = np.asarray(values, dtype=float)
+        if len(src_times) != len(values):
+            raise ValueError(f"{len(src_times)} frame times but {len(values)} values")
+        if len(src_times) < 2:
+            return np.full(self.n, values[0] if len(values) else np.nan)
+
+        left, right, phase = self._neighbours(src_times)
+        left_is_near = phase < 0.5
+        near = np.where(left_is_near, left, right)
+        out = values[near]
+        if method == "linear":
+            far = np.where(left_is_near, right, left)
+            weight = np.clip(np.where(left_is_near, phase, 1.0 - phase), 0.0, 1.0)
+            both = ~np.isnan(out) & ~np.isnan(values[far])
+            out[both] += weight[both] * (values[far][both] - out[both])
+
+        half_step = 0.5 * (src_times[-1] - src_times[0]) / (len(src_times) - 1)
+        times = self.times
+        out[(times < src_times[0] - half_step) | (times > src_times[-1] + half_step)] = np.nan
+        return out
+
+    def alignment_error(self, src_times) -> np.ndarray:
+        """
+        :param src_times: increasing frame times of a track
+        :return: distance in seconds from each grid time to the nearest source frame
+        """
+        src_times = np.asarray(src_times, dtype=float)
+        if len(src_times) < 2:
+            return np.abs(self.times - src_times[0])
+        left, right, phase = self._neighbours(src_times)
+        near = np.where(phase < 0.5, left, right)
+        return np.abs(self.times - src_times[near])
+
+    def stack(self, tracks, method: str = "linear") -> np.ndarray:
+        """
+        Resamples several tracks onto this grid
+        :param tracks: iterable of (times, values) pairs, as returned by get_formants
+        :param method: 'nearest' or 'linear'
+        :return: 2-d array, one row per track and one column per grid frame
+        """
+        rows = [self.resample(times, values, method) for times, values in tracks]
+        return np.vstack(rows) if rows else np.empty((0, self.n))
+
+    def report(self, tracks, names=None) -> dict:
+        """
+        :param tracks: iterable of (times, values) pairs
+        :param names: names for the tracks, defaults to their position
+        :return: dict of name -> (maximum, mean) alignment error in seconds
+        """
+        tracks = list(tracks)
+        names = names or range(len(tracks))
+        out = {}
+        for name, (times, _) in zip(names, tracks):
+            err = self.alignment_error(times)
+            out[name] = (float(err.max()) if len(err) else 0.0, float(err.mean()) if len(err) else 0.0)
+        return out
+
+
+def align_tracks(pitch: pm.Pitch, formants: pm.Formant, intensity: pm.Intensity, grid: TimeGrid = None,
+                 method: str = "linear") -> tuple[TimeGrid, np.ndarray, dict]:
+    """
+    Puts pitch, F1-F4 and intensity on one time axis
+    :param pitch: parselmouth Pitch
+    :param formants: parselmouth Formants
+    :param intensity: parselmouth Intensity
+    :param grid: grid to resample onto, defaults to TimeGrid.common of the three objects
+    :param method: 'nearest' or 'linear'
+    :return: (grid, values, errors) where values is a 6 x n array with rows in TRACK_NAMES order (NaN where
+                undefined) and errors is the TimeGrid.report of the source grids
+    """
+    if grid is None:  # a grid with no frames is falsy, but is still the caller's grid
+        grid = TimeGrid.common(pitch, formants, intensity)
+    tracks = [(pitch.ts(), pitch_samples(pitch))]
+    tracks += [(formants.ts(), formant_samples(f, formants)) for f in FORMANT_NUMBERS]
+    tracks.append((intensity.ts(), intensity_samples(intensity)))
+    return grid, grid.stack(tracks, method), grid.report(tracks, TRACK_NAMES)
+
+
+def main():
+    snd = pm.Sound("Thats One Small.wav")
+    intensity = snd.to_intensity(time_step=0.001)
+    formants = snd.to_formant_burg(time_step=0.001, window_length=0.032169)
+    pitch = snd.to_pitch(time_step=0.001)
+
+    for name, obj in (("pitch", pitch), ("formants", formants), ("intensity", intensity)):
+        print(f"{name}:\t{TimeGrid.from_sampled(obj)}")
+
+    grid, values, errors = align_tracks(pitch, formants, intensity)
+    print(f"common:\t{grid}")
+    for name, (max_err, mean_err) in errors.items():
+        print(f"{name}:\tmax error {max_err * 1000:.3f} ms\tmean error {mean_err * 1000:.3f} ms")
+    print(f"stacked values: {values.shape}")
+
+
+if __name__ == "__main__":
+    main()
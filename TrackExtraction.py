@@ -0,0 +1,282 @@
+##      TrackExtraction.py
+##
+##      Description: bulk extraction of pitch, formant and intensity tracks
+##          from parselmouth analysis objects as NumPy arrays. Replaces the
+##          per-frame get_value_at_time / get_value loops with vectorized
+##          versions of the same Praat interpolation rules, so the values
+##          returned are identical to the scalar calls.
+##
+##      ©2023
+##
+
+import collections
+import parselmouth as pm
+import numpy as np
+
+# formants sampled by the clean_formants layout, in row order after pitch
+FORMANT_NUMBERS = (1, 2, 3, 4)
+
+# the frame grid of track values held as an array rather than a parselmouth object
+FrameGrid = collections.namedtuple("FrameGrid", ("x1", "dx"))
+
+
+def _time_to_index(sampled, times: np.ndarray) -> np.ndarray:
+    """
+    Converts times to real-valued 1-based frame indices, the same way Praat's Sampled_xToIndex does
+    :param sampled: any parselmouth object with x1/dx (Pitch, Formant, Intensity, ...)
+    :param times: array of times in seconds
+    :return: array of real-valued frame indices
+    """
+    return (times - sampled.x1) / sampled.dx + 1.0
+
+
+def _sampled_value_at(sampled, samples: np.ndarray, times: np.ndarray) -> np.ndarray:
+    """
+    Vectorized Sampled_getValueAtX with linear interpolation, which is what Pitch.get_value_at_time and
+    Formant.get_value_at_time use. Undefined frames are NaN in samples; if the far neighbour is undefined
+    the near value is used, if the near one is undefined the result is NaN.
+    :param sampled: the parselmouth object the samples come from
+    :param samples: 1-d array with one value per frame, NaN where undefined
+    :param times: times to sample at
+    :return: array of values, one per time
+    """
+    n = len(samples)
+    ireal = _time_to_index(sampled, times)
+    ileft = np.floor(ireal)
+    phase = ireal - ileft
+    left_is_near = phase < 0.5
+    inear = np.where(left_is_near, ileft, ileft + 1).astype(np.intp)
+    ifar = np.where(left_is_near, ileft + 1, ileft).astype(np.intp)
+    phase = np.where(left_is_near, phase, 1.0 - phase)
+
+    padded = np.concatenate(([np.nan], samples, [np.nan]))  # index 0 and n+1 read as undefined
+    f_near = padded[np.clip(inear, 0, n + 1)]
+    f_far = padded[np.clip(ifar, 0, n + 1)]
+    f_near[(times < sampled.xmin) | (times > sampled.xmax)] = np.nan
+
+    far_defined = ~np.isnan(f_far)
+    values = f_near.copy()
+    values[far_defined] = f_near[far_defined] + phase[far_defined] * (f_far[far_defined] - f_near[far_defined])
+    return values
+
+
+def _cubic_value_at(sampled, samples: np.ndarray, times: np.ndarray) -> np.ndarray:
+    """
+    Vectorized Vector_getValueAtX with cubic interpolation (NUM_interpolate_sinc, depth 2), which is what
+    Intensity.get_value uses by default. Near the edges the depth drops to linear or nearest, as in Praat.
+    :param sampled: the parselmouth object the samples come from
+    :param samples: 1-d array with one value per frame
+    :param times: times to sample at
+    :return: array of values, one per time
+    """
+    n = len(samples)
+    left_edge = sampled.x1 - 0.5 * sampled.dx
+    right_edge = left_edge + n * sampled.dx
+    x = _time_to_index(sampled, times)
+    values = np.full(x.shape, np.nan)
+
+    inside = (times >= left_edge) & (times <= right_edge)
+    values[inside & (x > n)] = samples[n - 1]
+    values[inside & (x < 1)] = samples[0]
+
+    interior = inside & (x >= 1) & (x <= n)
+    midleft = np.floor(x).astype(np.intp)
+    midright = midleft + 1
+    on_frame = interior & (x == midleft)
+    values[on_frame] = samples[midleft[on_frame] - 1]
+
+    between = interior & ~on_frame
+    depth = np.minimum(np.minimum(2, midright - 1), n - midleft)
+
+    nearest = between & (depth <= 0)
+    values[nearest] = samples[np.floor(x[nearest] + 0.5).astype(np.intp) - 1]
+
+    linear = between & (depth == 1)
+    l, r = midleft[linear] - 1, midright[linear] - 1
+    values[linear] = samples[l] + (x[linear] - midleft[linear]) * (samples[r] - samples[l])
+
+    cubic = between & (depth >= 2)
+    l, r = midleft[cubic] - 1, midright[cubic] - 1
+    yl, yr = samples[l], samples[r]
+    dyl = 0.5 * (yr - samples[l - 1])
+    dyr = 0.5 * (samples[r + 1] - yl)
+    fil = x[cubic] - midleft[cubic]
+    fir = midright[cubic] - x[cubic]
+    values[cubic] = yl * fir + yr * fil - fil * fir * (0.5 * (dyr - dyl) + (fil - 0.5) * (dyl + dyr - 2 * (yr - yl)))
+    return values
+
+
+def pitch_samples(pitch: pm.Pitch) -> np.ndarray:
+    """
+    :param pitch: a parselmouth.Pitch object
+    :return: the selected pitch of every frame in Hz, NaN where the frame is unvoiced
+    """
+    samples = pitch.selected_array['frequency'].copy()
+    samples[(samples <= 0) | (samples >= pitch.ceiling)] = np.nan
+    return samples
+
+
+def formant_samples(formant_number: int, formants: pm.Formant) -> np.ndarray:
+    """
+    :param formant_number: the formant to extract
+    :param formants: a parselmouth.Formant object
+    :return: the frequency of that formant in every frame in Hz, NaN where the frame has no such formant
+    """
+    samples = pm.praat.call(formants, "To Matrix", formant_number).values[0].copy()
+    samples[samples == 0] = np.nan
+    return samples
+
+
+def intensity_samples(intensity: pm.Intensity) -> np.ndarray:
+    """
+    :param intensity: a parselmouth.Intensity object
+    :return: the intensity of every frame in dB
+    """
+    return intensity.values[0].copy()
+
+
+def pitch_track(pitch: pm.Pitch, times=None) -> np.ndarray:
+    """
+    Bulk equivalent of calling pitch.get_value_at_time(t) for every t in times
+    :param pitch: a parselmouth.Pitch object
+    :param times: times to sample at, defaults to the pitch frame times
+    :return: array of pitch values in Hz, NaN where unvoiced
+    """
+    times = pitch.ts() if times is None else np.asarray(times, dtype=float)
+    return _sampled_value_at(pitch, pitch_samples(pitch), times)
+
+
+def formant_track(formant_number: int, formants: pm.Formant, times=None) -> np.ndarray:
+    """
+    Bulk equivalent of calling formants.get_value_at_time(formant_number, t) for every t in times
+    :param formant_number: the formant to extract
+    :param formants: a parselmouth.Formant object
+    :param times: times to sample at, defaults to the formant frame times
+    :return: array of formant values in Hz, NaN where undefined
+    """
+    times = formants.ts() if times is None else np.asarray(times, dtype=float)
+    return _sampled_value_at(formants, formant_samples(formant_number, formants), times)
+
+
+def intensity_track(intensity: pm.Intensity, times=None) -> np.ndarray:
+    """
+    Bulk equivalent of calling intensity.get_value(t) for every t in times
+    :param intensity: a parselmouth.Intensity object
+    :param times: times to sample at, defaults to the intensity frame times
+    :return: array of intensity values in dB, NaN outside the intensity's time domain
+    """
+    times = intensity.ts() if times is None else np.asarray(times, dtype=float)
+    return _cubic_value_at(intensity, intensity_samples(intensity), times)
+
+
+def grid_intensity_track(grid: FrameGrid, samples: np.ndarray, times) -> np.ndarray:
+    """
+    intensity_track for intensity frames held as an array, e.g. stitched together by StreamingAnalysis
+    :param grid: time of the first frame and the time step
+    :param samples: the intensity of every frame in dB
+    :param times: times to sample at
+    :return: array of intensity values in dB, NaN outside the frames' time domain
+    """
+    return _cubic_value_at(grid, np.asarray(samples, dtype=float), np.asarray(times, dtype=float))
+
+
+def intensity_gate(intensity: pm.Intensity, times: np.ndarray, intensity_filter: float = 0) -> np.ndarray:
+    """
+    Mask of the frames that pass the intensity filter used by get_pitch_values / get_formant_values
+    :param intensity: a parselmouth.Intensity object
+    :param times: the frame times to gate
+    :param intensity_filter: frames with intensity below this value fail the gate. Every frame passes if set to zero
+    :return: boolean array, True where the frame is kept
+    """
+    if intensity_filter == 0:
+        return np.ones(len(times), dtype=bool)
+    return intensity_track(intensity, times) >= intensity_filter
+
+
+def apply_gate(values: np.ndarray, gate: np.ndarray, nan_as_zero=True) -> np.ndarray:
+    """
+    Zeroes the frames that fail the gate and optionally converts the remaining NaNs to zero
+    :param values: array of track values
+    :param gate: boolean array, True where the frame is kept
+    :param nan_as_zero: converts nan values to 0.0 if True, leaves them if False
+    :return: new array of gated values
+    """
+    values = np.where(gate, values, 0.0)
+    if nan_as_zero:
+        values[np.isnan(values)] = 0.0
+    return values
+
+
+def extract_tracks(pitch: pm.Pitch, formants: pm.Formant, intensity: pm.Intensity,
+                   which_formants: tuple[int, ...] = (0, 1, 2, 3, 4), intensity_filter: float = 0,
+                   nan_as_zero=True) -> list[tuple[np.ndarray, np.ndarray]]:
+    """
+    Bulk version of get_formants. Pitch is sampled at the pitch frame times and formants at the formant
+    frame times.
+    :param pitch: parselmouth Pitch
+    :param formants: parselmouth Formants
+    :param intensity: parselmouth Intensity
+    :param which_formants: tuple that contains the formants to get, 0 being pitch
+    :param intensity_filter: float that when 0 does nothing and when > 0 sets returned values to 0 if the
+                                intensity at that time is below the filter value
+    :param nan_as_zero: converts nan values to 0.0 if True, leaves them if False
+    :return: a list of (times, values) array pairs in the order of the which_formants tuple
+    """
+    pitch_times = pitch.ts()
+    formant_times = formants.ts()
+    pitch_gate = None
+    formant_gate = None
+
+    tracks = []
+    for f in which_formants:
+        if f == 0:
+            if pitch_gate is None:
+                pitch_gate = intensity_gate(intensity, pitch_times, intensity_filter)
+            values = apply_gate(pitch_track(pitch), pitch_gate, nan_as_zero)
+            tracks.append((pitch_times, values))
+        else:
+            if formant_gate is None:
+                formant_gate = intensity_gate(intensity, formant_times, intensity_filter)
+            values = apply_gate(formant_track(f, formants), formant_gate, nan_as_zero)
+            tracks.append((formant_times, values))
+    return tracks
+
+
+def extract_frames(pitch: pm.Pitch, formants: pm.Formant, intensity: pm.Intensity,
+                   times=None, intensity_floor: float = 55) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Bulk version of clean_formants. Pitch, F1-F4 and intensity are all sampled on one set of frame times;
+    pitch and formants are set to 0 where intensity is below the floor. Undefined values are left as NaN.
+    :param pitch: parselmouth Pitch
+    :param formants: parselmouth Formants
+    :param intensity: parselmouth Intensity
+    :param times: times to sample at, defaults to the formant frame times
+    :param intensity_floor: frames with intensity below this value are zeroed
+    :return: (times, values, intensity) where values is a 5 x n array with rows pitch, F1, F2, F3, F4
+    """
+    times = formants.ts() if times is None else np.asarray(times, dtype=float)
+    intensity_values = intensity_track(intensity, times)
+
+    values = np.empty((1 + len(FORMANT_NUMBERS), len(times)))
+    values[0] = pitch_track(pitch, times)
+    for row, f in enumerate(FORMANT_NUMBERS, start=1):
+        values[row] = formant_track(f, formants, times)
+    values[:, intensity_values < intensity_floor] = 0.0
+    return times, values, intensity_values
+
+
+def main():
+    snd = pm.Sound("Thats One Small.wav")
+    pitch = snd.to_pitch(time_step=0.001)
+    formants = snd.to_formant_burg(time_step=0.001, window_length=0.032169)
+    intensity = snd.to_intensity(time_step=0.001)
+
+    times, values, intensity_values = extract_frames(pitch, formants, intensity)
+    print(f"{len(times)} frames from {times[0]:.4f} s to {times[-1]:.4f} s")
+    for name, row in zip(("Pitch", "F1", "F2", "F3", "F4"), values):
+        print(f"{name}:\tmean {np.nanmean(row[row > 0]):.1f} Hz")
+    print(f"Intensity:\tmean {np.nanmean(intensity_values):.1f} dB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+##      TrackStore.py
+##
+##      Description: a columnar store for per-recording frame tables (time,
+##          F0, F1-F4, intensity, voicing and frame-to-frame differences), so
+##          analysis results can be saved once and reloaded or aggregated
+##          without re-analysing. A store is a directory with a JSON manifest
+##          and one folder per table; every table is split into chunks of
+##          rows, and each chunk holds one array per column. Compressed
+##          chunks are .npz files whose columns are read only when asked for;
+##          uncompressed chunks are one .npy file per column, memory-mapped
+##          on read, so columns reach NumPy without a copy.
+##
+##      ©2023
+##
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import numpy as np
+from AnalysisCache import FileLock, get_cache
+
+STORE_FORMAT_VERSION = 1
+DEFAULT_CHUNK_ROWS = 1 << 16
+
+# columns of the frame tables made by frame_table, in order
+FRAME_COLUMNS = ("time", "F0", "F1", "F2", "F3", "F4", "intensity", "voiced",
+                 "dF0", "dF1", "dF2", "dF3", "dF4", "dintensity")
+
+
+def frame_table(times, values) -> dict[str, np.ndarray]:
+    """
+    :param times: frame times
+    :param values: 6 x n array of pitch, F1-F4 and intensity, NaN where undefined (e.g. from TimeGrid.align_tracks)
+    :return: dict of FRAME_COLUMNS -> arrays; voiced is where F0 is defined, each d column is the value minus the
+                previous frame's value (NaN at the first frame or where either is undefined)
+    """
+    values = np.asarray(values, dtype=float)
+    table = {"time": np.asarray(times, dtype=float)}
+    names = ("F0", "F1", "F2", "F3", "F4", "intensity")
+    for name, track in zip(names, values):
+        table[name] = track
+    table["voiced"] = ~np.isnan(values[0])
+    diffs = np.full_like(values, np.nan)
+    diffs[:, 1:] = values[:, 1:] - values[:, :-1]
+    for name, track in zip(names, diffs):
+        table["d" + name] = track
+    return {name: table[name] for name in FRAME_COLUMNS}
+
+
+class TrackStore:
+    """
+    A directory of chunked columnar tables. Safe for several processes appending at once: chunk files are
+    written before the manifest that lists them, and the manifest is updated under a file lock.
+    """
+
+    def __init__(self, directory: str, chunk_rows: int = DEFAULT_CHUNK_ROWS, compress: bool = True,
+                 cached_chunks: int = 16):
+        """
+        :param directory: where the store lives, created if missing
+        :param chunk_rows: rows per chunk for new tables
+        :param compress: write new chunks as compressed .npz (smaller, decompressed on read) rather than raw .npy
+                            columns (larger, memory-mapped on read)
+        :param cached_chunks: how many decompressed chunk columns are kept, so neighbouring reads don't
+                                decompress again
+        """
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+        self.compress = compress
+        self.cached_chunks = cached_chunks
+        self._chunk_cache = {}
+        os.makedirs(os.path.join(directory, "tables"), exist_ok=True)
+        self._manifest_path = os.path.join(directory, "manifest.json")
+        self._manifest = None
+        self._manifest_mtime = None
+
+    # ------------------------------------------------------------------ manifest
+
+    def _read_manifest(self) -> dict:
+        try:
+            mtime = os.stat(self._manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            return {"version": STORE_FORMAT_VERSION, "tables": {}}
+        if self._manifest is None or mtime != self._manifest_mtime:
+            with open(self._manifest_path, encoding="utf8") as f:
+                manifest = json.load(f)
+            if manifest.get("version") != STORE_FORMAT_VERSION:
+                raise ValueError(f"{self._manifest_path} has store format {manifest.get('version')}, "
+                                 f"expected {STORE_FORMAT_VERSION}")
+            self._manifest, self._manifest_mtime = manifest, mtime
+        return self._manifest
+
+    def _write_manifest(self, manifest: dict):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf8") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp, self._manifest_path)
+        self._manifest, self._manifest_mtime = manifest, os.stat(self._manifest_path).st_mtime_ns
+
+    def tables(self) -> list[str]:
+        """
+        :return: names of the stored tables
+        """
+        return list(self._read_manifest()["tables"])
+
+    def info(self, table: str) -> dict:
+        """
+        :return: the table's manifest entry: rows, columns (name -> dtype), chunks, source and digest
+        """
+        try:
+            return self._read_manifest()["tables"][table]
+        except KeyError:
+            raise KeyError(f"no table '{table}' in {self.directory}") from None
+
+    def __contains__(self, table: str) -> bool:
+        return table in self._read_manifest()["tables"]
+
+    def __len__(self):
+        return len(self._read_manifest()["tables"])
+
+    # ------------------------------------------------------------------ writing
+
+    def _table_dir(self, table: str) -> str:
+        """
+        :return: the folder for a new table's chunks: its name made safe for the file system (shortened, so
+                    readable) and a hash of the name, so no two tables share one
+        """
+        readable = re.sub(r"[^\w.-]", "_", table)[-64:]
+        return os.path.join(self.directory, "tables",
+                            f"{readable}_{hashlib.sha256(table.encode('utf8')).hexdigest()[:16]}")
+
+    def _write_chunk(self, folder: str, columns: dict, start: int, stop: int) -> str:
+        """
+        Writes rows start..stop-1 of the columns as a new chunk
+        :return: the chunk's name relative to the table folder
+        """
+        os.makedirs(folder, exist_ok=True)
+        if self.compress:
+            fd, tmp = tempfile.mkstemp(dir=folder, prefix="chunk_", suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                np.savez_compressed(f, **{name: col[start:stop] for name, col in columns.items()})
+            name = os.path.basename(tmp)[:-4] + ".npz"
+            os.replace(tmp, os.path.join(folder, name))
+        else:
+            chunk_dir = tempfile.mkdtemp(dir=folder, prefix="chunk_")
+            for column, values in columns.items():
+                np.save(os.path.join(chunk_dir, column + ".npy"), np.ascontiguousarray(values[start:stop]))
+            name = os.path.basename(chunk_dir)
+        return name
+
+    def append(self, table: str, columns: dict, source: str = None, digest: str = None, replace: bool = False,
+               **metadata):
+        """
+        Adds rows to a table, creating it if needed
+        :param table: table name, e.g. the recording's path
+        :param columns: dict of column name -> 1-D array, all the same length; an existing table must get the
+                            same columns
+        :param source: file the rows were computed from
+        :param digest: SHA-256 of the source, used by add_recording to skip unchanged files
+        :param replace: replace the table's rows instead of adding to them; the old rows are swapped out under
+                            the same lock that adds the new ones, so concurrent writers never leave both behind
+        :param metadata: JSON-serialisable settings to record with a new table
+        """
+        columns = {name: np.asarray(values) for name, values in columns.items()}
+        lengths = {len(values) for values in columns.values()}
+        if len(lengths) != 1:
+            raise ValueError(f"columns have different lengths: {sorted(lengths)}")
+        n = lengths.pop()
+        if table in self and not replace:
+            # rows added to a table go where its other chunks are, which for stores written before table folders
+            # were hashed is not _table_dir
+            entry = self.info(table)
+            folder = os.path.join(self.directory, "tables", entry["folder"])
+            chunk_rows = entry["chunk_rows"]
+        else:
+            folder, chunk_rows = self._table_dir(table), self.chunk_rows
+
+        # chunk files go down first, so a crash only leaves unreferenced files behind
+        chunks = []
+        for start in range(0, n, chunk_rows):
+            stop = min(start + chunk_rows, n)
+            chunk = {"file": self._write_chunk(folder, columns, start, stop), "rows": stop - start}
+            if "time" in columns and stop > start:
+                chunk["time"] = [float(columns["time"][start]), float(columns["time"][stop - 1])]
+            chunks.append(chunk)
+
+        with FileLock(os.path.join(self.directory, "lock")):
+            self._manifest = None
+            manifest = self._read_manifest()
+            replaced = manifest["tables"].pop(table, None) if replace else None
+            entry = manifest["tables"].get(table)
+            if entry is None:
+                entry = manifest["tables"][table] = {
+                    "folder": os.path.basename(folder), "rows": 0, "chunk_rows": chunk_rows,
+                    "columns": {name: values.dtype.str for name, values in columns.items()},
+                    "chunks": [], "source": source, "digest": digest, "metadata": metadata}
+            elif set(entry["columns"]) != set(columns):
+                raise ValueError(f"table '{table}' has columns {sorted(entry['columns'])}, got {sorted(columns)}")
+            for chunk in chunks:
+                chunk["start"] = entry["rows"]
+                entry["rows"] += chunk["rows"]
+                entry["chunks"].append(chunk)
+            self._write_manifest(manifest)
+        if replaced is not None:
+            # the new chunks share the table's folder, so only the old entry's chunks are deleted
+            self._delete_chunks(table, replaced)
+
+    def _delete_chunks(self, table: str, entry: dict):
+        """
+        Deletes the chunk files of a table entry that is no longer in the manifest, and its folder once that is
+        empty. Other files in the folder are left alone: stores written before table folders were hashed can
+        have several tables in one.
+        """
+        folder = os.path.join(self.directory, "tables", entry["folder"])
+        for chunk in entry["chunks"]:
+            path = os.path.join(folder, chunk["file"])
+            if chunk["file"].endswith(".npz"):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            else:
+                shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.rmdir(folder)
+        except OSError:  # still holds another entry's chunks, or already gone
+            pass
+        self._chunk_cache = {key: value for key, value in self._chunk_cache.items() if key[0] != table}
+
+    def remove(self, table: str):
+        """
+        Deletes a table and its chunks
+        """
+        with FileLock(os.path.join(self.directory, "lock")):
+            self._manifest = None
+            manifest = self._read_manifest()
+            entry = manifest["tables"].pop(table, None)
+            if entry is None:
+                return
+            self._write_manifest(manifest)
+        self._delete_chunks(table, entry)
+
+    def add_recording(self, filename: str, table: str = None, time_step: float = 0.01, replace: bool = False,
+                      **analysis) -> bool:
+        """
+        Analyses a recording and stores its frame table, unless the same file contents are already stored
+        :param filename: path to a .wav file
+        :param table: table name, defaults to filename
+        :param time_step: analysis time step in seconds
+        :param replace: re-analyse even if the stored table is up to date
+        :param analysis: extra keyword arguments for to_pitch (pitch_floor, pitch_ceiling)
+        :return: True if the recording was analysed, False if the stored table was kept
+        """
+        import parselmouth as pm
+        from TimeGrid import align_tracks
+
+        table = table or filename
+        digest = get_cache().file_digest(filename)
+        settings = {"time_step": time_step, **analysis}
+        if table in self and not replace:
+            entry = self.info(table)
+            if entry["digest"] == digest and entry["metadata"] == settings:
+                return False
+        snd = pm.Sound(filename)
+        pitch = snd.to_pitch(time_step=time_step, **analysis)
+        formants = snd.to_formant_burg(time_step=time_step)
+        intensity = snd.to_intensity(time_step=time_step)
+        grid, values, _ = align_tracks(pitch, formants, intensity)
+        self.append(table, frame_table(grid.times, values), source=filename, digest=digest, replace=True, **settings)
+        return True
+
+    # ------------------------------------------------------------------ reading
+
+    def _chunk_column(self, table: str, entry: dict, chunk: dict, column: str) -> np.ndarray:
+        """
+        :return: one column of one chunk, memory-mapped for raw chunks, decompressed (and cached) for .npz chunks
+        """
+        path = os.path.join(self.directory, "tables", entry["folder"], chunk["file"])
+        if not chunk["file"].endswith(".npz"):
+            return np.load(os.path.join(path, column + ".npy"), mmap_mode="r")
+        key = (table, chunk["file"], column)
+        values = self._chunk_cache.pop(key, None)
+        if values is None:
+            with np.load(path) as data:
+                values = data[column]
+            values.flags.writeable = False  # shared between callers through the cache
+        self._chunk_cache[key] = values  # most recently used last
+        while len(self._chunk_cache) > self.cached_chunks:
+            del self._chunk_cache[next(iter(self._chunk_cache))]
+        return values
+
+    def column(self, table: str, column: str, start: int = 0, stop: int = None) -> np.ndarray:
+        """
+        Reads rows start..stop-1 of one column, touching only the chunks that overlap them. A range inside one
+        chunk is returned as a read-only view of that chunk without copying.
+        :param table: table name
+        :param column: column name
+        :param start: first row
+        :param stop: row after the last, defaults to the end of the table
+        :return: 1-D array
+        """
+        entry = self.info(table)
+        if column not in entry["columns"]:
+            raise KeyError(f"table '{table}' has no column '{column}'")
+        start, stop, _ = slice(start, stop).indices(entry["rows"])
+        pieces = []
+        for chunk in entry["chunks"]:
+            lo, hi = chunk["start"], chunk["start"] + chunk["rows"]
+            if hi <= start or lo >= stop:
+                continue
+            values = self._chunk_column(table, entry, chunk, column)
+            pieces.append(values[max(start - lo, 0):min(stop, hi) - lo])
+        if not pieces:
+            return np.empty(0, dtype=np.dtype(entry["columns"][column]))
+        return pieces[0] if len(pieces) == 1 else np.concatenate(pieces)
+
+    def read(self, table: str, columns=None, start: int = 0, stop: int = None) -> dict[str, np.ndarray]:
+        """
+        :param columns: column names, defaults to all of them
+        :return: dict of column name -> rows start..stop-1
+        """
+        columns = columns or list(self.info(table)["columns"])
+        return {name: self.column(table, name, start, stop) for name in columns}
+
+    def rows_between(self, table: str, from_time: float, to_time: float) -> tuple[int, int]:
+        """
+        :return: (start, stop) rows whose time is in [from_time, to_time], found from the chunks' time ranges
+                    and a binary search in at most two chunks
+        """
+        entry = self.info(table)
+        chunks = [chunk for chunk in entry["chunks"] if chunk.get("time") and chunk["time"][1] >= from_time]
+        if not chunks:
+            return entry["rows"], entry["rows"]
+        first = chunks[0]
+        start = first["start"] + int(np.searchsorted(
+            self._chunk_column(table, entry, first, "time"), from_time, side="left"))
+        last = [chunk for chunk in chunks if chunk["time"][0] <= to_time]
+        if not last:
+            return start, start
+        last = last[-1]
+        stop = last["start"] + int(np.searchsorted(
+            self._chunk_column(table, entry, last, "time"), to_time, side="right"))
+        return start, max(start, stop)
+
+    def read_between(self, table: str, from_time: float, to_time: float, columns=None) -> dict[str, np.ndarray]:
+        """
+        :return: dict of column name -> the rows whose time is in [from_time, to_time]
+        """
+        start, stop = self.rows_between(table, from_time, to_time)
+        return self.read(table, columns, start, stop)
+
+
+def main():
+    import time
+
+    store = TrackStore("track_store")
+    for inFile in ("Thats.wav", "Thats One Small.wav", "One Small Step.wav"):
+        start = time.perf_counter()
+        analysed = store.add_recording(inFile)
+        print(f"{inFile}: {'analysed' if analysed else 'up to date'} in {time.perf_counter() - start:.2f} s, "
+              f"{store.info(inFile)['rows']} rows")
+
+    start = time.perf_counter()
+    f1 = store.read_between("One Small Step.wav", 3.711298, 3.844613, ["time", "F1"])
+    print(f"F1 on the interval: {np.nanmean(f1['F1']):.1f} Hz over {len(f1['time'])} frames, "
+          f"read in {(time.perf_counter() - start) * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,822 @@
+##      TrackViewer.py
+##
+##      Description: an interactive viewer for a whole recording: the
+##          waveform, the spectrogram with pitch and F1-F4 drawn over it, and
+##          a strip colouring each track's frame-to-frame change in just
+##          noticeable differences (red rising, blue falling), as
+##          Assignment_2.first_part_separate colours its plots. Drag to pan,
+##          scroll to zoom around the pointer, or use the toolbar. Only the
+##          data layers are redrawn when the view moves; the axes are kept as
+##          a saved background and the layers are blitted over it.
+##
+##          Every layer is a min/max pyramid: level k holds the minimum and
+##          maximum of each run of PYRAMID_FACTOR**k samples or frames. A
+##          redraw takes the coarsest level that still has about
+##          BINS_PER_PIXEL bins per pixel and slices only the visible bins
+##          out of it, so it costs the same on an hour-long file as on a
+##          short one. The waveform and spectrogram pyramids are built once
+##          by streaming over the file and kept beside the analysis cache as
+##          .npy files, which are memory-mapped so that only the pages of the
+##          visible window are read. The finest waveform levels are not
+##          stored: they come from the .wav file itself, through WavReader.
+##
+##          usage: python TrackViewer.py <sound.wav> [--floor DB] [--benchmark REDRAWS]
+##
+##      ©2023
+##
+
+import argparse
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+from AnalysisCache import get_cache
+from IntervalReports import JNDS
+from Profiling import profiled
+from Rendering import FORMANT_COLORS, FORMANT_LABELS, VALUES_MAX_FREQUENCY, spectrogram_band
+from StreamingAnalysis import StreamingAnalyser
+from WavReader import MappedWav
+
+# samples or frames per bin of one level, relative to the level below
+PYRAMID_FACTOR = 4
+# levels are added until one has at most this many bins
+COARSEST_BINS = 2048
+# bins drawn per pixel of the axes; with PYRAMID_FACTOR 4 the chosen level has 0.5 to 2 bins per pixel
+BINS_PER_PIXEL = 2
+# rows of the level below reduced at a time while building
+BUILD_CHUNK = 1 << 20
+# the first waveform level that is stored; the ones below are reduced from the .wav file when drawn, which
+# reads at most PYRAMID_FACTOR**WAVEFORM_FIRST_LEVEL samples per bin
+WAVEFORM_FIRST_LEVEL = 3
+# a wideband spectrogram, as Praat draws by default
+SPECTROGRAM_SETTINGS = dict(window_length=0.005, time_step=0.01, frequency_step=20.0)
+SPECTROGRAM_DTYPE = np.float16
+# spectrogram frames analysed at a time
+SPECTROGRAM_BLOCK_FRAMES = 6000
+# points; of the waveform where it is drawn as a line of samples
+WAVEFORM_LINE_WIDTH = 0.8
+# rendered time tick labels kept for later redraws; a few hundred cover the values of a long session of pans
+TICK_LABELS_KEPT = 512
+# the pitch and formant settings of AnalysisCore.analyse_formants
+TRACK_SETTINGS = dict(time_step=0.01, pitch_ceiling=300)
+
+
+def _reduce(lo_source, hi_source, lo_out, hi_out, runs: int):
+    """
+    Fills lo_out and hi_out with the minimum and maximum of each run of rows of the sources, ignoring NaN; a
+    run that is all NaN gives NaN
+    :param lo_source: rows x channels array to take minima of, None to fill only hi_out
+    :param hi_source: rows x channels array to take maxima of
+    :param lo_out: ceil(rows / runs) x channels array, None to fill only hi_out
+    :param hi_out: ceil(rows / runs) x channels array
+    :param runs: rows per bin
+    """
+    n = len(hi_source)
+    step = max(1, BUILD_CHUNK // runs) * runs
+    for start in range(0, n, step):
+        end = min(start + step, n)
+        bins = -(-(end - start) // runs)
+        for source, out, reduce in ((lo_source, lo_out, np.fmin.reduce), (hi_source, hi_out, np.fmax.reduce)):
+            if source is None or out is None:
+                continue
+            rows = np.asarray(source[start:end], dtype=np.float32)
+            if len(rows) % runs:
+                rows = np.concatenate([rows, np.full((bins * runs - len(rows),) + rows.shape[1:], np.nan,
+                                                     dtype=np.float32)])
+            out[start // runs:start // runs + bins] = reduce(rows.reshape((bins, runs) + rows.shape[1:]), axis=1)
+
+
+class _WavSamples:
+    """
+    The samples of a MappedWav sliced like a samples x channels float32 array, read only when sliced
+    """
+
+    def __init__(self, reader: MappedWav):
+        self.reader = reader
+        self.shape = (reader.n_samples, reader.n_channels)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index: slice) -> np.ndarray:
+        start, stop, _ = index.indices(self.shape[0])
+        return self.reader.read(start, max(start, stop)).T.astype(np.float32)
+
+
+class MinMaxPyramid:
+    """
+    Minimum and maximum of a sampled signal over runs of factor**level samples, for drawing any stretch of it at
+    screen resolution. Level 0 is the signal itself. Levels below first_level are not stored and are reduced from
+    the signal when asked for. Every array is samples (or bins) x channels.
+    """
+
+    def __init__(self, x1: float, dx: float, base, levels: list, factor: int = PYRAMID_FACTOR, first_level: int = 1):
+        """
+        :param x1: time of the first sample
+        :param dx: time between samples
+        :param base: the signal, anything sliced like a samples x channels array (e.g. a memory map)
+        :param levels: [(lo, hi), ...] of levels first_level, first_level + 1, ...; lo is None in a max-only pyramid
+        :param factor: samples per bin of level 1, and bins per bin of each level above
+        :param first_level: the level of levels[0]
+        """
+        self.x1 = x1
+        self.dx = dx
+        self.base = base
+        self.levels = levels
+        self.factor = factor
+        self.first_level = first_level
+
+    @classmethod
+    def build(cls, x1: float, dx: float, base, keep_min: bool = True, factor: int = PYRAMID_FACTOR,
+              first_level: int = 1, dtype=np.float32, directory: str = None) -> "MinMaxPyramid":
+        """
+        Builds the levels, streaming over base a chunk at a time, until a level has at most COARSEST_BINS bins
+        :param keep_min: False for a max-only pyramid, e.g. of a spectrogram
+        :param dtype: of the stored levels
+        :param directory: folder to write the levels to as .npy files, with the pyramid's description in
+                            meta.json; None to keep them in memory
+        :return: the pyramid; its levels are memory maps of the files when directory is given
+        """
+        def allocate(name: str, shape: tuple):
+            if directory is None:
+                return np.empty(shape, dtype=dtype)
+            return np.lib.format.open_memmap(os.path.join(directory, f"{name}.npy"), mode="w+", dtype=dtype,
+                                             shape=shape)
+
+        levels = []
+        lo, hi = (base if keep_min else None), base
+        runs = factor ** first_level
+        n = len(base)
+        while n > COARSEST_BINS:
+            n = -(-n // runs)
+            level = first_level + len(levels)
+            shape = (n,) + tuple(base.shape[1:])
+            lo_out = allocate(f"lo{level}", shape) if keep_min else None
+            hi_out = allocate(f"hi{level}", shape)
+            _reduce(lo, hi, lo_out, hi_out, runs)
+            levels.append((lo_out, hi_out))
+            lo, hi, runs = lo_out, hi_out, factor
+        for lo_out, hi_out in levels:
+            for array in (lo_out, hi_out):
+                if isinstance(array, np.memmap):
+                    array.flush()
+        if directory is not None:
+            with open(os.path.join(directory, "meta.json"), "w", encoding="ascii") as f:
+                json.dump({"x1": x1, "dx": dx, "factor": factor, "first_level": first_level,
+                           "n_levels": len(levels), "keep_min": keep_min}, f)
+        return cls(x1, dx, base, levels, factor, first_level)
+
+    @classmethod
+    def open(cls, directory: str, base) -> "MinMaxPyramid":
+        """
+        :param directory: a folder written by build
+        :param base: the signal the pyramid was built from
+        :return: the pyramid with its levels memory-mapped
+        """
+        with open(os.path.join(directory, "meta.json"), encoding="ascii") as f:
+            meta = json.load(f)
+        levels = []
+        for level in range(meta["first_level"], meta["first_level"] + meta["n_levels"]):
+            lo = np.load(os.path.join(directory, f"lo{level}.npy"), mmap_mode="r") if meta["keep_min"] else None
+            levels.append((lo, np.load(os.path.join(directory, f"hi{level}.npy"), mmap_mode="r")))
+        return cls(meta["x1"], meta["dx"], base, levels, meta["factor"], meta["first_level"])
+
+    @property
+    def top_level(self) -> int:
+        return self.first_level + len(self.levels) - 1 if self.levels else 0
+
+    def level_for(self, from_time: float, to_time: float, max_bins: int) -> int:
+        """
+        :return: the finest level with at most max_bins bins between from_time and to_time
+        """
+        samples = max(to_time - from_time, 0.0) / self.dx
+        if samples <= max_bins:
+            return 0
+        return min(math.ceil(math.log(samples / max_bins, self.factor)), self.top_level)
+
+    def window(self, from_time: float, to_time: float, max_bins: int) -> tuple[float, float, np.ndarray, np.ndarray]:
+        """
+        The bins to draw between from_time and to_time, plus one on each side so lines reach the edges
+        :param max_bins: most bins wanted in the window, e.g. a few per pixel
+        :return: (time of the left edge of the first bin, bin width, lo, hi); lo and hi are bins x channels and the
+                    same array at level 0, lo is None in a max-only pyramid
+        """
+        level = self.level_for(from_time, to_time, max_bins)
+        runs = self.factor ** level
+        width = self.dx * runs
+        left = self.x1 - 0.5 * self.dx
+        n_bins = -(-len(self.base) // runs)
+        start = min(max(math.floor((from_time - left) / width) - 1, 0), n_bins)
+        stop = min(max(math.ceil((to_time - left) / width) + 1, start), n_bins)
+        if level == 0:
+            values = np.asarray(self.base[start:stop])
+            return left + start * width, width, values, values
+        if level < self.first_level:
+            hi_source = self.base[start * runs:stop * runs]
+            lo_source = hi_source if not self.levels or self.levels[0][0] is not None else None
+            lo = None if lo_source is None else np.empty((stop - start,) + hi_source.shape[1:], dtype=np.float32)
+            hi = np.empty((stop - start,) + hi_source.shape[1:], dtype=np.float32)
+            _reduce(lo_source, hi_source, lo, hi, runs)
+            return left + start * width, width, lo, hi
+        lo, hi = self.levels[level - self.first_level]
+        return left + start * width, width, None if lo is None else lo[start:stop], hi[start:stop]
+
+    def extremes(self) -> tuple[float, float]:
+        """
+        :return: the signal's overall minimum and maximum, from the coarsest level
+        """
+        lo, hi = self.levels[-1] if self.levels else (self.base[:], self.base[:])
+        lo = hi if lo is None else lo
+        if len(hi) == 0:
+            return 0.0, 0.0
+        return float(np.nanmin(lo)), float(np.nanmax(hi))
+
+
+def _cached_pyramid(filename: str, kind: str, build, **params) -> str:
+    """
+    Finds or builds a pyramid kept beside the analysis cache, under pyramids/ in its directory. These are not
+    counted in the cache's size limit; delete the folder to reclaim the space.
+    :param build: function taking an empty folder and writing the pyramid's files to it
+    :param params: every parameter that changes the pyramid
+    :return: the folder holding the pyramid, or None if the cache is disabled
+    """
+    cache = get_cache()
+    if not cache.enabled:
+        return None
+    folder = os.path.join(cache.directory, "pyramids", cache.key(filename, kind, **params))
+    if os.path.exists(os.path.join(folder, "meta.json")):
+        return folder
+    os.makedirs(os.path.dirname(folder), exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(folder), suffix=".tmp")
+    try:
+        build(tmp)
+        os.replace(tmp, folder)
+    except OSError:
+        # another process published the same pyramid first
+        if not os.path.exists(os.path.join(folder, "meta.json")):
+            raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return folder
+
+
+@profiled(params=("filename",))
+def waveform_pyramid(filename: str, reader: MappedWav) -> MinMaxPyramid:
+    """
+    :param filename: path to a .wav file
+    :param reader: the file, open; levels below WAVEFORM_FIRST_LEVEL are read from it
+    :return: the min/max pyramid of its samples
+    """
+    samples = _WavSamples(reader)
+
+    def build(directory):
+        return MinMaxPyramid.build(0.5 * reader.dx, reader.dx, samples, first_level=WAVEFORM_FIRST_LEVEL,
+                                   directory=directory)
+
+    folder = _cached_pyramid(filename, "waveform_pyramid", build, factor=PYRAMID_FACTOR,
+                             first_level=WAVEFORM_FIRST_LEVEL, coarsest=COARSEST_BINS)
+    return build(None) if folder is None else MinMaxPyramid.open(folder, samples)
+
+
+def _spectrogram_frames(reader: MappedWav, allocate) -> tuple[np.ndarray, np.ndarray, float]:
+    """
+    The band up to VALUES_MAX_FREQUENCY of a spectrogram with SPECTROGRAM_SETTINGS, in dB, analysed
+    SPECTROGRAM_BLOCK_FRAMES frames at a time. Frame i is centred at (i + 0.5) * time step.
+    :param allocate: function taking a shape and returning a SPECTROGRAM_DTYPE array to fill
+    :return: (frames x frequency bins dB, frequency cell edges, highest dB)
+    """
+    step = SPECTROGRAM_SETTINGS["time_step"]
+    padding = SPECTROGRAM_SETTINGS["window_length"] + step  # half Praat's Gaussian window, and a frame to spare
+    n_frames = int(reader.duration // step)
+    frames = y_grid = None
+    vmax = -np.inf
+    for first in range(0, n_frames, SPECTROGRAM_BLOCK_FRAMES):
+        last = min(first + SPECTROGRAM_BLOCK_FRAMES, n_frames)
+        snd = reader.sound(first * step, last * step, padding=padding)
+        band = spectrogram_band(snd.to_spectrogram(maximum_frequency=VALUES_MAX_FREQUENCY, **SPECTROGRAM_SETTINGS))
+        if frames is None:
+            y_grid = band.y_grid()
+            frames = allocate((n_frames, band.db.shape[0]))
+            frames[:] = np.nan
+        x_grid = band.x_grid()
+        columns = np.round(0.5 * (x_grid[:-1] + x_grid[1:]) / step - 0.5).astype(np.int64)
+        keep = (columns >= first) & (columns < last)
+        frames[columns[keep]] = band.db[:, keep].T
+        vmax = max(vmax, float(band.db[:, keep].max(initial=-np.inf)))
+    if frames is None:
+        frames, y_grid = allocate((0, 1)), np.array([0.0, VALUES_MAX_FREQUENCY])
+    return frames, y_grid, vmax
+
+
+@profiled(params=("filename",))
+def spectrogram_pyramid(filename: str, reader: MappedWav) -> tuple[MinMaxPyramid, np.ndarray, float]:
+    """
+    :param filename: path to a .wav file
+    :param reader: the file, open
+    :return: (max-only pyramid of the spectrogram frames in dB, frequency cell edges, highest dB)
+    """
+    step = SPECTROGRAM_SETTINGS["time_step"]
+
+    def build(directory):
+        if directory is None:
+            frames, y_grid, vmax = _spectrogram_frames(reader, lambda shape: np.empty(shape, SPECTROGRAM_DTYPE))
+        else:
+            frames, y_grid, vmax = _spectrogram_frames(reader, lambda shape: np.lib.format.open_memmap(
+                os.path.join(directory, "frames.npy"), mode="w+", dtype=SPECTROGRAM_DTYPE, shape=shape))
+            np.save(os.path.join(directory, "y_grid.npy"), y_grid)
+            np.save(os.path.join(directory, "vmax.npy"), vmax)
+        pyramid = MinMaxPyramid.build(0.5 * step, step, frames, keep_min=False, dtype=SPECTROGRAM_DTYPE,
+                                      directory=directory)
+        return pyramid, y_grid, vmax
+
+    folder = _cached_pyramid(filename, "spectrogram_pyramid", build, factor=PYRAMID_FACTOR,
+                             coarsest=COARSEST_BINS, dtype=np.dtype(SPECTROGRAM_DTYPE).name,
+                             max_frequency=VALUES_MAX_FREQUENCY, **SPECTROGRAM_SETTINGS)
+    if folder is None:
+        return build(None)
+    frames = np.load(os.path.join(folder, "frames.npy"), mmap_mode="r")
+    return (MinMaxPyramid.open(folder, frames), np.load(os.path.join(folder, "y_grid.npy")),
+            float(np.load(os.path.join(folder, "vmax.npy"))))
+
+
+@profiled(params=("filename",))
+def track_pyramids(filename: str, intensity_floor: float = None) -> dict[str, MinMaxPyramid]:
+    """
+    Pitch and F1-F4 with the settings of analyse_formants, analysed block-wise and cached, and their
+    frame-to-frame changes in JNDs (later minus earlier, as get_formant_differences). The pyramids are small
+    enough to build in memory each time.
+    :param filename: path to a .wav file
+    :param intensity_floor: analyse pitch and formants only around frames at least this loud (in dB), see
+                            StreamingAnalyser.analyse_loud; None analyses every frame
+    :return: dict of "pitch" (1 channel) and "formants" (4 channels) pyramids of the tracks in Hz, and
+                "pitch_jnd" and "formants_jnd" pyramids of the changes
+    """
+    analyser = StreamingAnalyser(filename, **TRACK_SETTINGS)
+
+    def compute():
+        if intensity_floor is None:
+            tracks = analyser.analyse(analyses=("pitch", "formant"))
+        else:
+            tracks = analyser.analyse_loud(intensity_floor)
+        return {"pitch_times": tracks["pitch"][0], "pitch": tracks["pitch"][1],
+                "formant_times": tracks["formant"][0], "formants": tracks["formant"][1]}
+
+    arrays = get_cache().fetch(filename, "viewer_tracks", compute, intensity_floor=intensity_floor, **TRACK_SETTINGS)
+    step = analyser.time_step
+    pyramids = {}
+    for name, times, jnds in (("pitch", arrays["pitch_times"], [JNDS["F0"]]),
+                              ("formants", arrays["formant_times"], [JNDS[f"F{n}"] for n in range(1, 5)])):
+        values = np.atleast_2d(arrays[name]).T.astype(np.float32)
+        x1 = float(times[0]) if len(times) else 0.5 * step
+        changes = np.diff(values, axis=0) / np.asarray(jnds, dtype=np.float32)
+        pyramids[name] = MinMaxPyramid.build(x1, step, values)
+        pyramids[f"{name}_jnd"] = MinMaxPyramid.build(x1 + 0.5 * step, step, changes)
+    return pyramids
+
+
+def _speckles(left: float, width: float, lo: np.ndarray, hi: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    :return: (x, channels x points y) of the points to mark: the values at level 0, and above it the maximum and
+                the minimum of every bin
+    """
+    centres = left + width * (np.arange(len(hi)) + 0.5)
+    if lo is hi:
+        return centres, hi.T
+    return np.concatenate([centres, centres]), np.concatenate([hi, lo]).T
+
+
+def _outline(left: float, width: float, lo: np.ndarray, hi: np.ndarray, thickness: float = 0.0) -> list[np.ndarray]:
+    """
+    :param thickness: least height of the band, which is widened to it around the middle of each bin
+    :return: per channel, the points x 2 outline of the band between the minima and maxima, for filling; it
+                folds onto a line where they are the same, as at level 0
+    """
+    centres = left + width * (np.arange(len(hi)) + 0.5)
+    if thickness:
+        middle, half = 0.5 * (lo + hi), 0.5 * thickness
+        lo, hi = np.minimum(lo, middle - half), np.maximum(hi, middle + half)
+    x = np.concatenate([centres, centres[::-1]])
+    return [np.column_stack([x, np.concatenate([upper, lower[::-1]])]) for lower, upper in zip(lo.T, hi.T)]
+
+
+def _strongest(lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    """
+    :return: per bin, whichever of the largest rise and the largest fall is bigger, signed
+    """
+    with np.errstate(invalid="ignore"):
+        return np.where(np.abs(hi) >= np.abs(lo), hi, lo)
+
+
+class _Raster:
+    """
+    Colour-mapped values drawn straight onto the canvas at the pixel size of an axes. The visible bins are
+    coloured through a lookup table and spread over the pixels by indexing, which costs a fraction of an AxesImage
+    of the same data. Pixels no layer covers, and NaN values, are left transparent.
+    """
+
+    def __init__(self, ax, cmap: str, vmin: float, vmax: float):
+        from matplotlib import colormaps
+
+        self.ax = ax
+        self.vmin = vmin
+        self.vmax = vmax
+        # one RGBA pixel per uint32, so colouring and resampling move 4 bytes at a time
+        self._lut = np.ascontiguousarray(colormaps[cmap](np.linspace(0, 1, 256), bytes=True)).view(np.uint32).ravel()
+        self._pixels = np.zeros((1, 1, 4), dtype=np.uint8)
+
+    def set_layers(self, layers: list):
+        """
+        Paints the raster for the axes' current limits and size
+        :param layers: list of (rows x bins values, left edge of the first bin, bin width, bottom, top), rows evenly
+                        spread from bottom to top in data coordinates
+        """
+        bbox = self.ax.bbox
+        width, height = max(int(round(bbox.width)), 1), max(int(round(bbox.height)), 1)
+        (x0, x1), (y0, y1) = self.ax.get_xlim(), self.ax.get_ylim()
+        xs = x0 + (np.arange(width) + 0.5) * ((x1 - x0) / width)
+        ys = y0 + (np.arange(height) + 0.5) * ((y1 - y0) / height)
+        pixels = np.zeros((height, width), dtype=np.uint32)
+        for values, left, bin_width, bottom, top in layers:
+            if values.size == 0:
+                continue
+            columns = np.floor((xs - left) / bin_width).astype(np.int64)
+            rows = np.floor((ys - bottom) * (values.shape[0] / (top - bottom))).astype(np.int64)
+            column_in = np.flatnonzero((columns >= 0) & (columns < values.shape[1]))
+            row_in = np.flatnonzero((rows >= 0) & (rows < values.shape[0]))
+            scaled = (np.asarray(values, dtype=np.float32) - self.vmin) * (255 / (self.vmax - self.vmin))
+            colours = self._lut[np.clip(np.nan_to_num(scaled), 0, 255).astype(np.uint8)]
+            colours[np.isnan(values)] = 0
+            pixels[np.ix_(row_in, column_in)] = colours.take(rows[row_in], axis=0).take(columns[column_in], axis=1)
+        # rows from the bottom up, as draw_image takes them
+        self._pixels = pixels.view(np.uint8).reshape(height, width, 4)
+
+    def draw(self, renderer):
+        bbox = self.ax.bbox
+        gc = renderer.new_gc()
+        gc.set_clip_rectangle(bbox)
+        renderer.draw_image(gc, round(bbox.x0), round(bbox.y0), self._pixels)
+        gc.restore()
+
+
+class _TimeTicks:
+    """
+    The ticks and labels of the time axis under an axes, drawn straight onto the canvas like _Raster. A matplotlib
+    axis lays out and renders every label again on every draw, which costs more than all the data; here the axis'
+    own locator and formatter pick the labels, and each label is rendered once by Agg and its bitmap kept for the
+    next draw that shows it.
+    """
+
+    def __init__(self, ax):
+        from matplotlib import rcParams
+        from matplotlib.font_manager import FontProperties
+        from matplotlib.lines import Line2D, TICKDOWN
+
+        self.ax = ax
+        # absolute times, without an offset text such as "+8.137e1" that would need drawing too
+        ax.ticklabel_format(axis="x", useOffset=False)
+        self.marks = Line2D([], [], linestyle="none", marker=TICKDOWN, markersize=rcParams["xtick.major.size"],
+                            markeredgewidth=rcParams["xtick.major.width"], color=rcParams["xtick.color"],
+                            transform=ax.get_xaxis_transform(), clip_on=False)
+        self.marks.set_figure(ax.figure)
+        self.font = FontProperties(size=rcParams["xtick.labelsize"])
+        color = rcParams["xtick.labelcolor"]
+        self.color = rcParams["xtick.color"] if color == "inherit" else color
+        # points from the bottom of the axes to the top of the labels
+        self.offset = rcParams["xtick.major.size"] + rcParams["xtick.major.pad"]
+        self._labels = {}  # text -> RGBA bitmap, rows from the bottom up, oldest first
+        self._dpi = None
+
+    def _label(self, text: str, renderer) -> np.ndarray:
+        """
+        :return: the RGBA bitmap of text with a pixel of margin around it, rows from the bottom up
+        """
+        if renderer.dpi != self._dpi:
+            self._labels = {}
+            self._dpi = renderer.dpi
+        label = self._labels.get(text)
+        if label is None:
+            from matplotlib.backends.backend_agg import RendererAgg
+
+            width, height, descent = renderer.get_text_width_height_descent(text, self.font, ismath=False)
+            offscreen = RendererAgg(math.ceil(width) + 2, math.ceil(height) + 2, renderer.dpi)
+            gc = offscreen.new_gc()
+            gc.set_foreground(self.color)
+            # y counts down from the top to the baseline, as on any canvas that flips y
+            offscreen.draw_text(gc, 1, 1 + height - descent, text, self.font, 0)
+            gc.restore()
+            label = np.asarray(offscreen.buffer_rgba())[::-1].copy()
+            if len(self._labels) >= TICK_LABELS_KEPT:
+                del self._labels[next(iter(self._labels))]
+            self._labels[text] = label
+        return label
+
+    def draw(self, renderer):
+        (x0, x1), bbox = self.ax.get_xlim(), self.ax.bbox
+        ticks = [tick for tick in self.ax.xaxis.get_major_locator().tick_values(x0, x1) if x0 <= tick <= x1]
+        self.marks.set_data(ticks, np.zeros(len(ticks)))
+        self.marks.draw(renderer)
+        texts = self.ax.xaxis.get_major_formatter().format_ticks(ticks)
+        top = bbox.y0 - renderer.points_to_pixels(self.offset)
+        gc = renderer.new_gc()
+        for text, x in zip(texts, self.ax.transData.transform([(tick, 0) for tick in ticks])[:, 0]):
+            label = self._label(text, renderer)
+            renderer.draw_image(gc, round(x - 0.5 * label.shape[1]), round(top - label.shape[0]), label)
+        gc.restore()
+
+
+class TrackViewer:
+    """
+    The waveform, spectrogram with tracks, and JND strip of one recording, on one figure, redrawn from the
+    pyramids whenever the time axis changes.
+
+    Drawing the axes' labels and ticks costs more than drawing the data, so the viewer keeps a bitmap of
+    everything that doesn't move with the time axis and, when its own scroll-zoom and drag-pan change the view,
+    draws only the data and the time ticks over it (blitting). Changes made in other ways, such as the toolbar,
+    redraw the whole figure.
+    """
+
+    def __init__(self, filename: str, figure=None, intensity_floor: float = None, dynamic_range: float = 70):
+        """
+        :param filename: path to a .wav file
+        :param figure: matplotlib figure to draw in, e.g. from pyplot for a window; defaults to an off-screen one
+        :param intensity_floor: see track_pyramids
+        :param dynamic_range: dB below the loudest spectrogram cell that are still shaded
+        """
+        self.filename = filename
+        self.reader = MappedWav(filename)
+        self.waveform = waveform_pyramid(filename, self.reader)
+        self.spectrogram, self.y_grid, vmax = spectrogram_pyramid(filename, self.reader)
+        self.tracks = track_pyramids(filename, intensity_floor)
+        if figure is None:
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            from matplotlib.figure import Figure
+            figure = Figure(figsize=(12.8, 7.2))
+            FigureCanvasAgg(figure)
+        self.figure = figure
+        self._background = None
+        self._drag = None
+        self._build(vmax - dynamic_range, vmax)
+        self.set_view(0.0, self.reader.duration)
+
+    def _build(self, vmin: float, vmax: float):
+        from matplotlib.patches import Polygon
+
+        fig = self.figure
+        # the time axes are linked in _on_xlim rather than shared, which would have every redraw lay out the
+        # hidden tick labels of the other axes too
+        wave_ax, spec_ax, jnd_ax = fig.subplots(3, 1, gridspec_kw={"height_ratios": (2, 4, 1)})
+        fig.subplots_adjust(left=0.07, right=0.98, top=0.94, bottom=0.07, hspace=0.08)
+        # a filled outline: stroking a vertical line per bin costs several times as much
+        self.wave_bands = [wave_ax.add_patch(Polygon(np.zeros((1, 2)), facecolor="C0", edgecolor="C0",
+                                                     lw=WAVEFORM_LINE_WIDTH)) for _ in range(self.reader.n_channels)]
+        low, high = self.waveform.extremes()
+        margin = 0.05 * (high - low) or 1.0
+        wave_ax.set_ylim(low - margin, high + margin)
+        wave_ax.set_ylabel("amplitude")
+
+        self.spec_raster = _Raster(spec_ax, "binary", vmin, vmax)
+        # speckles, as draw_values scatters them; lines through noisy formants are mostly long vertical strokes,
+        # which cost ten times as much to draw
+        self.track_lines = [spec_ax.plot([], [], linestyle="none", marker="o", markersize=2, markeredgewidth=0,
+                                         color=color, label=label)[0]
+                            for color, label in zip(FORMANT_COLORS, FORMANT_LABELS)]
+        spec_ax.set_ylim(self.y_grid[0], min(self.y_grid[-1], VALUES_MAX_FREQUENCY))
+        spec_ax.set_ylabel("frequency [Hz]")
+        # above the axes, so the legend is part of the kept bitmap and the tracks never run over it
+        fig.legend(handles=self.track_lines, loc="upper center", ncol=5, frameon=False, markerscale=3)
+
+        # one row per track, F0 at the bottom; a change of a JND or more between frames is fully coloured
+        self.jnd_raster = _Raster(jnd_ax, "seismic", -1, 1)
+        jnd_ax.set_ylim(0, 5)
+        jnd_ax.set_yticks(np.arange(5) + 0.5, FORMANT_LABELS)
+        # time ticks under the bottom axes only, drawn from kept label bitmaps, and the axis label outside
+        # them, so that a redraw lays out only labels it has not shown before
+        fig.supxlabel("time [s]", y=0.005, fontsize="medium")
+        self.time_ticks = _TimeTicks(jnd_ax)
+        for ax in (wave_ax, spec_ax, jnd_ax):
+            ax.xaxis.set_visible(False)
+        self.axes = (wave_ax, spec_ax, jnd_ax)
+        for ax in self.axes:
+            ax.set_autoscale_on(False)  # the limits follow the view, never the data set in _update
+
+        # drawn over the kept bitmap on every redraw, and left out of it
+        self._moving = [*self.wave_bands, self.spec_raster, *self.track_lines, self.jnd_raster, self.time_ticks]
+        for artist in self._moving:
+            if not isinstance(artist, (_Raster, _TimeTicks)):
+                artist.set_animated(True)
+
+        self._linking = False
+        for ax in self.axes:
+            ax.callbacks.connect("xlim_changed", self._on_xlim)
+            ax.callbacks.connect("ylim_changed", lambda ax: self._update(*ax.get_xlim()))  # repaint the rasters
+        canvas = fig.canvas
+        canvas.mpl_connect("draw_event", self._on_draw)
+        canvas.mpl_connect("resize_event", lambda event: self._update(*wave_ax.get_xlim()))
+        canvas.mpl_connect("scroll_event", self._on_scroll)
+        canvas.mpl_connect("button_press_event", self._on_press)
+        canvas.mpl_connect("motion_notify_event", self._on_motion)
+        canvas.mpl_connect("button_release_event", self._on_release)
+
+    def _max_bins(self) -> int:
+        return max(1, int(BINS_PER_PIXEL * self.axes[0].bbox.width))
+
+    def _update(self, from_time: float, to_time: float):
+        """
+        Replaces every artist's data with the bins visible between from_time and to_time
+        """
+        max_bins = self._max_bins()
+        left, width, lo, hi = self.waveform.window(from_time, to_time, max_bins)
+        # only the line of samples at level 0 needs stroking; above it every bin is filled at least a pixel high,
+        # since stroking the outline of thousands of bins costs twice as much as filling them
+        bottom, top = self.axes[0].get_ylim()
+        pixel = (top - bottom) / max(self.axes[0].bbox.height, 1)
+        for band, outline in zip(self.wave_bands, _outline(left, width, lo, hi, 0.0 if lo is hi else pixel)):
+            band.set_xy(outline)
+            band.set_linewidth(WAVEFORM_LINE_WIDTH if lo is hi else 0.0)
+
+        # rasters need no more than a bin per pixel
+        raster_bins = max_bins // BINS_PER_PIXEL
+        left, width, _, hi = self.spectrogram.window(from_time, to_time, raster_bins)
+        self.spec_raster.set_layers([(hi.T, left, width, self.y_grid[0], self.y_grid[-1])])
+
+        lines = iter(self.track_lines)
+        strip = []
+        for name, bottom in (("pitch", 0), ("formants", 1)):
+            x, ys = _speckles(*self.tracks[name].window(from_time, to_time, max_bins))
+            for y in ys:
+                next(lines).set_data(x, y)
+            left, width, lo, hi = self.tracks[f"{name}_jnd"].window(from_time, to_time, raster_bins)
+            strip.append((_strongest(lo, hi).T, left, width, bottom, bottom + hi.shape[1]))
+        self.jnd_raster.set_layers(strip)
+
+    def _on_xlim(self, ax):
+        """
+        Gives every axes the time limits one of them was given, and updates the data
+        """
+        if self._linking:
+            return
+        limits = ax.get_xlim()
+        self._linking = True
+        try:
+            for other in self.axes:
+                if other is not ax:
+                    other.set_xlim(limits)
+        finally:
+            self._linking = False
+        self._update(*limits)
+
+    def _draw_moving(self):
+        renderer = self.figure.canvas.get_renderer()
+        for artist in self._moving:
+            if isinstance(artist, (_Raster, _TimeTicks)):
+                artist.draw(renderer)
+            else:
+                artist.axes.draw_artist(artist)
+
+    def _on_draw(self, event):
+        """
+        After a full draw, which leaves out the moving artists: keeps the bitmap and draws them over it
+        """
+        self._background = self.figure.canvas.copy_from_bbox(self.figure.bbox)
+        self._draw_moving()
+
+    def redraw(self):
+        """
+        Draws the current view over the kept bitmap, or the whole figure if there is none yet
+        """
+        canvas = self.figure.canvas
+        if self._background is None:
+            canvas.draw()
+            return
+        canvas.restore_region(self._background)
+        self._draw_moving()
+        canvas.blit(self.figure.bbox)
+
+    def set_view(self, from_time: float, to_time: float):
+        """
+        Shows from_time to to_time; call redraw (or draw the figure) to see it
+        """
+        self.axes[0].set_xlim(from_time, to_time)
+
+    def _clamped_view(self, from_time: float, to_time: float):
+        span = min(to_time - from_time, self.reader.duration)
+        from_time = min(max(from_time, 0.0), self.reader.duration - span)
+        self.set_view(from_time, from_time + span)
+        self.redraw()
+
+    def _navigating(self) -> bool:
+        """
+        :return: whether a toolbar pan or zoom mode is on, which then owns the mouse
+        """
+        toolbar = getattr(self.figure.canvas, "toolbar", None)
+        return bool(toolbar is not None and toolbar.mode)
+
+    def _on_scroll(self, event):
+        """
+        Zooms the time axis around the pointer, in for scrolling up and out for scrolling down
+        """
+        if event.inaxes not in self.axes or event.xdata is None:
+            return
+        from_time, to_time = self.axes[0].get_xlim()
+        scale = 0.8 if event.button == "up" else 1.25
+        self._clamped_view(event.xdata - (event.xdata - from_time) * scale,
+                           event.xdata + (to_time - event.xdata) * scale)
+
+    def _on_press(self, event):
+        if event.button == 1 and event.inaxes in self.axes and not self._navigating():
+            self._drag = (event.x, self.axes[0].get_xlim())
+
+    def _on_motion(self, event):
+        """
+        Drags the time axis with the pointer
+        """
+        if self._drag is None or event.x is None:
+            return
+        x, (from_time, to_time) = self._drag
+        shift = (x - event.x) * (to_time - from_time) / self.axes[0].bbox.width
+        self._clamped_view(from_time + shift, to_time + shift)
+
+    def _on_release(self, event):
+        self._drag = None
+
+    def close(self):
+        self.reader.close()
+
+
+def show(filename: str, intensity_floor: float = None) -> TrackViewer:
+    """
+    Opens the viewer in a window and returns when it is closed
+    """
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure(figsize=(12.8, 7.2))
+    fig.canvas.manager.set_window_title(os.path.basename(filename))
+    viewer = TrackViewer(filename, fig, intensity_floor)
+    plt.show()
+    viewer.close()
+    return viewer
+
+
+def redraw_times(viewer: TrackViewer, redraws: int, seed: int = 0) -> np.ndarray:
+    """
+    Times random pans and zooms, each drawn as the viewer's scroll-zoom and drag-pan draw them
+    :param redraws: number of views to draw
+    :return: seconds per redraw
+    """
+    import time
+
+    rng = np.random.default_rng(seed)
+    duration = viewer.reader.duration
+    from_time, to_time = viewer.axes[0].get_xlim()
+    times = np.empty(redraws)
+    for i in range(redraws):
+        span = to_time - from_time
+        move = rng.integers(4)
+        if move == 0:  # zoom in or out around the middle
+            span = min(max(span * rng.choice((0.25, 0.5, 2.0, 4.0)), 0.02), duration)
+            middle = 0.5 * (from_time + to_time)
+        elif move == 1:  # pan by part of the window
+            middle = 0.5 * (from_time + to_time) + span * rng.uniform(-0.5, 0.5)
+        else:  # jump somewhere else at any zoom
+            span = duration * 10.0 ** rng.uniform(-5, 0)
+            middle = rng.uniform(0, duration)
+        from_time = min(max(middle - 0.5 * span, 0.0), duration - span)
+        to_time = from_time + span
+        start = time.perf_counter()
+        viewer.set_view(from_time, to_time)
+        viewer.redraw()
+        times[i] = time.perf_counter() - start
+    return times
+
+
+def main(argv=None):
+    import time
+
+    parser = argparse.ArgumentParser(description="View the waveform, spectrogram, pitch and formants of a recording.")
+    parser.add_argument("sound", nargs="?", default="One Small Step.wav")
+    parser.add_argument("--floor", type=float, default=None,
+                        help="analyse pitch and formants only around frames at least this loud, in dB")
+    parser.add_argument("--benchmark", type=int, default=0, metavar="REDRAWS",
+                        help="time this many random pans and zooms off-screen instead of opening a window")
+    args = parser.parse_args(argv)
+
+    if not args.benchmark:
+        show(args.sound, args.floor)
+        return 0
+
+    start = time.perf_counter()
+    viewer = TrackViewer(args.sound, intensity_floor=args.floor)
+    viewer.figure.canvas.draw()
+    print(f"opened {args.sound} ({viewer.reader.duration:.0f} s) in {time.perf_counter() - start:.2f} s")
+    times = redraw_times(viewer, args.benchmark) * 1000
+    print(f"{args.benchmark} redraws: median {np.median(times):.1f} ms, 95th percentile "
+          f"{np.percentile(times, 95):.1f} ms, slowest {times.max():.1f} ms")
+    viewer.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,205 @@
+##      WavReader.py
+##
+##      Description: memory-mapped access to .wav files. The sample data is
+##          mapped rather than read, sample ranges are NumPy views into the
+##          mapping, and parselmouth Sounds are built only for the span that is
+##          asked for (plus padding for analysis windows). Interval queries on
+##          long recordings cost time proportional to the interval, not the file.
+##
+##      ©2023
+##
+
+import math
+import os
+import struct
+import parselmouth as pm
+import numpy as np
+
+_WAVE_FORMAT_PCM = 0x0001
+_WAVE_FORMAT_IEEE_FLOAT = 0x0003
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# (format, bytes per sample) -> (raw dtype, offset, scale) so that float = (raw - offset) / scale,
+# the same conversion Praat uses when it reads the file
+_SAMPLE_TYPES = {
+    (_WAVE_FORMAT_PCM, 1): (np.dtype("u1"), 128.0, 128.0),
+    (_WAVE_FORMAT_PCM, 2): (np.dtype("<i2"), 0.0, 32768.0),
+    (_WAVE_FORMAT_PCM, 3): (np.dtype("u1"), 0.0, 8388608.0),  # unpacked from 3 bytes by read
+    (_WAVE_FORMAT_PCM, 4): (np.dtype("<i4"), 0.0, 2147483648.0),
+    (_WAVE_FORMAT_IEEE_FLOAT, 4): (np.dtype("<f4"), 0.0, 1.0),
+    (_WAVE_FORMAT_IEEE_FLOAT, 8): (np.dtype("<f8"), 0.0, 1.0),
+}
+
+
+class MappedWav:
+    """
+    A .wav file with its sample data memory-mapped. Sample i (0-based) is centred at (i + 0.5) / sampling_frequency
+    seconds, as in a parselmouth.Sound read from the same file.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        audio_format = None
+        data_offset = data_size = None
+        with open(filename, "rb") as f:
+            riff, _, wave_id = struct.unpack("<4sI4s", f.read(12))
+            if riff != b"RIFF" or wave_id != b"WAVE":
+                raise ValueError(f"{filename} is not a RIFF/WAVE file")
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    break
+                chunk_id, chunk_size = struct.unpack("<4sI", header)
+                if chunk_id == b"fmt ":
+                    fmt = f.read(chunk_size)
+                    audio_format, channels, rate, _, block_align, bits = struct.unpack("<HHIIHH", fmt[:16])
+                    if audio_format == _WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+                        audio_format = struct.unpack("<H", fmt[24:26])[0]  # first two bytes of the sub-format GUID
+                    f.seek(chunk_size % 2, os.SEEK_CUR)
+                elif chunk_id == b"data":
+                    data_offset = f.tell()
+                    data_size = chunk_size
+                    break
+                else:
+                    f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+        if audio_format is None or data_offset is None:
+            raise ValueError(f"{filename} has no fmt or data chunk")
+
+        self.n_channels = channels
+        self.sampling_frequency = float(rate)
+        self.sample_width = block_align // channels
+        if (audio_format, self.sample_width) not in _SAMPLE_TYPES:
+            raise ValueError(f"{filename}: unsupported sample format {audio_format} with {bits} bits")
+        self._dtype, self._offset, self._scale = _SAMPLE_TYPES[(audio_format, self.sample_width)]
+
+        # writers that stream to disk sometimes leave the data size unset, so trust the file length over it
+        data_size = min(data_size, os.path.getsize(filename) - data_offset)
+        self.n_samples = data_size // block_align
+        if self.n_samples == 0:
+            self._map = np.zeros((0, channels, self.sample_width) if self.sample_width == 3 else (0, channels),
+                                 dtype=self._dtype)
+        elif self.sample_width == 3:
+            self._map = np.memmap(filename, dtype=self._dtype, mode="r", offset=data_offset,
+                                  shape=(self.n_samples, channels, 3))
+        else:
+            self._map = np.memmap(filename, dtype=self._dtype, mode="r", offset=data_offset,
+                                  shape=(self.n_samples, channels))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.n_samples
+
+    def close(self):
+        """
+        Lets go of the mapping; it is unmapped once no array from view is left, so those stay readable
+        """
+        self._map = None
+
+    @property
+    def dx(self) -> float:
+        return 1.0 / self.sampling_frequency
+
+    @property
+    def duration(self) -> float:
+        return self.n_samples * self.dx
+
+    def time_to_sample(self, time: float) -> int:
+        """
+        :return: index of the sample nearest to time, clipped to the file
+        """
+        return min(max(round(time * self.sampling_frequency - 0.5), 0), max(self.n_samples - 1, 0))
+
+    def view(self, start: int = 0, end: int = None) -> np.ndarray:
+        """
+        :param start: first sample
+        :param end: sample after the last one, defaults to the end of the file
+        :return: samples x channels view of the raw data in the file, without copying (samples x channels x 3 bytes
+                    for 24-bit files)
+        """
+        return self._map[start:end]
+
+    def read(self, start: int = 0, end: int = None, channel: int = None) -> np.ndarray:
+        """
+        :param start: first sample
+        :param end: sample after the last one, defaults to the end of the file
+        :param channel: only this channel (0-based), as a 1 x samples array, None for all of them
+        :return: channels x samples float array scaled like parselmouth.Sound; only this range (and channel) is
+                    converted
+        """
+        raw = self._map[start:end]
+        if channel is not None:
+            raw = raw[:, channel:channel + 1]  # a strided view, the other channels are never touched
+        if self.sample_width == 3:
+            b = raw.astype(np.int32)
+            data = (b[..., 0] | (b[..., 1] << 8) | (b[..., 2] << 16)).astype(float)
+            data[data >= 1 << 23] -= 1 << 24
+        else:
+            data = raw.astype(float)
+        if self._offset:
+            data -= self._offset
+        if self._scale != 1.0:
+            data /= self._scale
+        return data.T
+
+    def times(self, start: int = 0, end: int = None) -> np.ndarray:
+        """
+        :return: times of the samples in [start, end), like parselmouth.Sound.xs
+        """
+        end = self.n_samples if end is None else end
+        return 0.5 * self.dx + np.arange(start, end) * self.dx
+
+    def sound(self, from_time: float = None, to_time: float = None, padding: float = 0.0,
+              channel: int = None) -> pm.Sound:
+        """
+        Builds a parselmouth.Sound from part of the file, keeping the file's time axis
+        :param from_time: start of the span in seconds, defaults to the start of the file
+        :param to_time: end of the span in seconds, defaults to the end of the file
+        :param padding: extra seconds included on each side, e.g. half an analysis window
+        :param channel: only this channel (0-based), as a mono Sound, None for all of them
+        :return: a Sound whose samples sit at the same times as in the whole file
+        """
+        from_time = 0.0 if from_time is None else from_time
+        to_time = self.duration if to_time is None else to_time
+        start = max(0, math.floor((from_time - padding) * self.sampling_frequency))
+        end = min(self.n_samples, math.ceil((to_time + padding) * self.sampling_frequency))
+        return pm.Sound(self.read(start, end, channel), sampling_frequency=self.sampling_frequency,
+                        start_time=start * self.dx)
+
+    def extract_part(self, from_time: float, to_time: float) -> pm.Sound:
+        """
+        Same result as pm.Sound(filename).extract_part(from_time=from_time, to_time=to_time), reading only the
+        samples in the interval
+        :param from_time: start of the interval in seconds
+        :param to_time: end of the interval in seconds
+        :return: the part as a Sound starting at time 0
+        """
+        return self.sound(from_time, to_time, padding=2 * self.dx).extract_part(from_time=from_time, to_time=to_time)
+
+
+def main():
+    import time
+
+    inFile = "One Small Step.wav"
+    from_time, to_time = 3.711298, 3.844613
+
+    start = time.perf_counter()
+    whole = pm.Sound(inFile).extract_part(from_time=from_time, to_time=to_time)
+    print(f"pm.Sound + extract_part: {(time.perf_counter() - start) * 1000:.2f} ms")
+
+    start = time.perf_counter()
+    with MappedWav(inFile) as wav:
+        part = wav.extract_part(from_time, to_time)
+    print(f"MappedWav.extract_part: {(time.perf_counter() - start) * 1000:.2f} ms")
+
+    same = np.array_equal(part.values, whole.values) and (part.xmin, part.xmax, part.x1, part.nx) == \
+        (whole.xmin, whole.xmax, whole.x1, whole.nx)
+    print(f"identical parts: {same}")
+
+
+if __name__ == "__main__":
+    main()
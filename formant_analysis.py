@@ -3,6 +3,8 @@ import os.path as path
 import numpy as np
 from FormantCleaning import draw_spectrogram
 from ExtractValues import *
+from TrackExtraction import pitch_track, formant_track, intensity_track
+import matplotlib.pyplot as plt
 from matplotlib.colors import TwoSlopeNorm
 
 def plot_differences(times, differences, maxF, minF):
@@ -30,28 +32,22 @@ def plot_differences(times, differences, maxF, minF):
 
 def get_pitch_values(pitch: pm.Pitch, intensity: pm.Intensity,
                      intensity_filter: float = 0, nan_as_zero=True) -> tuple[list[float, ...], list[float, ...]]:
-    values = []
-    for t in pitch.ts():
-        if intensity.get_value(time=t) > intensity_filter:
-            val = pitch.get_value_at_time(t)
-            if np.isnan(val) and nan_as_zero:
-                values.append(0.0)
-            else:
-                values.append(val)
-    return pitch.ts(), values
+    times = pitch.ts()
+    loud = intensity_track(intensity, times) > intensity_filter
+    values = pitch_track(pitch, times)[loud]
+    if nan_as_zero:
+        values[np.isnan(values)] = 0.0
+    return times, values.tolist()
 
 
 def get_formant_values(formant_number: int, formants: pm.Formant, intensity: pm.Intensity,
                        intensity_filter: float = 0, nan_as_zero=True) -> tuple[list[float, ...], list[float, ...]]:
-    values = []
-    for t in formants.ts():
-        if intensity.get_value(time=t) > intensity_filter:
-            val = formants.get_value_at_time(formant_number, t)
-            if np.isnan(val) and nan_as_zero:
-                values.append(0.0)
-            else:
-                values.append(val)
-    return formants.ts(), values
+    times = formants.ts()
+    loud = intensity_track(intensity, times) > intensity_filter
+    values = formant_track(formant_number, formants, times)[loud]
+    if nan_as_zero:
+        values[np.isnan(values)] = 0.0
+    return times, values.tolist()
 
 
 def get_formants(pitch: pm.Pitch, formants: pm.Formant, intensity: pm.Intensity,